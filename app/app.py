@@ -1,19 +1,14 @@
 import streamlit as st
-from story_generation.story_generator import StoryGenerator
-from voice_generation.voice_generator import VoiceGenerator
-from video_generation.video_generator import VideoGenerator
-from moviepy.editor import VideoFileClip
-import tempfile
+from jobs.job_manager import JobManager, ACTIVE_STATES, DONE, FAILED, CANCELLED
+from jobs import tasks
+from instrumentation.metrics import serve_metrics
+from environment import load_environment
+from storage.media_server import media_url, serve_media
+from storage.lifecycle import StorageManager, parse_quotas
 import os
-from pydub.utils import mediainfo
-from dotenv import load_dotenv
-path = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), '.env')
-load_dotenv(path)
+load_environment()
 import logging
-import mimetypes
 import time
-from PIL import Image
-import requests
 from streamlit_lottie import st_lottie
 import json
 
@@ -21,64 +16,136 @@ st.set_page_config(page_title="Reelify", page_icon=":tada:", layout="wide")
 
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Streamlit reruns this script on every interaction. Shared objects are created once per process
+# with st.cache_resource, and the generator modules (langchain, moviepy, PIL...) are only imported
+# once their stage is used.
+
+@st.cache_resource(show_spinner=False)
 def load_lottiefile(file_path: str):
     with open(file_path, "r") as f:
         return json.load(f)
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def create_story_generator(api_key):
-    return StoryGenerator(api_key=api_key)
+    from story_generation.story_generator import StoryGenerator
+    from story_generation.prompt_cache import PromptCache
+    return StoryGenerator(api_key=api_key, prompt_cache=PromptCache())
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def create_voice_generator(api_key):
+    from voice_generation.voice_generator import VoiceGenerator
     return VoiceGenerator(api_key=api_key)
 
-@st.cache_data(show_spinner=False)
+@st.cache_resource(show_spinner=False)
 def create_video_generator(openai_api_key = None, stable_diff_api_key = None):
+    from video_generation.video_generator import VideoGenerator
     return VideoGenerator(openai_api_key=openai_api_key,
                           stable_diff_api_key=stable_diff_api_key)
 
-@st.cache_data(show_spinner=False)
-def generate_story(_generator, story_summary):
-    return _generator.generate_story(story_summary)
-
-@st.cache_data(show_spinner=False)
-def generate_voice(_voice_generator, text, voice, model):
-    return _voice_generator.generate_story_audio(text, voice, model)
-
-@st.cache_data(show_spinner=False)
-def generate_static_video(_video_generator, audio_file, static_image):
-    return _video_generator.generate_video_static(audio_file, static_image)
+@st.cache_resource(show_spinner=False)
+def create_job_manager():
+    return JobManager()
+
+@st.cache_resource(show_spinner=False)
+def create_upload_ingestor():
+    from storage.ingestion import UploadIngestor
+    return UploadIngestor()
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server():
+    # Prometheus scrapes the stage latencies on http://<host>:$METRICS_PORT/metrics
+    port = os.environ.get("METRICS_PORT")
+    return serve_metrics(int(port)) if port else None
+
+@st.cache_resource(show_spinner=False)
+def start_media_server():
+    # Videos are streamed to the browser from http://<host>:$MEDIA_PORT with byte ranges, when
+    # $MEDIA_URL says where the browser reaches it (e.g. http://localhost:8502, or a proxy). Only
+    # the deployment knows that address, without it the videos are sent through Streamlit
+    base_url = os.environ.get("MEDIA_URL")
+    if not base_url:
+        return None
+    port = int(os.environ.get("MEDIA_PORT", 8502))
+    try:
+        serve_media(port)
+    except OSError:
+        logging.exception("Could not start the media server on port %s, videos are sent through Streamlit", port)
+        return None
+    return base_url
+
+@st.cache_resource(show_spinner=False)
+def start_storage_sweeper():
+    # Evicts the least recently used assets once a category is over its quota, every
+    # $STORAGE_SWEEP_SECONDS (0 disables it); $STORAGE_QUOTAS overrides quotas, e.g. "videos=5G,segments=10G"
+    manager = StorageManager(quotas=parse_quotas(os.environ.get("STORAGE_QUOTAS", "")))
+    interval = float(os.environ.get("STORAGE_SWEEP_SECONDS", 600))
+    if interval > 0:
+        manager.start_sweeper(interval)
+    return manager
+
+# Session keys of the background jobs, mirrored in the URL so a refresh finds them again
+JOB_KEYS = ["story_job", "audio_job", "video_job"]
+
+def sync_job_query_params():
+    st.experimental_set_query_params(**{key: st.session_state[key] for key in JOB_KEYS if st.session_state.get(key)})
+
+def start_job(job_key, kind, fn, *args, **kwargs):
+    """Submit a background job and remember its id under `job_key`."""
+    st.session_state[job_key] = create_job_manager().submit(kind, fn, *args, **kwargs)
+    sync_job_query_params()
+
+def poll_job(job_key):
+    """
+    Show the progress of the job stored under `job_key` and return its state record. Once the
+    job has finished the key is cleared, so a finished job is returned exactly once.
+    """
+    job_id = st.session_state.get(job_key)
+    if not job_id:
+        return None
+
+    job = create_job_manager().status(job_id)
+    if job is None or job["state"] not in ACTIVE_STATES:
+        st.session_state[job_key] = None
+        sync_job_query_params()
+
+    if job is None:
+        return None
+    if job["state"] in ACTIVE_STATES:
+        st.progress(job["progress"], text=job["message"])
+        if st.button("Cancel", key=f"cancel_{job_key}"):
+            create_job_manager().cancel(job_id)
+    elif job["state"] == FAILED:
+        st.error(f"Something went wrong... {job['error']}")
+    elif job["state"] == CANCELLED:
+        st.warning("Cancelled.")
+    return job
+
+def show_video(file_location):
+    url = media_url(file_location, start_media_server())
+    if url is None:
+        # Without the media server Streamlit serves the file itself
+        st.video(file_location, format="video/mp4")
+        with open(file_location, "rb") as f:
+            st.download_button(label="Download Video", data=f, file_name=os.path.basename(file_location),
+                               mime="video/mp4")
+        return
+
+    # The browser fetches the video itself, in ranges, and can start playing right away
+    st.video(url, format="video/mp4")
+    st.markdown(f"[Download Video]({url}?download=1)")
 
 @st.cache_data(show_spinner=False)
 def create_list_of_voices(_voice_generator):
     return _voice_generator.get_list_of_voices()
 
 @st.cache_data(show_spinner=False)
-def save_uploaded_images(_video_generator, image_files):
-    uploaded_images = []
-    for image in image_files:
-            logging.info("This is the image file")
-            logging.info(image)
-            # get the image extension from the image type (e.g., 'image/jpeg' -> '.jpeg')
-            image_extension = mimetypes.guess_extension(image.type)
-            
-            # create a filename, here using the current timestamp to avoid filename conflicts
-            image_filename = f"{int(time.time())}{image_extension}"
-            
-            # create a full path for saving the image (you can adjust the path to your needs)
-            image_path = os.path.join(_video_generator.image_path, image_filename)
-            
-            # write the image to file
-            with open(image_path, "wb") as f:
-                f.write(image.read())
-            
-            # store the path for future use
-            uploaded_images.append(image_path)
-
-    return uploaded_images
+def create_subtitles(_video_generator, audio_file, story):
+    return _video_generator.generate_subtitles(audio_file, story)
 
 def main():
+    start_metrics_server()
+    start_media_server()
+    start_storage_sweeper()
     st.title("Welcome to :orange[_Reelify_!]")
 
     # Instantiate some variables in the session state
@@ -93,6 +160,15 @@ def main():
     
     if "generated_image" not in st.session_state:
         st.session_state.generated_image = None
+
+    if "audio_file" not in st.session_state:
+        st.session_state.audio_file = None
+
+    # Pick up the jobs started before a browser refresh
+    query_params = st.experimental_get_query_params()
+    for job_key in JOB_KEYS:
+        if job_key not in st.session_state:
+            st.session_state[job_key] = query_params.get(job_key, [None])[0]
     
     # Create an instance of StoryGenerator
     openai_api_key = st.sidebar.text_input("Enter your OpenAI API Key", type="password")
@@ -103,10 +179,10 @@ def main():
 
     if elevenlabs_api_key:
         voice_generator = create_voice_generator(api_key=elevenlabs_api_key)
-    
-    # Video generator for default properties doesn't need an apy key
+
+    # The video generator (create_video_generator) doesn't need an API key, it is only created
+    # once the video section is used
     # TODO: Update this when image generation is integrated
-    video_generator = create_video_generator()
 
     # ---- LOAD ASSETS
      # Define the path to the audio file storage directory (db is copied into app folder in docker)
@@ -168,14 +244,15 @@ def main():
                                 else:
                                     story_summary = f"Generate a {age_group} {story_genre} story in {language} language."
 
-                                with st.spinner('Generating your story...'):
-                                    # Generate story (replace this with your AI-based story generation logic)
-                                    generated_story = generate_story(generator, story_summary)
-                                    st.session_state.story = generated_story.lstrip()
-
-                                st.text_area("AI Generated Story:", value=st.session_state.story)
+                                start_job("story_job", "story", tasks.generate_story, generator, story_summary,
+                                          language=language)
                             except UnboundLocalError:  # Catch the specific error you're interested in
                                 st.error("Please enter your OpenAI API Key to generate a story.")
+
+            story_job = poll_job("story_job")
+            if story_job and story_job["state"] == DONE:
+                st.session_state.story = story_job["result"]
+                st.text_area("AI Generated Story:", value=st.session_state.story)
         with right_column:
             st_lottie(lottie_story, height=300, key="audio_lottie", quality="high")
             
@@ -198,17 +275,9 @@ def main():
                     voice_submit_button = st.form_submit_button(label="Generate Audio")
                     if voice_submit_button:
                         try:
-                            with st.spinner("Generating your audio..."):
-                                # Generate audio
-                                audio = generate_voice(
-                                    voice_generator,
-                                    text=st.session_state.story,
-                                    voice=voice,
-                                    model=model
-                                )
-                                
-                                print(audio)
-                                st.audio(audio, format="audio/mp3")
+                            # Generate audio
+                            start_job("audio_job", "audio", tasks.generate_voice, voice_generator,
+                                      st.session_state.story, voice, model)
                         except UnboundLocalError:  # Catch the specific error you're interested in
                             st.error("Please enter your ElevenLabs API Key to generate a story.")
 
@@ -227,32 +296,31 @@ def main():
                     clone_submit_button = st.form_submit_button(label="Generate Audio")
 
                     if clone_submit_button and voice_file is not None:
-                        print(voice_file)
-
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".mp3") as tmpfile:
-                            # Write the uploaded audio bytes to temp file
-                            tmpfile.write(voice_file.getvalue())
-                            tmp_filename = tmpfile.name
-                        # Add validation for maximum length of the audio file
-                        audio_info = mediainfo(tmp_filename)
-                        if float(audio_info["duration"]) > 120:
-                            st.error("Uploaded audio is too long. Please upload an audio of maximum 2 minutes.")
+                        logging.debug("Cloning a voice from %s", voice_file.name)
 
+                        from storage.ingestion import UploadRejected
                         try:
-                            with st.spinner("Creating the story audio with custom voice..."):
-                                custom_audio = voice_generator.generate_story_with_new_voice(
-                                    text=st.session_state.story,
-                                    name=st.session_state.voice_name,
-                                    description=st.session_state.voice_description,
-                                    files=[tmp_filename]
-                                )
-                                print(custom_audio)
-                                st.audio(custom_audio, format="audio/mp3")
-                        except Exception as e:
-                            print(e)
-                            st.error("Cloning went wrong...")
-                        finally:
-                            os.remove(tmp_filename)
+                            # Stored under the hash of its contents, with its duration checked (maximum 2 minutes)
+                            sample_file = create_upload_ingestor().ingest_audio(voice_file, max_seconds=120)
+                            start_job("audio_job", "audio", tasks.generate_voice_clone, voice_generator,
+                                      text=st.session_state.story,
+                                      name=st.session_state.voice_name,
+                                      description=st.session_state.voice_description,
+                                      files=[sample_file])
+                        except UploadRejected as e:
+                            st.error(str(e))
+                        except UnboundLocalError:
+                            st.error("Please enter your ElevenLabs API Key to generate a story.")
+
+            audio_job = poll_job("audio_job")
+            if audio_job and audio_job["state"] in ACTIVE_STATES and audio_job.get("preview"):
+                # Start playback with the first sentence while the rest is synthesized
+                st.audio(audio_job["preview"], format="audio/mp3")
+            elif audio_job and audio_job["state"] == DONE:
+                st.session_state.audio_file = audio_job["result"]
+
+            if st.session_state.audio_file and not st.session_state.audio_job:
+                st.audio(st.session_state.audio_file, format="audio/mp3")
     
         with right_column2:
             st_lottie(lottie_audio, height=300, key="coding", quality="high")
@@ -273,51 +341,40 @@ def main():
 
                     if image_option == "Upload my own photos":
                         uploaded_images = st.file_uploader("Upload files:", [".png", ".jpg"], accept_multiple_files=True)
+                        pan_and_zoom = st.checkbox("Pan & zoom between photos", value=True)
 
                     elif image_option == "Use static default image":
                         st.session_state.image = None # This will default to black_image.png
 
+                    burn_subtitles = st.checkbox("Burn in subtitles", value=False, key="custom_image_subtitles")
+                    draft_preview = st.checkbox("Quick draft preview", value=False, key="custom_image_preview",
+                                                help="Low resolution, in a few seconds. The full video reuses its work.")
                     video_submitt_button = st.form_submit_button("Generate Video")
                     
                     if video_submitt_button:
 
-                        if uploaded_images and image_option == "Upload my own photos":
-                            st.session_state.uploaded_images = save_uploaded_images(video_generator, uploaded_images)
-                            # TODO: Naming of these videos
+                        if not st.session_state.audio_file:
+                            st.error("Generate the story audio first!")
 
+                        elif uploaded_images and image_option == "Upload my own photos":
+                            from storage.ingestion import UploadRejected
+                            from video_generation.motion import MotionSettings
                             try:
-                                with st.spinner("Generating your video..."):
-                                    video_generator.create_video(st.session_state.uploaded_images)
-                                    file_location = os.path.join(video_generator.video_path, "test.mp4")
-
-                                    with open(file_location, "rb") as f:
-                                        video_bytes = f.read()
-                                    st.video(video_bytes, format="video/mp4")
-
-                                    # Download video
-                                    st.download_button(
-                                        label="Download Video",
-                                        data=video_bytes,
-                                        file_name=file_location,
-                                        mime="video/mp4",
-                                    )
-
-                            except Exception as e:
-                                    st.error("")
+                                st.session_state.uploaded_images = create_upload_ingestor().ingest_images(uploaded_images)
+                            except UploadRejected as e:
+                                st.error(str(e))
+                            else:
+                                start_job("video_job", "video", tasks.create_video, create_video_generator(),
+                                          st.session_state.uploaded_images, st.session_state.audio_file,
+                                          motion=MotionSettings() if pan_and_zoom else None,
+                                          captions=st.session_state.story if burn_subtitles else None,
+                                          preview=draft_preview, cpu_bound=True)
 
                         elif image_option == "Use static default image":
-                            try:
-                                with st.spinner("Generating your video..."):
-                                    video_generator.generate_video_static(static_image = st.session_state.image)
-                                    # TODO: Naming of these videos
-                                    file_location = os.path.join(video_generator.video_path, "test.mp4")
-
-                                    with open(file_location, 'rb') as f:
-                                            video_bytes = f.read()
-                                    st.video(video_bytes, format="video/mp4")
-                                        
-                            except Exception as e:
-                                print(e)
+                            start_job("video_job", "video", tasks.generate_video_static, create_video_generator(),
+                                      st.session_state.audio_file, static_image=st.session_state.image,
+                                      captions=st.session_state.story if burn_subtitles else None,
+                                      preview=draft_preview, cpu_bound=True)
                         
                         else:
                             st.error("Upload some photos first!")
@@ -333,35 +390,46 @@ def main():
                     
                     if image_generation_submit_button:
                         with st.spinner("Generating your image..."):
-                            generated_image = video_generator.generate_images_with_dalle(api_key=openai_api_key,prompt=prompt)
+                            generated_image = create_video_generator().generate_images_with_dalle(api_key=openai_api_key,prompt=prompt)
                             
                             if generated_image is not None:
                                 st.session_state.generated_image = generated_image
-                                image = Image.open(generated_image)
-                                st.image(image, caption="Reelify")
+                                st.image(generated_image, caption="Reelify")
 
 
                 with st.form("video_generated_image_form"):
 
+                    burn_generated_subtitles = st.checkbox("Burn in subtitles", value=False, key="generated_image_subtitles")
+                    generated_preview = st.checkbox("Quick draft preview", value=False, key="generated_image_preview",
+                                                    help="Low resolution, in a few seconds. The full video reuses its work.")
                     video_gen_submit_button = st.form_submit_button("Generate video")
                     
-                    if video_gen_submit_button:
+                    if video_gen_submit_button and not st.session_state.audio_file:
+                        st.error("Generate the story audio first!")
 
-                        with st.spinner("Generating your video..."):
-                            try:
-                                video_generator.generate_video_static(static_image=st.session_state.generated_image)
-                                # TODO: Naming of these videos
-                                file_location = os.path.join(video_generator.video_path, "test.mp4")
+                    elif video_gen_submit_button:
+                        start_job("video_job", "video", tasks.generate_video_static, create_video_generator(),
+                                  st.session_state.audio_file, static_image=st.session_state.generated_image,
+                                  captions=st.session_state.story if burn_generated_subtitles else None,
+                                  preview=generated_preview, cpu_bound=True)
 
-                                with open(file_location, 'rb') as f:
-                                        video_bytes = f.read()
-                                st.video(video_bytes, format="video/mp4")
-                                        
-                            except Exception as e:
-                                print(e)
+            video_job = poll_job("video_job")
+            if video_job and video_job["state"] == DONE:
+                show_video(video_job["result"])
+
+                if st.session_state.story and st.session_state.audio_file:
+                    subtitle_file = create_subtitles(create_video_generator(), st.session_state.audio_file, st.session_state.story)
+                    with open(subtitle_file, "rb") as f:
+                        st.download_button(label="Download Subtitles", data=f.read(),
+                                           file_name=os.path.basename(subtitle_file), mime="application/x-subrip")
 
             with right_column3:
                 st_lottie(lottie_video, height=300, key="video_lottie", quality="high")
 
+    # Poll the background jobs until they finish
+    if any(st.session_state.get(job_key) for job_key in JOB_KEYS):
+        time.sleep(1)
+        st.experimental_rerun()
+
 if __name__ == "__main__":
     main()
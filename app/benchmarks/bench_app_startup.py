@@ -0,0 +1,129 @@
+"""
+Benchmark the Streamlit script: the time to import app.py in a fresh interpreter and the time
+of a script run, cold (first run of the process) and warm (the reruns Streamlit does on every
+widget interaction). No widget is touched, so no API key is entered and only the always-on
+parts of the page are measured.
+
+It also lists which heavy modules got imported; the generator stages should only load theirs
+once they are used. The ones Streamlit itself imports (numpy and PIL in 1.25) are listed
+apart, as "heavy_modules_preloaded". Pass budgets to fail when a change makes startup slower.
+
+    cd app && python -m benchmarks.bench_app_startup --reruns 20 --import-budget 3 --rerun-budget 0.2
+"""
+import os
+import sys
+import ast
+import json
+import argparse
+import statistics
+import subprocess
+
+HEAVY_MODULES = ["langchain", "elevenlabs", "moviepy", "pydub", "openai", "PIL", "numpy"]
+
+# Runs in a fresh interpreter, so the import and the first script run start from a cold process.
+# The script is driven by Streamlit's local script runner (what its own script tests use) with a
+# mocked server runtime, timing every run between its started and stopped events.
+PROBE = """
+import sys, json, time, logging, threading
+from unittest.mock import MagicMock
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner import RerunData, ScriptRunnerEvent
+from streamlit.testing.local_script_runner import LocalScriptRunner
+
+runtime = MagicMock(spec=Runtime)
+runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/media"))
+runtime.cache_storage_manager = MemoryCacheStorageManager()
+Runtime._instance = runtime
+logging.disable(logging.CRITICAL)
+
+# Imported by Streamlit before the app, whatever the app does
+preloaded = set(sys.modules)
+import_start = time.perf_counter()
+{imports}
+import_s = time.perf_counter() - import_start
+
+runs, errors, started, stopped = [], [], [0.0], threading.Event()
+
+def on_event(sender, event, **kwargs):
+    if event == ScriptRunnerEvent.SCRIPT_STARTED:
+        started[0] = time.perf_counter()
+    elif event == ScriptRunnerEvent.SCRIPT_STOPPED_WITH_SUCCESS:
+        runs.append(time.perf_counter() - started[0])
+        stopped.set()
+    elif event == ScriptRunnerEvent.SCRIPT_STOPPED_WITH_COMPILE_ERROR:
+        errors.append(str(event))
+        stopped.set()
+    elif event == ScriptRunnerEvent.ENQUEUE_FORWARD_MSG:
+        delta = kwargs["forward_msg"].delta
+        if delta.new_element.WhichOneof("type") == "exception":
+            errors.append(delta.new_element.exception.message)
+
+runner = LocalScriptRunner("app.py")
+runner.on_event.connect(on_event, weak=False)
+for run in range({runs}):
+    stopped.clear()
+    runner.request_rerun(RerunData())
+    if run == 0:
+        runner.start()
+    stopped.wait(60)
+runner.request_stop()
+runner.join()
+
+print(json.dumps({{
+    "import_s": import_s,
+    "runs_s": runs,
+    "errors": errors,
+    "loaded": [name for name in {heavy} if name in sys.modules and name not in preloaded],
+    "preloaded": [name for name in {heavy} if name in preloaded],
+}}))
+"""
+
+def app_imports(app_path: str) -> str:
+    """The top-level import statements of app.py, i.e. what every new process pays before its first run."""
+    with open(app_path) as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def probe(reruns: int) -> dict:
+    app_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+    imports = app_imports(os.path.join(app_dir, "app.py"))
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(imports=imports, runs=reruns + 1, heavy=HEAVY_MODULES)],
+        cwd=app_dir, capture_output=True, text=True, check=True,
+    )
+    # The result is the last line of stdout, Streamlit logs its own warnings around it
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reruns", type=int, default=20)
+    parser.add_argument("--import-budget", type=float, default=None, help="Maximum seconds to import app.py")
+    parser.add_argument("--rerun-budget", type=float, default=None, help="Maximum median seconds of a rerun")
+    args = parser.parse_args()
+
+    measured = probe(args.reruns)
+    reruns = measured["runs_s"][1:]
+    report = {
+        "import_s": round(measured["import_s"], 3),
+        "cold_run_s": round(measured["runs_s"][0], 3),
+        "rerun_median_s": round(statistics.median(reruns), 4) if reruns else None,
+        "rerun_max_s": round(max(reruns), 4) if reruns else None,
+        "heavy_modules_loaded": measured["loaded"],
+        "heavy_modules_preloaded": measured["preloaded"],
+        "script_errors": measured["errors"],
+    }
+    print(json.dumps(report))
+
+    if args.import_budget is not None and report["import_s"] > args.import_budget:
+        sys.exit(f"Importing app.py took {report['import_s']}s, over the {args.import_budget}s budget")
+    if args.rerun_budget is not None and reruns and report["rerun_median_s"] > args.rerun_budget:
+        sys.exit(f"A rerun took {report['rerun_median_s']}s, over the {args.rerun_budget}s budget")
+
+
+if __name__ == "__main__":
+    main()
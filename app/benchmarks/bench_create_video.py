@@ -0,0 +1,79 @@
+"""
+Compare `VideoGenerator.create_video` against the previous temp.gif + moviepy render.
+
+Each render runs in a fresh process so peak RSS is measured independently. ffmpeg runs as a
+child process, so its peak RSS is reported separately.
+
+    cd app && python -m benchmarks.bench_create_video --images 8 --seconds 60
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image
+from mutagen.mp3 import MP3
+from moviepy import editor
+
+from benchmarks.synthetic import make_audio, make_images
+from storage.asset_store import AssetStore
+from video_generation.video_generator import Frames, VideoGenerator
+
+
+def legacy_create_video(image_files, audio_file_path, output_video_path, video_size):
+    """The gif round trip `create_video` used before rendering through the frame pipe."""
+    audio_length = MP3(audio_file_path).info.length
+    duration_per_image = audio_length / len(image_files)
+    gif_path = output_video_path + ".gif"
+
+    images = [Image.open(image).resize(video_size, Image.ANTIALIAS) for image in image_files]
+    images[0].save(gif_path, save_all=True, append_images=images[1:], duration=int(duration_per_image)*1000)
+
+    video = editor.VideoFileClip(gif_path)
+    audio = editor.AudioFileClip(audio_file_path)
+    video.set_audio(audio).write_videofile(output_video_path, fps=30, codec="libx264", logger=None)
+    os.remove(gif_path)
+
+
+def run(path_name, image_files, audio_file_path, work_dir, video_size, results):
+    start = time.perf_counter()
+    if path_name == "legacy":
+        legacy_create_video(image_files, audio_file_path, os.path.join(work_dir, "legacy.mp4"), video_size)
+    else:
+        store = AssetStore(os.path.join(work_dir, "store"))
+        VideoGenerator(asset_store=store).create_video(image_files, audio_file_path, video_size)
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is reported in kilobytes on Linux
+    results.put({
+        "path": path_name,
+        "wall_time_s": round(wall_time, 2),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "ffmpeg_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=60)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_file_path = make_audio(os.path.join(work_dir, "story.mp3"), args.seconds)
+        image_files = make_images(os.path.join(work_dir, "images"), args.images)
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        for path_name in ("legacy", "frame_pipe"):
+            process = context.Process(target=run, args=(path_name, image_files, audio_file_path, work_dir,
+                                                        Frames.INSTAGRAM_REEL, results))
+            process.start()
+            process.join()
+            print(results.get())
+
+
+if __name__ == "__main__":
+    main()
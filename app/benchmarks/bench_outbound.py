@@ -0,0 +1,87 @@
+"""
+Benchmark the outbound scheduler against a local image API that answers 429 over its rate limit.
+
+A batch of image requests is sent at batch priority, and interactive requests arrive while it
+runs. Without limits every thread fires at once and the stub throttles most of them, which are
+retried with backoff; with limits matching the stub the requests are spaced out and the
+interactive ones skip the batch queue.
+
+    cd app && python -m benchmarks.bench_outbound --batch 24 --interactive 4 --rpm 240
+"""
+import time
+import argparse
+import tempfile
+import threading
+from statistics import mean
+
+from benchmarks.fakes import FakeImageServer
+from outbound.scheduler import BATCH, INTERACTIVE, OutboundScheduler, ProviderLimits, outbound_priority
+from storage.asset_store import AssetStore
+from video_generation.image_generation import DalleImageGenerator
+
+
+def run(server: FakeImageServer, limits: ProviderLimits, batch: int, interactive: int, delay: float) -> dict:
+    scheduler = OutboundScheduler({"dalle": limits})
+    latencies = {BATCH: [], INTERACTIVE: []}
+    lock = threading.Lock()
+
+    with tempfile.TemporaryDirectory() as root:
+        generator = DalleImageGenerator("fake-key", AssetStore(root), api_base=server.api_base,
+                                        max_concurrency=batch + interactive, scheduler=scheduler)
+
+        def request(priority: int, index: int):
+            start = time.perf_counter()
+            with outbound_priority(priority):
+                generator.generate(f"prompt {priority} {index}", size=(256, 256))
+            with lock:
+                latencies[priority].append(time.perf_counter() - start)
+
+        rate_limited = server.rate_limited
+        start = time.perf_counter()
+        threads = [threading.Thread(target=request, args=(BATCH, index)) for index in range(batch)]
+        for thread in threads:
+            thread.start()
+        time.sleep(delay)
+        for index in range(interactive):
+            thread = threading.Thread(target=request, args=(INTERACTIVE, index))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    stats = scheduler.stats()["dalle"]
+    return {
+        "seconds": round(time.perf_counter() - start, 2),
+        "throttled": server.rate_limited - rate_limited,
+        "retries": stats["retries"],
+        "interactive_mean": round(mean(latencies[INTERACTIVE]), 2),
+        "interactive_max": round(max(latencies[INTERACTIVE]), 2),
+        "batch_mean": round(mean(latencies[BATCH]), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=24, help="Batch requests, sent first")
+    parser.add_argument("--interactive", type=int, default=4, help="Interactive requests, sent while the batch runs")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds between the batch and the interactive requests")
+    parser.add_argument("--rpm", type=float, default=240, help="Rate limit of the stub, requests per minute")
+    parser.add_argument("--window", type=float, default=1.0, help="Seconds the stub enforces its limit over")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds every accepted request takes")
+    args = parser.parse_args()
+
+    scenarios = {
+        # Retries alone, every request is sent as soon as its thread gets to it
+        "unlimited": ProviderLimits(max_concurrency=args.batch + args.interactive, max_retries=10, base_delay=0.25),
+        "limited": ProviderLimits(requests_per_minute=args.rpm, burst_seconds=args.window, max_concurrency=4,
+                                  max_retries=10, base_delay=0.25),
+    }
+    with FakeImageServer(latency=args.latency, image_size=256, requests_per_minute=args.rpm,
+                         window=args.window) as server:
+        for name, limits in scenarios.items():
+            result = run(server, limits, args.batch, args.interactive, args.delay)
+            print(f"{name:>10}: " + "  ".join(f"{key}={value}" for key, value in result.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Time a draft preview against the final render, and the final render started from scratch
+against one following its preview (which finds the fitted images, the timeline and the audio
+track stored).
+
+Every sequence gets a fresh asset store.
+
+    cd app && python -m benchmarks.bench_preview --images 8 --seconds 30 --motion
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+from benchmarks.synthetic import make_audio, make_images
+from storage.asset_store import AssetStore
+from video_generation.motion import MotionSettings
+from video_generation.video_generator import Frames, VideoGenerator
+
+
+def timed(fn, *args, **kwargs) -> float:
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return round(time.perf_counter() - start, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--motion", action="store_true", help="Render with pan/zoom and crossfades")
+    parser.add_argument("--captions", action="store_true", help="Burn in subtitles")
+    args = parser.parse_args()
+
+    motion = MotionSettings() if args.motion else None
+    captions = " ".join(f"Sentence number {index} of the story." for index in range(int(args.seconds / 3))) \
+        if args.captions else None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_file_path = make_audio(os.path.join(work_dir, "story.mp3"), args.seconds)
+        image_files = make_images(os.path.join(work_dir, "images"), args.images)
+
+        def render(name, preview):
+            generator = VideoGenerator(asset_store=AssetStore(os.path.join(work_dir, name)))
+            return lambda: generator.create_video(image_files, audio_file_path, Frames.INSTAGRAM_REEL, motion=motion,
+                                                  captions=captions, preview=preview)
+
+        cold_final = timed(render("cold", preview=False))
+        preview = timed(render("draft", preview=True))
+        final_after_preview = timed(render("draft", preview=False))
+
+    print(json.dumps({"preview_s": preview, "cold_final_s": cold_final, "final_after_preview_s": final_after_preview,
+                      "images": args.images, "audio_seconds": args.seconds, "motion": args.motion}))
+
+
+if __name__ == "__main__":
+    main()
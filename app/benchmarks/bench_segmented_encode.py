@@ -0,0 +1,79 @@
+"""
+Compare a single-worker encode of a slideshow against the parallel per-slide segment encode, for every
+quality profile, on the cores of this machine (or fewer, with --cores).
+
+Each render gets a fresh asset store so nothing is reused between them. The segmented
+renders are timed once the worker processes are started, like on a render box serving
+several videos.
+
+    cd app && python -m benchmarks.bench_segmented_encode --images 12 --seconds 120 --motion
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+from benchmarks.synthetic import make_audio, make_images
+from storage.asset_store import AssetStore
+from video_generation.encoder import QUALITY_PROFILES, auto_settings
+from video_generation.motion import MotionSettings
+from video_generation.segmented import SegmentedEncoder
+from video_generation.video_generator import Frames, VideoGenerator
+
+
+def render(work_dir, name, image_files, audio_file_path, encoder, settings, motion):
+    generator = VideoGenerator(asset_store=AssetStore(os.path.join(work_dir, name)), segmented_encoder=encoder)
+    # Fit the images first, only the encode is timed
+    frame_size = motion.source_size(Frames.INSTAGRAM_REEL) if motion else Frames.INSTAGRAM_REEL
+    generator.image_preprocessor.prepare_many_sizes(image_files, [frame_size])
+    generator.audio_track(audio_file_path, settings)
+
+    start = time.perf_counter()
+    path = generator.create_video(image_files, audio_file_path, Frames.INSTAGRAM_REEL, settings=settings, motion=motion)
+    return time.perf_counter() - start, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=12)
+    parser.add_argument("--seconds", type=float, default=120)
+    parser.add_argument("--cores", type=int, default=None, help="Cores to use, defaults to all")
+    parser.add_argument("--threads-per-segment", type=int, default=4)
+    parser.add_argument("--motion", action="store_true", help="Render with pan/zoom and crossfades")
+    args = parser.parse_args()
+
+    cores = args.cores or os.cpu_count() or 1
+    motion = MotionSettings() if args.motion else None
+    single = SegmentedEncoder(cores=cores, threads_per_segment=cores)
+    segmented = SegmentedEncoder(cores=cores, threads_per_segment=args.threads_per_segment)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        audio_file_path = make_audio(os.path.join(work_dir, "story.mp3"), args.seconds)
+        image_files = make_images(os.path.join(work_dir, "images"), args.images)
+
+        # Start the workers before timing
+        warmup_audio = make_audio(os.path.join(work_dir, "warmup.mp3"), 4)
+        render(work_dir, "warmup", image_files[:2], warmup_audio, segmented, auto_settings("fast", cores), motion)
+
+        for profile in QUALITY_PROFILES:
+            settings = auto_settings(profile, cores)
+            single_s, single_bytes = render(work_dir, f"single-{profile}", image_files, audio_file_path, single, settings, motion)
+            segmented_s, segmented_bytes = render(work_dir, f"segmented-{profile}", image_files, audio_file_path,
+                                                  segmented, settings, motion)
+            print(json.dumps({
+                "profile": profile,
+                "preset": settings.preset,
+                "crf": settings.crf,
+                "cores": cores,
+                "workers": segmented.workers,
+                "single_s": round(single_s, 2),
+                "segmented_s": round(segmented_s, 2),
+                "speedup": round(single_s / segmented_s, 2),
+                "single_mb": round(single_bytes / 2 ** 20, 2),
+                "segmented_mb": round(segmented_bytes / 2 ** 20, 2),
+            }))
+
+
+if __name__ == "__main__":
+    main()
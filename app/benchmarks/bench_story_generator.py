@@ -0,0 +1,91 @@
+"""
+Benchmark StoryGenerator against a fake local LLM.
+
+- per-call overhead: latency-free LLM, chains rebuilt on every call (the previous behaviour)
+  vs. the chain built once per generator.
+- batch throughput: a sequential loop of generate_story vs. generate_stories.
+- early exit: latency of a story whose first draft passes the validator, with and without
+  skipping the review and improve steps.
+
+    cd app && python -m benchmarks.bench_story_generator --calls 200 --ideas 32 --latency 0.2
+"""
+import argparse
+import time
+
+from langchain.chains import SequentialChain
+
+from benchmarks.fakes import lift_rate_limits
+from story_generation.fake_llm import FakeStoryLLM
+from story_generation.story_generator import StoryGenerator
+
+
+def legacy_generate_story(llm, idea):
+    """generate_story as it was before the chains were built once per generator."""
+    chains = StoryGenerator.build_chains(llm)
+    return SequentialChain(chains=list(chains), input_variables=["idea"], verbose=True).run(idea)
+
+
+def per_call_overhead(calls: int) -> dict:
+    llm = FakeStoryLLM()
+
+    start = time.perf_counter()
+    for _ in range(calls):
+        legacy_generate_story(llm, "idea")
+    rebuilt = (time.perf_counter() - start) / calls
+
+    generator = StoryGenerator(llm=llm, early_exit=None)
+    start = time.perf_counter()
+    for _ in range(calls):
+        generator.generate_story("idea")
+    built_once = (time.perf_counter() - start) / calls
+
+    return {"rebuilt_per_call_ms": round(rebuilt * 1000, 3), "built_once_per_call_ms": round(built_once * 1000, 3)}
+
+
+def batch_throughput(ideas: int, latency: float, max_concurrency: int) -> dict:
+    generator = StoryGenerator(llm=FakeStoryLLM(latency=latency), early_exit=None)
+    batch = [f"idea {i}" for i in range(ideas)]
+
+    start = time.perf_counter()
+    for idea in batch:
+        generator.generate_story(idea)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generator.generate_stories(batch, max_concurrency=max_concurrency)
+    concurrent = time.perf_counter() - start
+
+    return {
+        "sequential_stories_per_s": round(ideas / sequential, 2),
+        "batch_stories_per_s": round(ideas / concurrent, 2),
+        "max_concurrency": max_concurrency,
+    }
+
+
+def early_exit(latency: float) -> dict:
+    # The fake LLM answers with 100 words, within the 75-150 words the validator accepts
+    results = {}
+    for name, generator in (("full_chain_s", StoryGenerator(llm=FakeStoryLLM(latency=latency), early_exit=None)),
+                            ("early_exit_s", StoryGenerator(llm=FakeStoryLLM(latency=latency)))):
+        start = time.perf_counter()
+        generator.generate_story("idea")
+        results[name] = round(time.perf_counter() - start, 3)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--ideas", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds per fake LLM call")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    args = parser.parse_args()
+    lift_rate_limits()
+
+    print(per_call_overhead(args.calls))
+    print(batch_throughput(args.ideas, args.latency, args.max_concurrency))
+    print(early_exit(args.latency))
+
+
+if __name__ == "__main__":
+    main()
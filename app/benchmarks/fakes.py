@@ -0,0 +1,162 @@
+"""
+Local stand-ins for the external APIs that don't have one next to the code using them.
+FakeStoryLLM (story_generation.fake_llm) and FakeTTSBackend (voice_generation.tts_backends)
+cover OpenAI completions and ElevenLabs.
+"""
+import io
+import json
+import time
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from outbound.scheduler import DEFAULT_LIMITS, SCHEDULER, OutboundScheduler, ProviderLimits
+
+
+def lift_rate_limits(scheduler: OutboundScheduler = SCHEDULER):
+    """The fakes don't throttle: drop the limits of the real APIs so benchmarks time the code, not the scheduler."""
+    for provider in DEFAULT_LIMITS:
+        scheduler.set_limits(provider, ProviderLimits(max_concurrency=1024))
+
+
+def synthetic_png(size: int, seed: int) -> bytes:
+    """A smooth noise PNG of size x size, different for every seed."""
+    rng = np.random.default_rng(seed)
+    noise = rng.integers(0, 256, size=(size // 64, size // 64, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noise).resize((size, size), Image.BILINEAR).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class FakeImageServer:
+    """
+    HTTP stub of the OpenAI image generation endpoint (`POST /v1/images/generations`), serving
+    synthetic PNGs. Point the openai client at it with `openai.api_base = server.api_base`.
+    With a rate limit, requests over it are answered 429 with a Retry-After, as OpenAI does.
+
+    Usage:
+        with FakeImageServer(latency=0.5, requests_per_minute=60) as server:
+            openai.api_base = server.api_base
+            ...
+    """
+
+    def __init__(self, latency: float = 0.0, image_size: int = 1024, requests_per_minute: float = 0,
+                 window: float = 1.0):
+        """
+        :param latency: Seconds every generation request takes
+        :param image_size: Width and height of the generated images
+        :param requests_per_minute: Rate limit of the generation requests, 0 for none
+        :param window: Seconds' worth of requests allowed at once
+        """
+        self.latency = latency
+        self.image_size = image_size
+        self.requests_per_minute = requests_per_minute
+        self.window = window
+        self.images = {}
+        self.requests = 0
+        self.rate_limited = 0
+        self._allowance = requests_per_minute * window / 60
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def api_base(self) -> str:
+        return f"{self.url}/v1"
+
+    def _retry_after(self) -> float:
+        """Seconds until the request may be accepted under the rate limit, 0 if it is (and counted)."""
+        if not self.requests_per_minute:
+            return 0.0
+        rate = self.requests_per_minute / 60
+        now = time.monotonic()
+        with self._lock:
+            # Replenished continuously up to `window` seconds' worth, as OpenAI describes its limits
+            self._allowance = min(max(1.0, rate * self.window), self._allowance + (now - self._updated) * rate)
+            self._updated = now
+            if self._allowance < 1:
+                self.rate_limited += 1
+                return (1 - self._allowance) / rate
+            self._allowance -= 1
+            return 0.0
+
+    def _new_image(self) -> int:
+        with self._lock:
+            image_id = len(self.images)
+            self.images[image_id] = synthetic_png(self.image_size, image_id)
+            return image_id
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes, content_type: str, **headers):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name.replace("_", "-"), value)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if self.path != "/v1/images/generations":
+                    return self._send(404, b"{}", "application/json")
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                with server._lock:
+                    server.requests += 1
+                retry_after = server._retry_after()
+                if retry_after:
+                    error = {"message": "Rate limit reached for images per minute", "type": "requests",
+                             "param": None, "code": "rate_limit_exceeded"}
+                    return self._send(429, json.dumps({"error": error}).encode("utf-8"), "application/json",
+                                      Retry_After=f"{retry_after:.3f}")
+                time.sleep(server.latency)
+
+                data = []
+                for _ in range(int(request.get("n", 1))):
+                    image_id = server._new_image()
+                    if request.get("response_format") == "b64_json":
+                        data.append({"b64_json": base64.b64encode(server.images[image_id]).decode("ascii")})
+                    else:
+                        data.append({"url": f"{server.url}/images/{image_id}.png"})
+                body = json.dumps({"created": int(time.time()), "data": data}).encode("utf-8")
+                self._send(200, body, "application/json")
+
+            def do_GET(self):
+                try:
+                    image_id = int(self.path.rsplit("/", 1)[-1].split(".")[0])
+                    image = server.images[image_id]
+                except (ValueError, KeyError):
+                    return self._send(404, b"", "text/plain")
+                self._send(200, image, "image/png")
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,139 @@
+"""
+Offline end-to-end benchmark of the story → voice → images → video pipeline.
+
+OpenAI, ElevenLabs and DALL·E are replaced by local fakes with configurable latency, so the
+numbers only move when our code does. Every scenario runs in a fresh process with an empty
+asset store and reports per-stage latency and peak Python memory, the encode throughput and
+the peak RSS of the process and of ffmpeg. Results are written as JSON to compare commits.
+
+    cd app && python -m benchmarks.run_pipeline --story-words 100 300 --images 3 8 \\
+        --frame-sizes INSTAGRAM_REEL INSTAGRAM_POST --output bench_results.json
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import itertools
+import subprocess
+import tempfile
+import tracemalloc
+import multiprocessing
+from contextlib import contextmanager
+
+import openai
+
+from benchmarks.fakes import FakeImageServer, lift_rate_limits
+from story_generation.fake_llm import FakeStoryLLM
+from story_generation.story_generator import StoryGenerator
+from storage.asset_store import AssetStore
+from video_generation.video_generator import Frames, VideoGenerator
+from voice_generation.tts_backends import FakeTTSBackend
+from voice_generation.voice_generator import VoiceGenerator
+
+
+@contextmanager
+def stage(results: dict, name: str):
+    """Record the wall time and the peak traced Python memory of a pipeline stage."""
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    yield
+    results[name] = {
+        "latency_s": round(time.perf_counter() - start, 3),
+        "peak_traced_mb": round(tracemalloc.get_traced_memory()[1] / 1024 / 1024, 1),
+    }
+
+
+def run_scenario(scenario: dict, latencies: dict, results):
+    work_dir = tempfile.mkdtemp(prefix="reelify-bench-")
+    store = AssetStore(work_dir)
+    stages = {}
+    lift_rate_limits()
+    tracemalloc.start()
+    try:
+        with FakeImageServer(latency=latencies["image"]) as image_server:
+            openai.api_base = image_server.api_base
+
+            with stage(stages, "story"):
+                llm = FakeStoryLLM(latency=latencies["llm"], words=scenario["story_words"])
+                story = StoryGenerator(llm=llm).generate_story("A benchmark story")
+
+            with stage(stages, "voice"):
+                tts = FakeTTSBackend(latency=latencies["tts"])
+                audio_file = VoiceGenerator(asset_store=store, backend=tts).generate_story_audio(story)
+
+            video_generator = VideoGenerator(image_path=store.category_dir("images"), asset_store=store)
+            frame_size = Frames.all()[scenario["frame_size"]]
+            with stage(stages, "images"):
+                # Fitted to the frame size as they arrive, so the render below finds the frames cached
+                images = video_generator.generate_images("A benchmark image", n=scenario["images"],
+                                                         frame_sizes=[frame_size], api_key="fake")
+
+            with stage(stages, "video"):
+                video_file = video_generator.create_video(images, audio_file, frame_size)
+
+        audio_seconds = video_generator.read_audio_file(audio_file)
+        frames = round(audio_seconds * 30)
+        results.put({
+            "scenario": scenario,
+            "stages": stages,
+            "audio_seconds": round(audio_seconds, 2),
+            "encode_frames_per_s": round(frames / stages["video"]["latency_s"], 1),
+            "video_bytes": os.path.getsize(video_file),
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "ffmpeg_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        })
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--story-words", type=int, nargs="+", default=[100])
+    parser.add_argument("--images", type=int, nargs="+", default=[4])
+    parser.add_argument("--frame-sizes", nargs="+", default=["INSTAGRAM_REEL"], choices=list(Frames.all()))
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds per fake LLM call")
+    parser.add_argument("--tts-latency", type=float, default=0.5, help="Seconds per fake TTS request")
+    parser.add_argument("--image-latency", type=float, default=1.0, help="Seconds per fake image generation")
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+
+    latencies = {"llm": args.llm_latency, "tts": args.tts_latency, "image": args.image_latency}
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "latencies": latencies,
+        "results": [],
+    }
+
+    for story_words, images, frame_size in itertools.product(args.story_words, args.images, args.frame_sizes):
+        scenario = {"story_words": story_words, "images": images, "frame_size": frame_size}
+        process = context.Process(target=run_scenario, args=(scenario, latencies, results))
+        process.start()
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Scenario {scenario} failed")
+        result = results.get()
+        print(json.dumps(result))
+        report["results"].append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import subprocess
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+from imageio_ffmpeg import get_ffmpeg_exe
+
+
+def make_audio(path: str, seconds: float) -> str:
+    """Write a sine tone mp3 of the given length, a stand-in for a generated story audio."""
+    subprocess.run(
+        [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "lavfi", "-i", f"sine=frequency=440:duration={seconds}",
+         "-c:a", "libmp3lame", "-b:a", "128k", path],
+        check=True,
+    )
+    return path
+
+
+def make_images(directory: str, count: int, size: Tuple[int, int] = (3024, 4032), seed: int = 0) -> List[str]:
+    """Write `count` noisy JPEGs of `size`, roughly what users upload from their phones."""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    width, height = size
+    paths = []
+    for i in range(count):
+        # Low resolution noise upscaled, so the JPEGs compress like photos rather than static
+        noise = rng.integers(0, 256, size=(height // 64, width // 64, 3), dtype=np.uint8)
+        image = Image.fromarray(noise).resize(size, Image.BILINEAR)
+        path = os.path.join(directory, f"image_{i}.jpg")
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
@@ -0,0 +1,13 @@
+import os
+import functools
+
+from dotenv import load_dotenv
+
+# The .env file lives in the project root, next to docker-compose.yml
+ENV_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), ".env")
+
+
+@functools.lru_cache(maxsize=None)
+def load_environment():
+    """Load the .env file into the environment variables, once per process."""
+    load_dotenv(ENV_PATH)
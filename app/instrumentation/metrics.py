@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import uuid
+import bisect
+import threading
+import functools
+import contextvars
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, Optional
+
+# Upper bounds of the latency histogram buckets in seconds, from a cached lookup to a long render
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+QUANTILES = (0.5, 0.9, 0.99)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+# A value exported as is, e.g. the depth of a queue, see `MetricsRegistry.register_collector`
+Sample = namedtuple("Sample", ["name", "type", "help", "labels", "value"])
+
+
+class Span:
+    """
+    Timing of one call of a pipeline stage, with the sizes of its inputs and its outcome.
+    """
+
+    def __init__(self, name: str, attributes: dict, parent: Optional["Span"] = None):
+        self.name = name
+        self.attributes = attributes
+        self.id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.id if parent else None
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.duration = None
+        self.outcome = "ok"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start_perf
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "id": self.id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration": self.duration,
+            "outcome": self.outcome,
+            "attributes": self.attributes,
+            "pid": os.getpid(),
+        }
+
+
+class StageMetrics:
+    """Aggregates of the spans of one stage: a cumulative histogram and a rolling window."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.bucket_counts = [0] * (len(BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.outcomes = {}
+        self.inputs = {}
+        self.recent = deque()
+
+    def observe(self, span: dict):
+        duration = span["duration"]
+        self.bucket_counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        self.total += duration
+        self.count += 1
+        self.outcomes[span["outcome"]] = self.outcomes.get(span["outcome"], 0) + 1
+        for name, value in span["attributes"].items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                self.inputs[name] = self.inputs.get(name, 0) + value
+
+        now = time.time()
+        self.recent.append((now, duration))
+        self.trim(now)
+
+    def trim(self, now: float):
+        while self.recent and now - self.recent[0][0] > self.window:
+            self.recent.popleft()
+
+    def rolling_histogram(self) -> dict:
+        """Bucket counts (non-cumulative) of the durations observed in the last `window` seconds."""
+        self.trim(time.time())
+        counts = [0] * (len(BUCKETS) + 1)
+        for _, duration in self.recent:
+            counts[bisect.bisect_left(BUCKETS, duration)] += 1
+        return dict(zip([str(bound) for bound in BUCKETS] + ["+Inf"], counts))
+
+    def rolling_quantiles(self) -> dict:
+        self.trim(time.time())
+        durations = sorted(duration for _, duration in self.recent)
+        if not durations:
+            return {}
+        return {q: durations[min(len(durations) - 1, int(q * len(durations)))] for q in QUANTILES}
+
+
+class MetricsRegistry:
+    """
+    Collects timing spans of the generators and exports them as Prometheus text metrics and,
+    optionally, as JSON lines trace files.
+
+    Usage:
+        with METRICS.span("video.encode", frames=900) as span:
+            ...
+            span.set(audio_seconds=30.0)
+
+        @METRICS.instrument("story.generate_story", lambda self, idea, **_: {"characters": len(idea)})
+        def generate_story(self, idea): ...
+    """
+
+    def __init__(self, window: float = 5 * 60, trace_dir: Optional[str] = None, history: int = 10000):
+        """
+        :param window: Seconds of observations kept for the rolling histograms and quantiles
+        :param trace_dir: Directory the spans are appended to as JSON lines, no trace files when None
+        :param history: Number of finished spans kept in memory
+        """
+        self.window = window
+        self.trace_dir = trace_dir
+        self.stages = {}
+        self.spans = deque(maxlen=history)
+        self.recorded = 0
+        self.collectors: List[Callable[[], List[Sample]]] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, attributes, _current_span.get())
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.outcome = "error"
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.finish()
+            _current_span.reset(token)
+            self.record(span.as_dict())
+
+    def instrument(self, name: str, attributes: Optional[Callable[..., dict]] = None):
+        """
+        Decorator timing every call of a function as a span.
+
+        :param name: Name of the stage
+        :param attributes: Called with the arguments of the function, returns the input sizes to record
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.span(name, **(attributes(*args, **kwargs) if attributes else {})):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, span: dict, trace: bool = True):
+        """
+        Add a finished span, also used to import the spans of jobs that ran in another process.
+
+        :param span: `Span.as_dict()` of the finished span
+        :param trace: Append the span to the trace file, False for imported spans the other process already traced
+        """
+        with self._lock:
+            stage = self.stages.get(span["name"])
+            if stage is None:
+                stage = self.stages[span["name"]] = StageMetrics(self.window)
+            stage.observe(span)
+            self.spans.append(span)
+            self.recorded += 1
+
+            if trace and self.trace_dir:
+                os.makedirs(self.trace_dir, exist_ok=True)
+                with open(os.path.join(self.trace_dir, f"trace-{os.getpid()}.jsonl"), "a") as f:
+                    f.write(json.dumps(span, default=str) + "\n")
+
+    def spans_since(self, recorded: int) -> List[dict]:
+        """Spans finished after `recorded` was read from `self.recorded`."""
+        with self._lock:
+            count = min(self.recorded - recorded, len(self.spans))
+            return list(self.spans)[len(self.spans) - count:] if count > 0 else []
+
+    def register_collector(self, collect: Callable[[], List[Sample]]):
+        """
+        :param collect: Called on every export, returns the current value of gauges and counters
+            kept outside the spans (e.g. queue depths)
+        """
+        self.collectors.append(collect)
+
+    def rolling_histogram(self, stage: str) -> dict:
+        with self._lock:
+            return self.stages[stage].rolling_histogram() if stage in self.stages else {}
+
+    def prometheus(self) -> str:
+        """Render all the metrics in the Prometheus text exposition format."""
+        lines = [
+            "# HELP reelify_stage_duration_seconds Duration of pipeline stages.",
+            "# TYPE reelify_stage_duration_seconds histogram",
+        ]
+        with self._lock:
+            stages = sorted(self.stages.items())
+            for name, stage in stages:
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in BUCKETS] + ["+Inf"], stage.bucket_counts):
+                    cumulative += count
+                    lines.append(f'reelify_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'reelify_stage_duration_seconds_sum{{stage="{name}"}} {stage.total}')
+                lines.append(f'reelify_stage_duration_seconds_count{{stage="{name}"}} {stage.count}')
+
+            lines += [
+                f"# HELP reelify_stage_recent_duration_seconds Duration of pipeline stages over the last {self.window:g} seconds.",
+                "# TYPE reelify_stage_recent_duration_seconds summary",
+            ]
+            for name, stage in stages:
+                for quantile, value in stage.rolling_quantiles().items():
+                    lines.append(f'reelify_stage_recent_duration_seconds{{stage="{name}",quantile="{quantile}"}} {value}')
+                # The window was trimmed with the quantiles, sum and count cover the same spans
+                recent = sum(duration for _, duration in stage.recent)
+                lines.append(f'reelify_stage_recent_duration_seconds_sum{{stage="{name}"}} {recent}')
+                lines.append(f'reelify_stage_recent_duration_seconds_count{{stage="{name}"}} {len(stage.recent)}')
+
+            lines += ["# HELP reelify_stage_calls_total Calls of pipeline stages by outcome.",
+                      "# TYPE reelify_stage_calls_total counter"]
+            for name, stage in stages:
+                for outcome, count in sorted(stage.outcomes.items()):
+                    lines.append(f'reelify_stage_calls_total{{stage="{name}",outcome="{outcome}"}} {count}')
+
+            lines += ["# HELP reelify_stage_input_total Sum of the input sizes (characters, images, audio seconds...) of pipeline stages.",
+                      "# TYPE reelify_stage_input_total counter"]
+            for name, stage in stages:
+                for input_name, total in sorted(stage.inputs.items()):
+                    lines.append(f'reelify_stage_input_total{{stage="{name}",input="{input_name}"}} {total}')
+
+        # Outside the lock, collectors take their own
+        described = set()
+        samples = sorted((sample for collect in list(self.collectors) for sample in collect()), key=lambda s: s.name)
+        for sample in samples:
+            if sample.name not in described:
+                described.add(sample.name)
+                lines += [f"# HELP {sample.name} {sample.help}", f"# TYPE {sample.name} {sample.type}"]
+            labels = ",".join(f'{label}="{value}"' for label, value in sorted(sample.labels.items()))
+            lines.append(f"{sample.name}{{{labels}}} {sample.value}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry shared by the whole process. Set REELIFY_TRACE_DIR to also write JSON trace files.
+METRICS = MetricsRegistry(trace_dir=os.environ.get("REELIFY_TRACE_DIR"))
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attributes):
+    """Add attributes to the span of the running stage, e.g. sizes only known halfway through."""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attributes)
+
+
+def mark_failed(error: BaseException):
+    """Record the running stage as failed when the error is handled instead of raised."""
+    span = _current_span.get()
+    if span is not None:
+        span.outcome = "error"
+        span.set(error=type(error).__name__)
+
+
+def serve_metrics(port: int, registry: MetricsRegistry = METRICS, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """Serve `registry.prometheus()` on http://host:port/metrics from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = registry.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,18 @@
+import re
+
+from instrumentation.metrics import MetricsRegistry
+
+
+def samples(text: str, metric: str) -> dict:
+    return {labels: float(value) for labels, value in re.findall(rf"^{metric}{{(.*?)}} (\S+)$", text, re.M)}
+
+
+def test_recent_summary_has_sum_and_count():
+    registry = MetricsRegistry()
+    for duration in (0.5, 1.5, 2.0):
+        registry.record({"name": "video.encode", "duration": duration, "outcome": "ok", "attributes": {}})
+
+    text = registry.prometheus()
+    assert samples(text, "reelify_stage_recent_duration_seconds_sum") == {'stage="video.encode"': 4.0}
+    assert samples(text, "reelify_stage_recent_duration_seconds_count") == {'stage="video.encode"': 3.0}
+    assert samples(text, "reelify_stage_duration_seconds_sum") == {'stage="video.encode"': 4.0}
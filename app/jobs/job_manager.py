@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import uuid
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional
+
+from instrumentation.metrics import METRICS
+from storage.asset_store import AssetStore
+from storage.lifecycle import StorageManager
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+# Seconds the result of a finished job is kept from eviction, for the page to show and download it
+RESULT_PIN_SECONDS = 60 * 60
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when cancellation was requested."""
+
+
+class JobContext:
+    """
+    Handle passed to every job function as its first argument. It is picklable, so jobs running
+    in the process pool report progress the same way as jobs on the thread pool: the job state
+    lives in a JSON file in the asset store and is only written by the worker while it runs.
+    """
+
+    def __init__(self, job_id: str, store_root: str):
+        self.job_id = job_id
+        self.store_root = store_root
+
+    @property
+    def store(self) -> AssetStore:
+        return AssetStore(self.store_root)
+
+    def read(self) -> Optional[dict]:
+        path = self.store.get("jobs", self.job_id, ".json")
+        if not path:
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def update(self, **fields):
+        record = self.read() or {"id": self.job_id}
+        record.update(fields, updated_at=time.time())
+        self.store.put_bytes("jobs", self.job_id, ".json", json.dumps(record).encode("utf-8"))
+
+    def report(self, progress: float, message: str = "", **extra):
+        """
+        :param progress: Fraction of the work done, between 0 and 1
+        :param message: Short description of the current step, shown in the UI
+        :param extra: Additional JSON-serialisable fields to publish (e.g. a preview path)
+
+        Raises JobCancelled if the job was cancelled, so long jobs stop at their next report.
+        """
+        self.update(progress=min(max(progress, 0.0), 1.0), message=message, **extra)
+        if self.cancelled():
+            raise JobCancelled()
+
+    def cancelled(self) -> bool:
+        return os.path.exists(self.store.path_for("jobs", self.job_id, ".cancel"))
+
+
+def run_job(context: JobContext, fn: Callable, args: tuple, kwargs: dict, export_spans: bool = False):
+    """
+    Run `fn` and record its outcome. Module level so it can be sent to the process pool.
+
+    :param export_spans: Save the timing spans of the job in its record, for jobs running in
+        another process whose metrics the submitting process would not see otherwise
+    """
+    if context.cancelled():
+        context.update(state=CANCELLED)
+        return
+
+    record = context.read() or {}
+    recorded = METRICS.recorded
+    started_at = time.time()
+    context.update(state=RUNNING, started_at=started_at)
+    try:
+        with METRICS.span(f"job.{record.get('kind', 'unknown')}",
+                          queued_seconds=started_at - record.get("created_at", started_at)):
+            result = fn(context, *args, **kwargs)
+    except JobCancelled:
+        fields = dict(state=CANCELLED, message="Cancelled")
+    except Exception as e:
+        logging.exception("Job %s failed", context.job_id)
+        fields = dict(state=FAILED, error=f"{type(e).__name__}: {e}")
+    else:
+        fields = dict(state=DONE, progress=1.0, result=result, finished_at=time.time())
+
+    if export_spans:
+        fields["spans"] = METRICS.spans_since(recorded)
+    context.update(**fields)
+
+
+class JobManager:
+    """
+    Runs the story → voice → video stages in the background so the Streamlit script thread
+    never blocks on them.
+
+    I/O-bound API calls run on a thread pool and CPU-bound encodes on a process pool. Each job
+    gets an id and a persisted state (queued/running/done/failed/cancelled) that pages poll,
+    so a job keeps running, and can be found again, after a browser refresh.
+    """
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, io_workers: int = 8,
+                 cpu_workers: Optional[int] = None, storage_manager: Optional[StorageManager] = None):
+        """
+        :param asset_store: Store the job states are persisted in
+        :param io_workers: Size of the thread pool for API calls
+        :param cpu_workers: Size of the process pool for encodes, defaults to the number of cores
+        :param storage_manager: Pins the assets jobs use so they aren't evicted under them
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.storage_manager = storage_manager or StorageManager(self.asset_store)
+        self.cpu_workers = cpu_workers or os.cpu_count() or 1
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="job-io")
+        self.cpu_pool = self._new_cpu_pool()
+        self.futures: Dict[str, object] = {}
+        self._recover()
+
+    def _new_cpu_pool(self) -> ProcessPoolExecutor:
+        # Never fork the (multi-threaded) Streamlit server
+        return ProcessPoolExecutor(max_workers=self.cpu_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def _recover(self):
+        # Jobs that were active when the previous process died will never finish
+        jobs_dir = self.asset_store.category_dir("jobs")
+        for file_name in os.listdir(jobs_dir):
+            if not file_name.endswith(".json") or file_name.startswith("."):
+                continue
+            context = self.context(file_name[:-len(".json")])
+            record = context.read()
+            if record and record.get("state") in ACTIVE_STATES:
+                context.update(state=FAILED, error="Interrupted by a restart")
+
+    def context(self, job_id: str) -> JobContext:
+        return JobContext(job_id, self.asset_store.root)
+
+    def submit(self, kind: str, fn: Callable, *args, cpu_bound: bool = False, **kwargs) -> str:
+        """
+        Queue `fn(job_context, *args, **kwargs)` and return the job id. The return value of
+        `fn` must be JSON-serialisable (e.g. a path); for CPU-bound jobs `fn` and its
+        arguments must also be picklable.
+
+        :param kind: Type of the job, e.g. "story", "audio", "video"
+        :param fn: Job function
+        :param cpu_bound: Run on the process pool instead of the thread pool
+        """
+        job_id = uuid.uuid4().hex
+        context = self.context(job_id)
+        # Input assets (audio, images...) stay in the store until the job is done
+        self.storage_manager.pin(job_id, self._paths(args, kwargs))
+        created_at = time.time()
+        context.update(id=job_id, kind=kind, state=QUEUED, progress=0.0, message="Queued",
+                       result=None, error=None, created_at=created_at)
+        self.asset_store.catalog.record_job(job_id, kind, QUEUED, created_at=created_at)
+
+        if cpu_bound:
+            try:
+                future = self.cpu_pool.submit(run_job, context, fn, args, kwargs, True)
+            except BrokenProcessPool:
+                self.cpu_pool = self._new_cpu_pool()
+                future = self.cpu_pool.submit(run_job, context, fn, args, kwargs, True)
+        else:
+            future = self.io_pool.submit(run_job, context, fn, args, kwargs)
+
+        self.futures[job_id] = future
+        future.add_done_callback(lambda f: self._on_done(job_id, f, cpu_bound))
+        return job_id
+
+    @staticmethod
+    def _paths(*values) -> List[str]:
+        """Existing file paths among job arguments, including inside lists and dicts."""
+        paths = []
+        for value in values:
+            if isinstance(value, (list, tuple, set)):
+                paths += JobManager._paths(*value)
+            elif isinstance(value, dict):
+                paths += JobManager._paths(*value.values())
+            elif isinstance(value, str) and len(value) < 4096 and os.path.isfile(value):
+                paths.append(value)
+        return paths
+
+    def _on_done(self, job_id: str, future, cpu_bound: bool = False):
+        self.futures.pop(job_id, None)
+        # Keep the result around for the page showing it, the inputs for the next stage
+        record = self.context(job_id).read() or {}
+        self.storage_manager.pin(job_id, self._paths(record.get("result")), ttl=RESULT_PIN_SECONDS)
+        if future.cancelled():
+            self.asset_store.catalog.record_job(job_id, state=CANCELLED, finished_at=time.time())
+            return
+        # run_job records its own failures, an exception here means the worker died (e.g. OOM)
+        error = future.exception()
+        if error is not None:
+            self.context(job_id).update(state=FAILED, error=f"{type(error).__name__}: {error}")
+        record = self.context(job_id).read() or {}
+        if cpu_bound:
+            # Bring the metrics of the worker process into the metrics of this one
+            for span in record.get("spans", []):
+                METRICS.record(span, trace=False)
+        self.asset_store.catalog.record_job(job_id, state=record.get("state"), result=record.get("result"),
+                                            error=record.get("error"), finished_at=record.get("finished_at", time.time()))
+
+    def status(self, job_id: str) -> Optional[dict]:
+        """Return the persisted state of a job, or None if the id is unknown."""
+        return self.context(job_id).read()
+
+    def cancel(self, job_id: str):
+        """Cancel a queued job right away; a running job stops at its next progress report."""
+        context = self.context(job_id)
+        future = self.futures.get(job_id)
+        if future is not None and future.cancel():
+            context.update(state=CANCELLED, message="Cancelled")
+            return
+        open(self.asset_store.path_for("jobs", job_id, ".cancel"), "w").close()
+
+    def shutdown(self):
+        self.io_pool.shutdown(wait=False, cancel_futures=True)
+        self.cpu_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,85 @@
+"""
+Job functions for the story → voice → video pipeline. Each takes the JobContext as its first
+argument and returns a JSON-serialisable result. The video tasks run in the process pool, so
+they only receive picklable arguments.
+"""
+import os
+from typing import TYPE_CHECKING, List, Optional
+
+from jobs.job_manager import JobContext
+from storage.asset_store import AssetStore
+from voice_generation.text_chunking import split_sentences
+
+if TYPE_CHECKING:
+    # The app imports the tasks on startup, the video modules load numpy and PIL
+    from video_generation.motion import MotionSettings
+
+
+def generate_story(job: JobContext, story_generator, idea: str, language: Optional[str] = None) -> str:
+    job.report(0.1, "Writing your story...")
+    return story_generator.generate_story(idea, language=language).lstrip()
+
+
+def _report_chunks(job: JobContext, text: str):
+    total = max(1, len(split_sentences(text)))
+
+    def on_chunk(index: int, chunk: bytes):
+        extra = {}
+        if index == 0:
+            # Publish the first sentence so the page can start playing it right away
+            extra["preview"] = job.store.put_bytes("audios", AssetStore.hash_key("preview", job.job_id), ".mp3", chunk)
+        job.report((index + 1) / total, f"Synthesized {index + 1} of {total} sentences", **extra)
+
+    return on_chunk
+
+
+def generate_voice(job: JobContext, voice_generator, text: str, voice: str, model: str) -> str:
+    job.report(0.0, "Generating your audio...")
+    return voice_generator.generate_story_audio(text, voice, model, streaming=True,
+                                                on_chunk=_report_chunks(job, text))
+
+
+def generate_voice_clone(job: JobContext, voice_generator, text: str, name: str, description: str,
+                         files: List[str], remove_files: bool = False) -> str:
+    """
+    :param remove_files: Delete the sample files once the voice is cloned (e.g. uploaded temp files)
+    """
+    job.report(0.1, "Creating the story audio with custom voice...")
+    try:
+        return voice_generator.generate_story_with_new_voice(text=text, name=name, description=description, files=files)
+    finally:
+        if remove_files:
+            for file in files:
+                os.remove(file)
+
+
+def _report_render(job: JobContext, message: str):
+    """Progress callback of the renders, raises JobCancelled from inside the render once the job is cancelled."""
+    job.report(0.1, message)
+
+    def progress(fraction: float):
+        job.report(0.1 + 0.9 * fraction, message)
+
+    return progress
+
+
+def create_video(job: JobContext, video_generator, image_files: List[str], audio_file_path: str,
+                 video_size: Optional[tuple] = None, motion: Optional["MotionSettings"] = None,
+                 captions: Optional[str] = None, preview: bool = False) -> str:
+    """
+    :param video_size: Frame size of the video, defaults to Frames.INSTAGRAM_REEL
+    """
+    # Imported on first use, the video generator is slow to import and the app starts without it
+    from video_generation.video_generator import Frames
+    progress = _report_render(job, "Rendering a quick preview..." if preview else "Generating your video...")
+    video_size = video_size or Frames.INSTAGRAM_REEL
+    return video_generator.create_video(image_files, audio_file_path, video_size, motion=motion, captions=captions,
+                                        preview=preview, progress=progress)
+
+
+def generate_video_static(job: JobContext, video_generator, audio_file_path: str,
+                          static_image: Optional[str] = None, captions: Optional[str] = None,
+                          preview: bool = False) -> str:
+    progress = _report_render(job, "Rendering a quick preview..." if preview else "Generating your video...")
+    return video_generator.generate_video_static(audio_file_path, static_image=static_image, captions=captions,
+                                                 preview=preview, progress=progress)
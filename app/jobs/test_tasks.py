@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_audio, make_images
+from jobs import tasks
+from jobs.job_manager import JobCancelled, JobContext
+from storage.asset_store import AssetStore
+from video_generation.video_generator import VideoGenerator
+
+
+class RecordingContext(JobContext):
+    """JobContext remembering its reports, which cancels its job after `cancel_after` of them."""
+
+    def __init__(self, job_id: str, store_root: str, cancel_after: int = 0):
+        super().__init__(job_id, store_root)
+        self.cancel_after = cancel_after
+        self.reports = []
+
+    def report(self, progress: float, message: str = "", **extra):
+        self.reports.append(progress)
+        if len(self.reports) == self.cancel_after:
+            open(self.store.path_for("jobs", self.job_id, ".cancel"), "w").close()
+        super().report(progress, message, **extra)
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    audio = make_audio(str(tmp_path / "story.mp3"), 4.0)
+    images = make_images(str(tmp_path / "images"), 3, size=(320, 240))
+    return VideoGenerator(asset_store=AssetStore(str(tmp_path / "store"))), audio, images
+
+
+def test_render_reports_progress_until_done(tmp_path, inputs):
+    generator, audio, images = inputs
+    job = RecordingContext("render", str(tmp_path / "store"))
+
+    video = tasks.create_video(job, generator, images, audio, video_size=(240, 320))
+
+    assert os.path.exists(video)
+    # Fitted images, every segment and the join, at least
+    assert len(job.reports) >= 1 + len(images) + 1
+    assert job.reports == sorted(job.reports)
+    assert job.reports[-1] == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("static", [False, True])
+def test_cancelled_render_stops_without_a_video(tmp_path, inputs, static):
+    generator, audio, images = inputs
+    job = RecordingContext("render", str(tmp_path / "store"), cancel_after=2)
+
+    with pytest.raises(JobCancelled):
+        if static:
+            tasks.generate_video_static(job, generator, audio, static_image=images[0], captions="Still rendering.")
+        else:
+            tasks.create_video(job, generator, images, audio, video_size=(240, 320))
+
+    assert len(job.reports) == 2
+    assert not os.path.exists(tmp_path / "store" / "videos") or not os.listdir(tmp_path / "store" / "videos")
@@ -0,0 +1,404 @@
+"""
+Scheduling of the calls to the external APIs (OpenAI completions and images, ElevenLabs).
+
+    with outbound_priority(BATCH):
+        SCHEDULER.call("dalle", openai.Image.create, prompt=prompt, n=4, units=4)
+"""
+import os
+import re
+import sys
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+
+from environment import load_environment
+from instrumentation.metrics import METRICS, MetricsRegistry, Sample
+
+# Requests a user is waiting on go ahead of batch requests (e.g. bulk story generation)
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+_priority = contextvars.ContextVar("outbound_priority", default=INTERACTIVE)
+
+# Seconds between checks of a waiting async call, which isn't woken up by releases
+ASYNC_POLL = 0.05
+
+# HTTP statuses worth retrying: throttling, timeouts and server errors
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+# ElevenLabs reports throttling in the body of its errors. quota_exceeded is not among them,
+# the quota doesn't come back by waiting
+ELEVENLABS_BUSY = {"too_many_concurrent_requests", "system_busy"}
+
+
+@dataclass(frozen=True)
+class ProviderLimits:
+    requests_per_minute: float = 0
+    # Characters for ElevenLabs, tokens for completions, images for DALL·E
+    units_per_minute: float = 0
+    max_concurrency: int = 4
+    # Seconds' worth of requests and units that may be sent at once. Services enforce their per
+    # minute limits over shorter periods, a full minute sent at once would be throttled
+    burst_seconds: float = 10.0
+    max_retries: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+
+
+# Limits of the lowest paid tiers, 0 is unlimited. Raise them with OUTBOUND_LIMITS as the account grows
+DEFAULT_LIMITS = {
+    "openai": ProviderLimits(requests_per_minute=3500, units_per_minute=90000, max_concurrency=8),
+    "dalle": ProviderLimits(requests_per_minute=50, units_per_minute=50, max_concurrency=4),
+    "elevenlabs": ProviderLimits(max_concurrency=3),
+}
+LIMIT_FIELDS = {"rpm": "requests_per_minute", "upm": "units_per_minute", "concurrency": "max_concurrency",
+                "burst": "burst_seconds", "retries": "max_retries"}
+
+
+def parse_limits(text: str) -> Dict[str, ProviderLimits]:
+    """
+    :param text: Comma separated provider.limit=value, the limits being rpm (requests per minute),
+        upm (units per minute), concurrency, burst (seconds) and retries, e.g. "dalle.rpm=100,elevenlabs.concurrency=5"
+    :return: Limits per provider, over `DEFAULT_LIMITS`
+    """
+    limits = dict(DEFAULT_LIMITS)
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        match = re.fullmatch(r"([\w-]+)\.(\w+)\s*=\s*(\d+(?:\.\d+)?)", item)
+        if not match or match.group(2) not in LIMIT_FIELDS:
+            raise ValueError(f"Invalid outbound limit {item!r}, expected e.g. dalle.rpm=100")
+        provider, name, value = match.groups()
+        field = LIMIT_FIELDS[name]
+        value = int(float(value)) if field in ("max_concurrency", "max_retries") else float(value)
+        limits[provider] = replace(limits.get(provider, ProviderLimits()), **{field: value})
+    return limits
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+@contextmanager
+def outbound_priority(priority: int):
+    """Schedule the API calls made in this block (and the threads and tasks it copies its context to) at `priority`."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _openai_error(error: BaseException, *names: str) -> bool:
+    # openai is left to the callers to import (it is slow to), an error can't come from it before
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, tuple(getattr(openai.error, name) for name in names))
+
+
+def _status(error: BaseException) -> Tuple[Optional[int], dict]:
+    if _openai_error(error, "OpenAIError"):
+        return error.http_status, error.headers or {}
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        return response.status_code, response.headers
+    return None, {}
+
+
+def _elevenlabs_busy(error: BaseException) -> bool:
+    # Status of the error body, see voice_generation.tts_backends.ElevenLabsHTTPError
+    status = getattr(error, "status", None)
+    return isinstance(status, str) and status in ELEVENLABS_BUSY
+
+
+def is_rate_limited(error: BaseException) -> bool:
+    if _elevenlabs_busy(error):
+        return True
+    return _status(error)[0] == 429
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """
+    :param error: Error raised by an API call
+    :return: Seconds the service asks to wait before retrying (0 if it doesn't say), None if the
+        call must not be retried
+    """
+    if _openai_error(error, "Timeout", "APIConnectionError", "ServiceUnavailableError") or \
+            isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return 0.0
+    if _elevenlabs_busy(error):
+        return 0.0
+    status, headers = _status(error)
+    if status not in RETRY_STATUSES:
+        return None
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value else 0.0
+    except ValueError:
+        # An HTTP date, rare enough to fall back to the backoff
+        return 0.0
+
+
+class TokenBucket:
+    """
+    Refills continuously at `per_minute` and holds up to `burst_seconds` of it. A request larger
+    than the bucket waits for a full bucket and leaves it in debt, so it is delayed but never stuck.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 60.0, now: Optional[float] = None):
+        """
+        :param per_minute: Refill rate, 0 for no limit
+        :param burst_seconds: Seconds of refill the bucket holds
+        """
+        self.per_minute = per_minute
+        self.capacity = per_minute * burst_seconds / 60
+        self.level = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` can be taken."""
+        if not self.per_minute:
+            return 0.0
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.per_minute)
+
+    def take(self, amount: float, now: float):
+        if self.per_minute:
+            self._refill(now)
+            self.level -= amount
+
+
+class ProviderQueue:
+    """
+    Admits the calls to one provider in priority order (first come first served within a
+    priority) once a concurrency slot is free and both token buckets hold enough.
+    """
+
+    def __init__(self, name: str, limits: ProviderLimits):
+        self.name = name
+        self._cond = threading.Condition()
+        self.set_limits(limits)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self._waiting: List[Tuple[int, int]] = []
+        self._tickets = itertools.count()
+
+    def set_limits(self, limits: ProviderLimits):
+        with self._cond:
+            self.limits = limits
+            self.requests = TokenBucket(limits.requests_per_minute, limits.burst_seconds)
+            self.units = TokenBucket(limits.units_per_minute, limits.burst_seconds)
+            self._cond.notify_all()
+
+    def _delay(self, ticket: Tuple[int, int], units: float) -> float:
+        """Seconds `ticket` should wait before checking again, 0 when it is admitted. Called with the lock held."""
+        if self._waiting[0] != ticket or self.in_flight >= self.limits.max_concurrency:
+            # Woken up when a call is released or the tickets ahead are admitted
+            return 1.0
+        now = time.monotonic()
+        delay = max(self.paused_until - now, self.requests.delay(1, now), self.units.delay(units, now))
+        if delay > 0:
+            return delay
+        heapq.heappop(self._waiting)
+        self.requests.take(1, now)
+        self.units.take(units, now)
+        self.in_flight += 1
+        # The next ticket may be admitted as well
+        self._cond.notify_all()
+        return 0.0
+
+    def _enqueue(self, priority: int) -> Tuple[int, int]:
+        ticket = (priority, next(self._tickets))
+        heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def _withdraw(self, ticket: Tuple[int, int]):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
+            self._cond.notify_all()
+
+    def acquire(self, units: float, priority: int):
+        """Block until the call is admitted, it must be followed by `release`."""
+        with self._cond:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    delay = self._delay(ticket, units)
+                    if not delay:
+                        return
+                    self._cond.wait(delay)
+            except BaseException:
+                self._withdraw(ticket)
+                raise
+
+    async def aacquire(self, units: float, priority: int):
+        """`acquire` without blocking the event loop."""
+        with self._cond:
+            ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    delay = self._delay(ticket, units)
+                if not delay:
+                    return
+                await asyncio.sleep(min(delay, ASYNC_POLL))
+        except BaseException:
+            with self._cond:
+                self._withdraw(ticket)
+            raise
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def retrying(self, delay: float, rate_limited: bool):
+        """Count a retry in `delay` seconds. A throttled call holds back every call to the provider for as long."""
+        with self._cond:
+            self.retries += 1
+            if rate_limited:
+                self.rate_limited += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def depth(self) -> Dict[int, int]:
+        """Number of waiting calls by priority."""
+        with self._cond:
+            return {priority: sum(1 for ticket in self._waiting if ticket[0] == priority) for priority in PRIORITY_NAMES}
+
+
+class OutboundScheduler:
+    """
+    Shared scheduler of the calls to the external APIs, so that concurrent generators stay under
+    the rate limits of the account instead of collecting 429s.
+
+    Every provider has a requests per minute and a units (characters, tokens, images) per minute
+    token bucket, a concurrency limit and a priority queue: interactive calls, the default, are
+    admitted before batch calls (see `outbound_priority`). Calls failing with a throttling or
+    transient error are retried with jittered exponential backoff, at least as late as the
+    service's Retry-After; a 429 also pauses the whole provider for that long. Limits hold
+    within a process, worker processes have their own scheduler.
+
+    Time spent waiting is recorded as the `outbound.<provider>.wait` stage and the queue depth
+    and calls in flight are exported as gauges with the other metrics.
+
+    Usage:
+        response = SCHEDULER.call("openai", llm.generate, prompts, units=estimated_tokens)
+    """
+
+    def __init__(self, limits: Optional[Dict[str, ProviderLimits]] = None, registry: MetricsRegistry = METRICS):
+        """
+        :param limits: Limits per provider, providers not listed get `ProviderLimits()`
+        :param registry: Metrics the waits, retries and queue gauges are recorded in
+        """
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.registry = registry
+        self._providers: Dict[str, ProviderQueue] = {}
+        self._lock = threading.Lock()
+        registry.register_collector(self._collect)
+
+    def provider(self, name: str) -> ProviderQueue:
+        with self._lock:
+            if name not in self._providers:
+                self._providers[name] = ProviderQueue(name, self.limits.get(name, ProviderLimits()))
+            return self._providers[name]
+
+    def set_limits(self, provider: str, limits: ProviderLimits):
+        """Change the limits of a provider, e.g. after the account moved to another tier. Waiting calls keep their place."""
+        with self._lock:
+            self.limits[provider] = limits
+            queue = self._providers.get(provider)
+        if queue is not None:
+            queue.set_limits(limits)
+
+    def _backoff(self, queue: ProviderQueue, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to wait before retrying, None if the error is final."""
+        server_delay = retry_after(error)
+        if server_delay is None or attempt >= queue.limits.max_retries:
+            return None
+        # Full jitter, so calls throttled together don't come back together
+        delay = max(server_delay, random.uniform(0, min(queue.limits.max_delay, queue.limits.base_delay * 2 ** attempt)))
+        queue.retrying(delay, is_rate_limited(error))
+        return delay
+
+    def call(self, provider: str, fn: Callable, *args, units: float = 1, priority: Optional[int] = None, **kwargs):
+        """
+        Call `fn(*args, **kwargs)` once the provider admits it, retrying throttled and transient failures.
+
+        :param provider: Name of the provider, e.g. "openai", "dalle" or "elevenlabs"
+        :param units: Units of the call, counted against the units per minute
+        :param priority: INTERACTIVE or BATCH, defaults to `current_priority()`
+        """
+        queue = self.provider(provider)
+        priority = current_priority() if priority is None else priority
+        for attempt in itertools.count():
+            with self.registry.span(f"outbound.{provider}.wait", priority=PRIORITY_NAMES[priority], attempt=attempt):
+                queue.acquire(units, priority)
+            try:
+                with self.registry.span(f"outbound.{provider}", units=units, attempt=attempt):
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._backoff(queue, e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                queue.release()
+            time.sleep(delay)
+
+    async def acall(self, provider: str, fn: Callable, *args, units: float = 1, priority: Optional[int] = None, **kwargs):
+        """`call` for a coroutine function."""
+        queue = self.provider(provider)
+        priority = current_priority() if priority is None else priority
+        for attempt in itertools.count():
+            with self.registry.span(f"outbound.{provider}.wait", priority=PRIORITY_NAMES[priority], attempt=attempt):
+                await queue.aacquire(units, priority)
+            try:
+                with self.registry.span(f"outbound.{provider}", units=units, attempt=attempt):
+                    return await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._backoff(queue, e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                queue.release()
+            await asyncio.sleep(delay)
+
+    def stats(self) -> Dict[str, dict]:
+        """Queue depth by priority, calls in flight, retries and 429s of every provider used so far."""
+        with self._lock:
+            queues = list(self._providers.values())
+        return {queue.name: {"waiting": {PRIORITY_NAMES[priority]: count for priority, count in queue.depth().items()},
+                             "in_flight": queue.in_flight, "retries": queue.retries,
+                             "rate_limited": queue.rate_limited} for queue in queues}
+
+    def _collect(self) -> List[Sample]:
+        samples = []
+        for provider, stats in self.stats().items():
+            for priority, count in stats["waiting"].items():
+                samples.append(Sample("reelify_outbound_queue_depth", "gauge", "Calls waiting for an external API.",
+                                      {"provider": provider, "priority": priority}, count))
+            samples.append(Sample("reelify_outbound_in_flight", "gauge", "Calls in flight to an external API.",
+                                  {"provider": provider}, stats["in_flight"]))
+            samples.append(Sample("reelify_outbound_retries_total", "counter", "Retried calls to external APIs.",
+                                  {"provider": provider}, stats["retries"]))
+            samples.append(Sample("reelify_outbound_rate_limited_total", "counter", "Calls throttled by external APIs.",
+                                  {"provider": provider}, stats["rate_limited"]))
+        return samples
+
+
+# Scheduler shared by the whole process. Set OUTBOUND_LIMITS to override the limits, e.g. "dalle.rpm=100"
+load_environment()
+SCHEDULER = OutboundScheduler(parse_limits(os.environ.get("OUTBOUND_LIMITS", "")))
@@ -0,0 +1,74 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.fakes import FakeImageServer
+from instrumentation.metrics import MetricsRegistry
+from outbound.scheduler import BATCH, INTERACTIVE, PRIORITY_NAMES, OutboundScheduler, ProviderLimits, outbound_priority
+from storage.asset_store import AssetStore
+from video_generation.image_generation import DalleImageGenerator
+
+SIZE = (64, 64)
+
+
+def image_generator(root, server: FakeImageServer, limits: ProviderLimits):
+    scheduler = OutboundScheduler({"dalle": limits}, registry=MetricsRegistry())
+    generator = DalleImageGenerator("fake-key", AssetStore(str(root)), api_base=server.api_base, max_concurrency=8,
+                                    scheduler=scheduler)
+    return scheduler, generator
+
+
+def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_throttled_requests_wait_for_retry_after(tmp_path):
+    # One request per second, so of three sent together two are answered 429 with a Retry-After
+    with FakeImageServer(image_size=64, requests_per_minute=60, window=1.0) as server:
+        scheduler, generator = image_generator(tmp_path, server, ProviderLimits(max_retries=10, base_delay=0.01))
+        start = time.monotonic()
+        with ThreadPoolExecutor(3) as pool:
+            images = list(pool.map(lambda index: generator.generate(f"prompt {index}", size=SIZE), range(3)))
+        elapsed = time.monotonic() - start
+
+    stats = scheduler.stats()["dalle"]
+    assert [len(batch) for batch in images] == [1, 1, 1]
+    assert server.rate_limited >= 2
+    assert stats["rate_limited"] == stats["retries"] == server.rate_limited
+    # The jittered backoff alone would retry within milliseconds, Retry-After spaces them a second apart
+    assert elapsed >= 1.9
+    assert server.rate_limited <= 4
+
+
+def test_interactive_requests_go_ahead_of_queued_batch(tmp_path):
+    with FakeImageServer(latency=0.05, image_size=64) as server:
+        scheduler, generator = image_generator(tmp_path, server, ProviderLimits(max_concurrency=1))
+        queue = scheduler.provider("dalle")
+        finished = []
+        lock = threading.Lock()
+
+        def request(priority: int):
+            with outbound_priority(priority):
+                generator.generate(PRIORITY_NAMES[priority], size=SIZE)
+            with lock:
+                finished.append(PRIORITY_NAMES[priority])
+
+        # Hold the only slot while the batch and then the interactive requests queue up
+        queue.acquire(0, INTERACTIVE)
+        threads = [threading.Thread(target=request, args=(BATCH,)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        wait_for(lambda: queue.depth()[BATCH] == 3)
+        threads += [threading.Thread(target=request, args=(INTERACTIVE,)) for _ in range(2)]
+        for thread in threads[3:]:
+            thread.start()
+        wait_for(lambda: queue.depth()[INTERACTIVE] == 2)
+        queue.release()
+        for thread in threads:
+            thread.join()
+
+    assert finished == ["interactive", "interactive", "batch", "batch", "batch"]
+    assert server.rate_limited == 0
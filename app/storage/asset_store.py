@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from typing import Optional
+
+# If the app is ran in docker, the db folder is copied into the app folder
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+storage_dir = "app/db/storage" if os.path.exists(os.path.join(root_dir, "app/db/storage")) else "db/storage"
+STORAGE_ROOT = os.path.join(root_dir, storage_dir)
+
+
+class AssetStore:
+    """
+    Content-addressed store for generated assets (audio, video, images, subtitles).
+
+    Every asset is saved as `<storage_root>/<category>/<key><ext>` where `key` is a hash of
+    the inputs that produced it, so identical requests resolve to the same file and different
+    sessions never overwrite each other.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, root: str = STORAGE_ROOT, catalog=None):
+        """
+        :param root: Directory of the store
+        :param catalog: Index of the assets, see `storage.catalog.AssetCatalog`, defaults to the one of `root`
+        """
+        self.root = root
+        self._catalog = catalog
+
+    @property
+    def catalog(self):
+        if self._catalog is None:
+            # Imported on first use, SQLAlchemy is slow to import and the app starts without it
+            from storage.catalog import default_catalog
+            self._catalog = default_catalog(self.root)
+        return self._catalog
+
+    @staticmethod
+    def hash_key(*parts) -> str:
+        """Hash arbitrary JSON-serialisable inputs into a stable key.
+
+        Args:
+            parts: Values describing the inputs of an asset (text, voice, sizes, settings...).
+
+        Returns:
+            Hex sha256 digest of the inputs.
+        """
+        payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def hash_file(cls, file_path: str) -> str:
+        """Hash the contents of a file in chunks so large media is never fully loaded.
+
+        Args:
+            file_path: Path of the file to hash.
+
+        Returns:
+            Hex sha256 digest of the file contents.
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def category_dir(self, category: str) -> str:
+        path = os.path.join(self.root, category)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def path_for(self, category: str, key: str, ext: str) -> str:
+        return os.path.join(self.category_dir(category), f"{key}{ext}")
+
+    def get(self, category: str, key: str, ext: str) -> Optional[str]:
+        """Return the path of a stored asset, or None if it has not been produced yet.
+
+        A found asset is marked as used, see `touch`.
+        """
+        path = self.path_for(category, key, ext)
+        return path if self.touch(path) else None
+
+    @staticmethod
+    def touch(path: str) -> bool:
+        """Mark an asset as recently used, the storage manager evicts the least recently used first.
+
+        Like the caches, the file mtime is the access time: atime is often not updated (noatime, relatime).
+
+        Returns:
+            Whether the asset exists.
+        """
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        except PermissionError:
+            # Written by another user of the shared volume, it still exists
+            pass
+        return True
+
+    @contextmanager
+    def atomic_path(self, category: str, key: str, ext: str):
+        """Yield a temporary path to write an asset to; it is renamed into place on success.
+
+        The temporary file lives in the same directory as the final asset so the rename is
+        atomic, and it keeps the extension so tools such as ffmpeg can infer the format.
+        """
+        final_path = self.path_for(category, key, ext)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{key}.", suffix=f".tmp{ext}", dir=os.path.dirname(final_path))
+        os.close(fd)
+        try:
+            yield tmp_path
+            # mkstemp creates the file private to the owner, assets are shared with other services
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, final_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def put_bytes(self, category: str, key: str, ext: str, data: bytes) -> str:
+        """Atomically write `data` as an asset and return its final path."""
+        with self.atomic_path(category, key, ext) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+        return self.path_for(category, key, ext)
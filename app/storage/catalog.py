@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import (Column, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text, create_engine,
+                        event, func, make_url, select)
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import StaticPool
+
+from storage.asset_store import STORAGE_ROOT, AssetStore
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# Keys are the content keys the assets are stored under (the file name without its extension)
+stories = Table(
+    "stories", metadata,
+    Column("id", String(64), primary_key=True),
+    Column("text", Text, nullable=False),
+    Column("created_at", Float, nullable=False, index=True),
+)
+
+audio = Table(
+    "audio", metadata,
+    Column("key", String(64), primary_key=True),
+    Column("path", Text, nullable=False),
+    Column("story_id", String(64), ForeignKey("stories.id"), index=True),
+    Column("voice", String(255)),
+    Column("model", String(255)),
+    Column("duration", Float),
+    Column("created_at", Float, nullable=False),
+)
+
+images = Table(
+    "images", metadata,
+    Column("key", String(64), primary_key=True),
+    Column("path", Text, nullable=False),
+    Column("source", String(32), nullable=False),  # "upload", "dalle"...
+    Column("prompt", Text),
+    Column("created_at", Float, nullable=False),
+)
+
+videos = Table(
+    "videos", metadata,
+    Column("key", String(64), primary_key=True),
+    Column("path", Text, nullable=False),
+    Column("kind", String(32), nullable=False),  # "slideshow", "static"
+    Column("audio_key", String(64), index=True),
+    Column("width", Integer),
+    Column("height", Integer),
+    Column("settings", Text),
+    Column("created_at", Float, nullable=False, index=True),
+)
+
+# Which images a video was rendered from, in order
+video_images = Table(
+    "video_images", metadata,
+    Column("video_key", String(64), ForeignKey("videos.key", ondelete="CASCADE"), primary_key=True),
+    Column("position", Integer, primary_key=True),
+    Column("image_key", String(64), nullable=False),
+    Index("ix_video_images_image_key", "image_key"),
+)
+
+jobs = Table(
+    "jobs", metadata,
+    Column("id", String(32), primary_key=True),
+    Column("kind", String(32), nullable=False),
+    Column("state", String(16), nullable=False),
+    Column("result", Text),
+    Column("error", Text),
+    Column("created_at", Float, nullable=False),
+    Column("finished_at", Float),
+    Index("ix_jobs_state_created_at", "state", "created_at"),
+)
+
+
+def sqlite_url(root: str) -> str:
+    return f"sqlite:///{os.path.join(root, 'catalog.sqlite3')}"
+
+
+def display_url(url: str) -> str:
+    """`url` without its password, for logs."""
+    try:
+        return make_url(url).render_as_string(hide_password=True)
+    except SQLAlchemyError:
+        return "<invalid database URL>"
+
+
+def asset_key(path: str) -> str:
+    """Key of an asset from its path, e.g. <root>/audios/<key>.mp3."""
+    return os.path.basename(path).split(".", 1)[0]
+
+
+def _row(row) -> dict:
+    return dict(row._mapping)
+
+
+class AssetCatalog:
+    """
+    Index of the stories, audio, images, videos and jobs in the asset store, and of which
+    assets each video was made from.
+
+    The files stay the source of truth: the catalog answers questions the store can only answer
+    by scanning directories ("all the videos of this story", "the renders that used this
+    image") with indexed queries, and only returns assets whose file still exists. Writes are
+    upserts, so recording an asset again (e.g. a cached render) is harmless, and a failed write
+    is logged rather than failing the generation it describes.
+
+    Postgres (the db service, $DATABASE_URL) in Docker and a SQLite file in the storage
+    root elsewhere, or "sqlite://" for a throwaway in-memory catalog. `open_catalog` falls back
+    to the SQLite file, then to an in-memory catalog, when the database can't be opened
+    (unreachable, missing driver...).
+
+    Every `AssetStore` has one, `asset_store.catalog`, which the generators record into.
+
+    Usage:
+        catalog = AssetCatalog("sqlite://")
+        catalog.record_video(key, path, "slideshow", audio_path, image_paths, (1080, 1920))
+        catalog.videos_for_story(AssetCatalog.story_id(text))
+    """
+
+    def __init__(self, url: Optional[str] = None, root: str = STORAGE_ROOT, pool_size: int = 5, max_overflow: int = 10):
+        """
+        :param url: SQLAlchemy database URL, defaults to $DATABASE_URL, then a SQLite file in `root`
+        :param root: Root of the asset store, for the SQLite file
+        :param pool_size: Connections kept open (Postgres)
+        :param max_overflow: Connections opened on top of `pool_size` under load (Postgres)
+        :raises SQLAlchemyError: If the database is unreachable
+        :raises ImportError: If its driver isn't installed
+        """
+        self.url = url or os.environ.get("DATABASE_URL") or sqlite_url(root)
+        if self.url.startswith("sqlite"):
+            if self.url in ("sqlite://", "sqlite:///:memory:"):
+                # One connection shared by every thread, or each would see its own empty database
+                self.engine = create_engine(self.url, poolclass=StaticPool, connect_args={"check_same_thread": False})
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.url[len("sqlite:///"):])), exist_ok=True)
+                self.engine = create_engine(self.url, connect_args={"timeout": 30, "check_same_thread": False})
+            event.listen(self.engine, "connect", self._configure_sqlite)
+        else:
+            # Pooled, and checked before use so a restarted db service doesn't fail the next query
+            self.engine = create_engine(self.url, pool_size=pool_size, max_overflow=max_overflow, pool_pre_ping=True)
+        try:
+            metadata.create_all(self.engine)
+        except SQLAlchemyError:
+            self.engine.dispose()
+            raise
+
+    def __reduce__(self):
+        # Sent to the encode workers with the generators, each process opens its own pool
+        return open_catalog, (self.url,)
+
+    @staticmethod
+    def _configure_sqlite(connection, _):
+        cursor = connection.cursor()
+        # Readers don't block the writer, the app and the encode workers write concurrently
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+    def _insert(self, table: Table):
+        if self.engine.dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+        return insert(table)
+
+    def _upsert(self, connection, table: Table, rows: List[dict], keep: Iterable[str] = ("created_at",)):
+        if not rows:
+            return
+        statement = self._insert(table)
+        keys = [column.name for column in table.primary_key]
+        updates = {name: statement.excluded[name] for name in rows[0] if name not in keys and name not in keep}
+        if updates:
+            statement = statement.on_conflict_do_update(index_elements=keys, set_=updates)
+        else:
+            statement = statement.on_conflict_do_nothing(index_elements=keys)
+        connection.execute(statement, rows)
+
+    def _write(self, action: str, fn):
+        try:
+            with self.engine.begin() as connection:
+                fn(connection)
+        except Exception:
+            # Whatever the database does, the asset it describes is already stored
+            logger.exception("Could not record %s in the catalog", action)
+
+    @staticmethod
+    def story_id(text: str) -> str:
+        return AssetStore.hash_key("story", text)
+
+    def record_story(self, text: str) -> str:
+        """:return: Id of the story"""
+        story_id = self.story_id(text)
+        self._write("a story", lambda connection: self._upsert(
+            connection, stories, [dict(id=story_id, text=text, created_at=time.time())]))
+        return story_id
+
+    def record_audio(self, path: str, text: Optional[str] = None, voice: Optional[str] = None,
+                     model: Optional[str] = None, duration: Optional[float] = None):
+        """
+        :param path: Path of the story audio
+        :param text: Story it reads
+        """
+        now = time.time()
+
+        def write(connection):
+            story_id = None
+            if text is not None:
+                story_id = self.story_id(text)
+                self._upsert(connection, stories, [dict(id=story_id, text=text, created_at=now)])
+            self._upsert(connection, audio, [dict(key=asset_key(path), path=path, story_id=story_id, voice=voice,
+                                                  model=model, duration=duration, created_at=now)])
+
+        self._write("an audio", write)
+
+    def record_image(self, path: str, source: str, prompt: Optional[str] = None):
+        self._write("an image", lambda connection: self._upsert(
+            connection, images, [dict(key=asset_key(path), path=path, source=source, prompt=prompt,
+                                      created_at=time.time())]))
+
+    def record_video(self, key: str, path: str, kind: str, audio_path: str, image_paths: List[str],
+                     size: Optional[tuple] = None, settings: Optional[dict] = None):
+        """
+        :param key: Key of the video
+        :param path: Path of the video
+        :param kind: Type of render (e.g. "slideshow", "static")
+        :param audio_path: Path of the story audio it was rendered from
+        :param image_paths: Paths of the images it was rendered from, in order
+        :param size: (width, height) of the video
+        :param settings: Settings of the render
+        """
+        width, height = size or (None, None)
+
+        def write(connection):
+            self._upsert(connection, videos, [dict(
+                key=key, path=path, kind=kind, audio_key=asset_key(audio_path), width=width, height=height,
+                settings=json.dumps(settings, sort_keys=True, default=str), created_at=time.time())])
+            self._upsert(connection, video_images, [dict(video_key=key, position=position, image_key=asset_key(image))
+                                                    for position, image in enumerate(image_paths)])
+
+        self._write("a video", write)
+
+    def record_job(self, job_id: str, kind: Optional[str] = None, state: Optional[str] = None, **fields):
+        """Record a job or update its state, see `JobManager`."""
+        row = dict(id=job_id, **{name: value for name, value in dict(kind=kind, state=state, **fields).items()
+                                 if value is not None})
+        if "result" in row and not isinstance(row["result"], str):
+            row["result"] = json.dumps(row["result"])
+        row.setdefault("created_at", time.time())
+
+        def write(connection):
+            exists = connection.execute(select(jobs.c.id).where(jobs.c.id == job_id)).first()
+            if exists:
+                connection.execute(jobs.update().where(jobs.c.id == job_id).values(
+                    {name: value for name, value in row.items() if name not in ("id", "created_at")}))
+            else:
+                connection.execute(jobs.insert().values(row))
+
+        self._write("a job", write)
+
+    def _existing(self, statement) -> List[dict]:
+        with self.engine.connect() as connection:
+            rows = [_row(row) for row in connection.execute(statement)]
+        # Evicted assets stay in the catalog until they are produced again
+        return [row for row in rows if os.path.exists(row["path"])]
+
+    def find_video(self, key: str) -> Optional[dict]:
+        """The video rendered under `key`, None if there is none or it was evicted."""
+        rows = self._existing(select(videos).where(videos.c.key == key))
+        return rows[0] if rows else None
+
+    def videos_for_story(self, story_id: str) -> List[dict]:
+        """Every video of a story, in any voice or format, newest first."""
+        return self._existing(select(videos).join(audio, videos.c.audio_key == audio.c.key)
+                              .where(audio.c.story_id == story_id).order_by(videos.c.created_at.desc()))
+
+    def videos_with_image(self, image_path: str) -> List[dict]:
+        """Every video an image was used in, newest first."""
+        return self._existing(select(videos).join(video_images, video_images.c.video_key == videos.c.key)
+                              .where(video_images.c.image_key == asset_key(image_path)).distinct()
+                              .order_by(videos.c.created_at.desc()))
+
+    def audio_for_story(self, story_id: str) -> List[dict]:
+        """Every audio of a story, newest first."""
+        return self._existing(select(audio).where(audio.c.story_id == story_id).order_by(audio.c.created_at.desc()))
+
+    def lineage(self, video_key: str) -> Optional[dict]:
+        """
+        :return: The video with its audio, story and images, None if it isn't in the catalog
+        """
+        with self.engine.connect() as connection:
+            video = connection.execute(select(videos).where(videos.c.key == video_key)).first()
+            if video is None:
+                return None
+            video_audio = connection.execute(select(audio).where(audio.c.key == video.audio_key)).first()
+            story = None
+            if video_audio is not None and video_audio.story_id:
+                story = connection.execute(select(stories).where(stories.c.id == video_audio.story_id)).first()
+            video_image_rows = connection.execute(
+                select(video_images.c.image_key.label("key"), images.c.path, images.c.source, images.c.prompt)
+                .select_from(video_images.outerjoin(images, images.c.key == video_images.c.image_key))
+                .where(video_images.c.video_key == video_key).order_by(video_images.c.position)).all()
+        return {
+            "video": _row(video),
+            "audio": _row(video_audio) if video_audio is not None else None,
+            "story": _row(story) if story is not None else None,
+            "images": [_row(row) for row in video_image_rows],
+        }
+
+    def recent_jobs(self, state: Optional[str] = None, limit: int = 100) -> List[dict]:
+        """The latest jobs, optionally in one state."""
+        statement = select(jobs).order_by(jobs.c.created_at.desc()).limit(limit)
+        if state is not None:
+            statement = statement.where(jobs.c.state == state)
+        with self.engine.connect() as connection:
+            return [_row(row) for row in connection.execute(statement)]
+
+    def counts(self) -> Dict[str, int]:
+        with self.engine.connect() as connection:
+            return {table.name: connection.execute(select(func.count()).select_from(table)).scalar_one()
+                    for table in metadata.sorted_tables}
+
+
+_OPEN_LOCK = threading.Lock()
+_CATALOGS: Dict[str, AssetCatalog] = {}
+
+IN_MEMORY_URL = "sqlite://"
+
+
+def open_catalog(url: str, fallback: Optional[str] = None) -> AssetCatalog:
+    """
+    The catalog at `url`, created once per process since its engine holds the connection pool.
+
+    If it can't be opened the error is logged and the catalog at `fallback` is used instead, then
+    an in-memory one, so a database outage never fails a generation. Only catalogs that opened
+    are kept, the next call tries `url` again.
+
+    :param url: SQLAlchemy database URL
+    :param fallback: URL to use if `url` can't be opened, e.g. the SQLite file of the store
+    """
+    # Serialized, generator threads often open it together and would race to create the tables
+    with _OPEN_LOCK:
+        candidates = [url] + [candidate for candidate in (fallback, IN_MEMORY_URL) if candidate and candidate != url]
+        for candidate in candidates:
+            if candidate in _CATALOGS:
+                return _CATALOGS[candidate]
+            try:
+                catalog = AssetCatalog(candidate)
+            except (SQLAlchemyError, ImportError, OSError):
+                if candidate == IN_MEMORY_URL:
+                    raise
+                logger.exception("Could not open the catalog at %s, falling back to the next one",
+                                 display_url(candidate))
+                continue
+            _CATALOGS[candidate] = catalog
+            return catalog
+
+
+def default_catalog(root: str = STORAGE_ROOT) -> AssetCatalog:
+    """
+    The catalog of the asset store at `root`: $DATABASE_URL if set, otherwise (or if it can't be
+    opened) a SQLite file in the store.
+    """
+    return open_catalog(os.environ.get("DATABASE_URL") or sqlite_url(root), fallback=sqlite_url(root))
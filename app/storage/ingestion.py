@@ -0,0 +1,172 @@
+import os
+import wave
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, List, Optional
+
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+from PIL import Image
+
+from instrumentation.metrics import METRICS, annotate
+from storage.asset_store import AssetStore
+
+IMAGE_EXTENSIONS = {"PNG": ".png", "JPEG": ".jpg", "WEBP": ".webp"}
+
+
+class UploadRejected(ValueError):
+    """Raised when an upload is not a supported, valid file. The message is meant for the user."""
+
+
+class UploadIngestor:
+    """
+    Saves user uploads (images, voice samples) into the asset store.
+
+    Uploads are streamed to disk in chunks while they are hashed, and stored under the hash of
+    their contents, so the same file uploaded twice is stored once and two uploads never
+    overwrite each other. Images are checked from their header and audio durations are read
+    in-process (mutagen for mp3, wave for wav) before a file is accepted.
+
+    Usage:
+        ingestor = UploadIngestor()
+        image_paths = ingestor.ingest_images(st.file_uploader(..., accept_multiple_files=True))
+        sample_path = ingestor.ingest_audio(voice_file, max_seconds=120)
+    """
+
+    IMAGE_CATEGORY = "images"
+    AUDIO_CATEGORY = "voice_samples"
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, max_workers: int = 4,
+                 max_bytes: int = 50 * 1024 * 1024, max_image_pixels: int = 50_000_000):
+        """
+        :param asset_store: Store the uploads are saved in
+        :param max_workers: Maximum number of uploads processed concurrently
+        :param max_bytes: Largest accepted upload
+        :param max_image_pixels: Largest accepted image, in pixels
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.max_workers = max_workers
+        self.max_bytes = max_bytes
+        self.max_image_pixels = max_image_pixels
+
+    @staticmethod
+    def _name(upload) -> str:
+        return getattr(upload, "name", "upload")
+
+    def _ingest(self, upload: BinaryIO, category: str, validate) -> str:
+        """
+        Stream `upload` to a temporary file in the category while hashing it, validate it and
+        move it to `<category>/<content hash><ext>`.
+
+        :param validate: Called with the temporary path, returns the extension of the file or
+            raises UploadRejected
+        :return: Path of the stored file
+        """
+        if hasattr(upload, "seek"):
+            upload.seek(0)
+
+        # Dot-prefixed like the other in-progress files of the store, so cache scans skip it
+        fd, tmp_path = tempfile.mkstemp(prefix=".upload.", suffix=".tmp", dir=self.asset_store.category_dir(category))
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in iter(lambda: upload.read(AssetStore.CHUNK_SIZE), b""):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadRejected(f"{self._name(upload)} is larger than {self.max_bytes // (1024 * 1024)} MB.")
+                    digest.update(chunk)
+                    f.write(chunk)
+            if size == 0:
+                raise UploadRejected(f"{self._name(upload)} is empty.")
+
+            ext = validate(tmp_path)
+            path = self.asset_store.path_for(category, digest.hexdigest(), ext)
+            duplicate = os.path.exists(path)
+            annotate(bytes=size, duplicate=duplicate)
+            if duplicate:
+                # Already uploaded, keep the stored copy and mark it as recently used
+                os.utime(path)
+            else:
+                # mkstemp creates the file private to the owner, assets are shared with other services
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, path)
+            return path
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _validate_image(self, name: str):
+        def validate(path: str) -> str:
+            try:
+                # Only the header is parsed, the pixels are decoded later by the preprocessor
+                with Image.open(path) as img:
+                    image_format, (width, height) = img.format, img.size
+                    img.verify()
+            except (OSError, SyntaxError, Image.DecompressionBombError) as e:
+                raise UploadRejected(f"{name} is not a valid image.") from e
+            if image_format not in IMAGE_EXTENSIONS:
+                accepted = list(IMAGE_EXTENSIONS)
+                raise UploadRejected(f"{name} is a {image_format} image, upload a "
+                                     f"{', '.join(accepted[:-1])} or {accepted[-1]} image.")
+            if width * height > self.max_image_pixels:
+                raise UploadRejected(f"{name} is too large ({width}x{height}).")
+            return IMAGE_EXTENSIONS[image_format]
+        return validate
+
+    @staticmethod
+    def audio_duration(path: str) -> Optional[tuple]:
+        """
+        :param path: Path of an mp3 or wav file
+        :return: (extension, duration in seconds), None if the file is neither
+        """
+        with open(path, "rb") as f:
+            header = f.read(12)
+        if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+            try:
+                with wave.open(path, "rb") as audio:
+                    return ".wav", audio.getnframes() / audio.getframerate()
+            except (wave.Error, EOFError, ZeroDivisionError):
+                return None
+        try:
+            return ".mp3", MP3(path).info.length
+        except MutagenError:
+            return None
+
+    def _validate_audio(self, name: str, max_seconds: Optional[float]):
+        def validate(path: str) -> str:
+            audio = self.audio_duration(path)
+            if audio is None:
+                raise UploadRejected(f"{name} is not a valid mp3 or wav file.")
+            ext, seconds = audio
+            annotate(audio_seconds=seconds)
+            if max_seconds is not None and seconds > max_seconds:
+                raise UploadRejected(f"Uploaded audio is too long. Please upload an audio of maximum "
+                                     f"{max_seconds / 60:g} minutes.")
+            return ext
+        return validate
+
+    @METRICS.instrument("ingest.image", lambda self, upload: {"images": 1})
+    def ingest_image(self, upload: BinaryIO) -> str:
+        """
+        :param upload: File-like object of the image (e.g. a Streamlit UploadedFile)
+        :return: Path of the stored image
+        """
+        path = self._ingest(upload, self.IMAGE_CATEGORY, self._validate_image(self._name(upload)))
+        self.asset_store.catalog.record_image(path, "upload")
+        return path
+
+    @METRICS.instrument("ingest.audio")
+    def ingest_audio(self, upload: BinaryIO, max_seconds: Optional[float] = None) -> str:
+        """
+        :param upload: File-like object of the mp3 or wav sample
+        :param max_seconds: Longest accepted audio, no limit when None
+        :return: Path of the stored audio file
+        """
+        return self._ingest(upload, self.AUDIO_CATEGORY, self._validate_audio(self._name(upload), max_seconds))
+
+    def ingest_images(self, uploads: List[BinaryIO]) -> List[str]:
+        """Ingest several images concurrently; the paths are returned in the order of `uploads`."""
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(uploads)))) as pool:
+            return list(pool.map(self.ingest_image, uploads))
@@ -0,0 +1,300 @@
+"""
+Keeps db/storage from growing without bounds.
+
+    cd app && python -m storage.lifecycle            # disk usage by category
+    cd app && python -m storage.lifecycle --sweep    # evict down to the quotas first
+"""
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from instrumentation.metrics import METRICS, annotate
+from storage.asset_store import AssetStore
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Size each category may take on disk before its least recently used assets are evicted.
+# Categories not listed are never evicted: the sentence and LLM caches bound themselves, and
+# job records, pins and cloned voices are bookkeeping
+DEFAULT_QUOTAS = {
+    "videos": 5 * GB,
+    "segments": 10 * GB,
+    "frames": 4 * GB,
+    "audio_tracks": 1 * GB,
+    "audios": 2 * GB,
+    "images": 2 * GB,
+    "voice_samples": 1 * GB,
+    "subtitles": 100 * MB,
+    "timelines": 100 * MB,
+}
+UNITS = {"": 1, "K": 1024, "M": MB, "G": GB, "T": 1024 * GB}
+
+# Assets are named after their content key, sidecars and derived copies (e.g. <key>.timings.json,
+# <key>_resized.png) share it and are evicted with the asset. Other files were put there by hand
+ASSET_KEY = re.compile(r"^[0-9a-f]{64}")
+
+PIN_CATEGORY = "pins"
+JOB_CATEGORY = "jobs"
+
+
+def parse_quotas(text: str) -> Dict[str, int]:
+    """
+    :param text: Comma separated category=size, e.g. "videos=5G,segments=500M"
+    :return: Bytes per category
+    """
+    quotas = {}
+    for item in filter(None, (item.strip() for item in text.split(","))):
+        category, _, size = item.partition("=")
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*", size.upper())
+        if not category.strip() or not match:
+            raise ValueError(f"Invalid storage quota {item!r}, expected e.g. videos=5G")
+        quotas[category.strip()] = int(float(match.group(1)) * UNITS[match.group(2)])
+    return quotas
+
+
+class StorageManager:
+    """
+    Size quotas, least recently used eviction and cleanup for the asset store.
+
+    Every content-addressed asset can be produced again from its inputs, so once a category
+    grows over its quota the assets used least recently are deleted, down to 90% of it. The
+    file mtime is the time of last use: `AssetStore.get` and the media server touch the assets
+    they hand out, as the sentence and LLM caches already do with their entries.
+
+    Assets are never evicted while in use. Anything used in the last `min_age` seconds is kept,
+    which covers a render between looking up its inputs and reading them, and jobs pin the
+    assets they were given and their results (see `pin`), across processes. A sweep also
+    removes writes abandoned by a crash and old job records.
+
+    Usage:
+        manager = StorageManager(quotas={"videos": 2 * GB})
+        manager.start_sweeper(interval=600)
+        manager.usage()
+    """
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, quotas: Optional[Dict[str, int]] = None,
+                 min_age: float = 15 * 60, temp_age: float = 24 * 60 * 60, job_age: float = 7 * 24 * 60 * 60):
+        """
+        :param asset_store: Store to manage
+        :param quotas: Bytes per category, overriding `DEFAULT_QUOTAS`
+        :param min_age: Seconds since their last use during which assets are never evicted
+        :param temp_age: Seconds after which in-progress files (dot-prefixed) are considered abandoned
+        :param job_age: Seconds after their last update job records are deleted
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.quotas = dict(DEFAULT_QUOTAS, **(quotas or {}))
+        self.min_age = min_age
+        self.temp_age = temp_age
+        self.job_age = job_age
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def categories(self) -> List[str]:
+        if not os.path.isdir(self.asset_store.root):
+            return []
+        return sorted(entry.name for entry in os.scandir(self.asset_store.root)
+                      if entry.is_dir() and not entry.name.startswith("."))
+
+    @staticmethod
+    def _files(directory: str) -> Iterable[os.DirEntry]:
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return []
+        return [entry for entry in entries if entry.is_file(follow_symlinks=False)]
+
+    def usage(self) -> Dict[str, dict]:
+        """
+        :return: Per category, the number of files, their size in bytes and the quota (None if unbounded)
+        """
+        usage = {}
+        for category in self.categories():
+            files, size = 0, 0
+            for entry in self._files(os.path.join(self.asset_store.root, category)):
+                try:
+                    size += entry.stat().st_size
+                except FileNotFoundError:
+                    continue
+                files += 1
+            usage[category] = {"files": files, "bytes": size, "quota": self.quotas.get(category)}
+        return usage
+
+    def pin(self, owner: str, paths: Iterable[str], ttl: float = 6 * 60 * 60):
+        """
+        Keep assets from being evicted, e.g. the inputs and result of a job, until `unpin` or `ttl`.
+        Pins are files in the store, so they hold for sweeps running in any process.
+
+        :param owner: Id of the pin (e.g. the job id), pinning again replaces its paths
+        :param paths: Paths of the assets, paths outside the store are ignored
+        :param ttl: Seconds the pin lasts at most, in case its owner never releases it
+        """
+        root = os.path.realpath(self.asset_store.root)
+        paths = sorted({os.path.realpath(path) for path in paths if isinstance(path, str)})
+        paths = [path for path in paths if os.path.commonpath([root, path]) == root]
+        entry = {"paths": paths, "expires_at": time.time() + ttl}
+        self.asset_store.put_bytes(PIN_CATEGORY, owner, ".json", json.dumps(entry).encode("utf-8"))
+
+    def unpin(self, owner: str):
+        try:
+            os.remove(self.asset_store.path_for(PIN_CATEGORY, owner, ".json"))
+        except FileNotFoundError:
+            pass
+
+    def pinned(self) -> Set[Tuple[str, str]]:
+        """
+        :return: (category, key) of every pinned asset; expired pins are deleted
+        """
+        pinned = set()
+        now = time.time()
+        for entry in self._files(os.path.join(self.asset_store.root, PIN_CATEGORY)):
+            if entry.name.startswith(".") or not entry.name.endswith(".json"):
+                continue
+            try:
+                with open(entry.path) as f:
+                    pin = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if pin["expires_at"] < now:
+                self._remove(entry.path)
+                continue
+            for path in pin["paths"]:
+                match = ASSET_KEY.match(os.path.basename(path))
+                if match:
+                    pinned.add((os.path.basename(os.path.dirname(path)), match.group()))
+        return pinned
+
+    @staticmethod
+    def _remove(path: str) -> int:
+        """Delete a file or directory, returning the bytes freed."""
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                size = sum(os.path.getsize(os.path.join(parent, name))
+                           for parent, _, names in os.walk(path) for name in names)
+                shutil.rmtree(path, ignore_errors=True)
+                return size
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except FileNotFoundError:
+            return 0
+
+    def evict(self, category: str, quota: int, pinned: Set[Tuple[str, str]] = frozenset()) -> Tuple[int, int]:
+        """
+        Delete the least recently used assets of `category` until it fits in 90% of `quota`.
+
+        :return: Number of assets evicted and bytes freed
+        """
+        # Group the files of every asset, it is as recent as its most recently used file
+        assets: Dict[str, list] = {}
+        total = 0
+        for entry in self._files(os.path.join(self.asset_store.root, category)):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            match = ASSET_KEY.match(entry.name)
+            if match:
+                used, size, paths = assets.get(match.group(), (0.0, 0, []))
+                assets[match.group()] = (max(used, stat.st_mtime), size + stat.st_size, paths + [entry.path])
+        if total <= quota:
+            return 0, 0
+
+        # Evict down to 90% of the quota so a busy category isn't swept on every pass
+        recent = time.time() - self.min_age
+        evicted, freed = 0, 0
+        for key, (used, size, paths) in sorted(assets.items(), key=lambda item: item[1][0]):
+            if total - freed <= quota * 0.9:
+                break
+            if used > recent or (category, key) in pinned:
+                continue
+            freed += sum(self._remove(path) for path in paths)
+            evicted += 1
+        if total - freed > quota:
+            logger.warning("Storage category %s is %d bytes over its quota, its assets are in use", category,
+                           total - freed - quota)
+        return evicted, freed
+
+    def _cleanup(self) -> int:
+        """Delete abandoned in-progress files and old job records, returning the bytes freed."""
+        now = time.time()
+        freed = 0
+        for category in self.categories():
+            directory = os.path.join(self.asset_store.root, category)
+            for entry in os.scandir(directory):
+                try:
+                    modified = entry.stat(follow_symlinks=False).st_mtime
+                except FileNotFoundError:
+                    continue
+                # Dot-prefixed files and directories are writes in progress (see `AssetStore.atomic_path`)
+                if entry.name.startswith(".") and now - modified > self.temp_age:
+                    freed += self._remove(entry.path)
+                elif category == JOB_CATEGORY and now - modified > self.job_age:
+                    freed += self._remove(entry.path)
+        return freed
+
+    @METRICS.instrument("storage.sweep")
+    def sweep(self) -> Dict[str, dict]:
+        """
+        Clean up and evict every category down to its quota.
+
+        :return: Usage by category after the sweep, see `usage`
+        """
+        with self._lock:
+            freed = self._cleanup()
+            pinned = self.pinned()
+            evicted = 0
+            for category, quota in self.quotas.items():
+                category_evicted, category_freed = self.evict(category, quota, pinned)
+                evicted += category_evicted
+                freed += category_freed
+            usage = self.usage()
+            annotate(evicted=evicted, freed_bytes=freed, stored_bytes=sum(item["bytes"] for item in usage.values()))
+            if freed:
+                logger.info("Storage sweep evicted %d assets and freed %.1f MB", evicted, freed / MB)
+            return usage
+
+    def start_sweeper(self, interval: float = 10 * 60) -> threading.Thread:
+        """Sweep every `interval` seconds from a background thread, until `stop_sweeper`."""
+
+        def run():
+            while not self._stop.wait(interval):
+                try:
+                    self.sweep()
+                except Exception:
+                    logger.exception("Storage sweep failed")
+
+        self._stop.clear()
+        thread = threading.Thread(target=run, name="storage-sweeper", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_sweeper(self):
+        self._stop.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=None, help="Storage root, defaults to db/storage")
+    parser.add_argument("--quotas", default=None, help="e.g. videos=5G,segments=10G, overriding DEFAULT_QUOTAS")
+    parser.add_argument("--sweep", action="store_true", help="Evict down to the quotas first")
+    args = parser.parse_args()
+
+    store = AssetStore(args.root) if args.root else AssetStore()
+    manager = StorageManager(store, parse_quotas(args.quotas or ""))
+    usage = manager.sweep() if args.sweep else manager.usage()
+    for category, item in usage.items():
+        print(json.dumps(dict(category=category, **item)))
+
+
+if __name__ == "__main__":
+    main()
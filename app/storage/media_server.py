@@ -0,0 +1,143 @@
+import os
+import re
+import mimetypes
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from storage.asset_store import AssetStore
+
+# Categories of the asset store the browser may fetch from
+MEDIA_CATEGORIES = ("videos", "subtitles")
+# Asset file names are a sha256 key and an extension, anything else is never served
+ASSET_NAME = re.compile(r"^(?P<key>[0-9a-f]{64})\.[0-9a-z]+$")
+# Assets are content-addressed, a name always refers to the same bytes
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+mimetypes.add_type("application/x-subrip", ".srt")
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    :param header: Value of a Range header, e.g. "bytes=0-1023" or "bytes=-500"
+    :param size: Size of the file in bytes
+    :return: First and last byte of the range, None if it can't be satisfied (it starts past the end).
+        Raises ValueError for headers that are not a single valid byte range, which are ignored
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise ValueError(header)
+    first, _, last = spec.strip().partition("-")
+    if not first:
+        # Suffix range, the last N bytes
+        length = int(last)
+        return (max(0, size - length), size - 1) if length > 0 and size > 0 else None
+    first = int(first)
+    if last and int(last) < first:
+        # Invalid rather than unsatisfiable (RFC 9110, 14.1.1), the whole file is sent
+        raise ValueError(header)
+    last = min(int(last), size - 1) if last else size - 1
+    return (first, last) if first <= last else None
+
+
+def media_url(file_path: str, base_url: Optional[str], asset_store: Optional[AssetStore] = None) -> Optional[str]:
+    """
+    :param file_path: Path of an asset, e.g. a rendered video
+    :param base_url: Address of the media server as seen by the browser, None if it isn't running
+    :param asset_store: Store the media server serves
+    :return: URL of the asset on the media server, None if it isn't served there
+    """
+    if not base_url:
+        return None
+    asset_store = asset_store or AssetStore()
+    relative = os.path.relpath(os.path.realpath(file_path), os.path.realpath(asset_store.root))
+    category, _, name = relative.replace(os.sep, "/").partition("/")
+    if category not in MEDIA_CATEGORIES or not ASSET_NAME.match(name):
+        return None
+    return f"{base_url.rstrip('/')}/{category}/{name}"
+
+
+def serve_media(port: int, asset_store: Optional[AssetStore] = None, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    """
+    Serve the rendered assets on http://host:port/<category>/<key><ext> from a background thread.
+
+    Responses support byte ranges (so players start right away and seek without downloading
+    the whole file) and ETags, and the file is sent with sendfile: memory stays flat whatever
+    the size of the video. Add ?download=1 to have the browser save the file.
+    """
+    asset_store = asset_store or AssetStore()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_HEAD(self):
+            self.send_asset(body=False)
+
+        def do_GET(self):
+            self.send_asset(body=True)
+
+        def send_empty(self, status: int, **headers):
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name.replace("_", "-"), value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def send_asset(self, body: bool):
+            url = urlsplit(self.path)
+            category, _, name = url.path.lstrip("/").partition("/")
+            match = ASSET_NAME.match(name)
+            if category not in MEDIA_CATEGORIES or not match:
+                return self.send_empty(404)
+            path = os.path.join(asset_store.root, category, name)
+            try:
+                size = os.stat(path).st_size
+            except OSError:
+                return self.send_empty(404)
+            # Watched assets are recently used, the storage manager evicts them last
+            asset_store.touch(path)
+
+            etag = f'"{match.group("key")}"'
+            if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+                return self.send_empty(304, ETag=etag, Cache_Control=CACHE_CONTROL)
+
+            byte_range = None
+            range_header = self.headers.get("Range")
+            # If-Range asks for the whole file when the client's copy is outdated
+            if range_header and self.headers.get("If-Range", etag) == etag:
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError:
+                    range_header = None
+                if range_header and byte_range is None:
+                    return self.send_empty(416, Content_Range=f"bytes */{size}")
+
+            first, last = byte_range or (0, size - 1)
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Type", mimetypes.guess_type(name)[0] or "application/octet-stream")
+            self.send_header("Content-Length", str(last - first + 1))
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {first}-{last}/{size}")
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", CACHE_CONTROL)
+            if "download" in parse_qs(url.query):
+                self.send_header("Content-Disposition", f'attachment; filename="{name}"')
+            self.end_headers()
+            if not body or last < first:
+                return
+
+            try:
+                with open(path, "rb") as f:
+                    self.connection.sendfile(f, first, last - first + 1)
+            except (ConnectionError, TimeoutError):
+                # Players drop connections all the time when seeking
+                self.close_connection = True
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,24 @@
+import pytest
+
+from storage.media_server import parse_range
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-300", (700, 999)),
+    ("bytes=-5000", (0, 999)),
+    # Unsatisfiable, answered 416
+    ("bytes=1000-1200", None),
+    ("bytes=-0", None),
+])
+def test_single_ranges(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=500-100", "bytes=0-1,5-9", "items=0-1", "bytes=a-b", "bytes=5--3"])
+def test_invalid_ranges_are_ignored(header):
+    # The caller drops the header and sends the whole file
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
@@ -0,0 +1,32 @@
+import time
+import asyncio
+from typing import Any, List, Optional
+
+from langchain.llms.base import LLM
+
+
+class FakeStoryLLM(LLM):
+    """
+    Local stand-in for the OpenAI LLM. Answers every prompt with a story of `words` words after
+    `latency` seconds, so chain overhead and batch throughput can be measured offline.
+    """
+
+    latency: float = 0.0
+    words: int = 100
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-story"
+
+    def _response(self, prompt: str) -> str:
+        self.calls += 1
+        return " ".join(["word"] * (self.words - 1) + ["end."])
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        time.sleep(self.latency)
+        return self._response(prompt)
+
+    async def _acall(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> str:
+        await asyncio.sleep(self.latency)
+        return self._response(prompt)
@@ -0,0 +1,85 @@
+import os
+import json
+import time
+import threading
+from typing import Optional
+
+from storage.asset_store import AssetStore
+
+
+class PromptCache:
+    """
+    Disk cache of LLM responses keyed by (template, inputs, model, temperature).
+
+    The story prompts come from a handful of dropdowns, so the same prompt is asked over and
+    over across sessions and restarts. Entries expire after `ttl` seconds and the least
+    recently used ones are evicted once there are more than `max_entries`.
+    """
+
+    CATEGORY = "llm_cache"
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, ttl: float = 24 * 60 * 60, max_entries: int = 10000):
+        """
+        :param asset_store: Store the responses are saved in
+        :param ttl: Seconds a response is served from the cache
+        :param max_entries: Number of responses kept before the least recently used are evicted
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.directory = self.asset_store.category_dir(self.CATEGORY)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._count = len(self._entries())
+
+    @staticmethod
+    def key(template: str, inputs: dict, model: str, temperature: Optional[float]) -> str:
+        return AssetStore.hash_key("llm", template, inputs, model, temperature)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.asset_store.path_for(self.CATEGORY, key, ".json")
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if time.time() - entry["created_at"] > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return entry["response"]
+
+    def put(self, key: str, response: str):
+        entry = {"created_at": time.time(), "response": response}
+        self.asset_store.put_bytes(self.CATEGORY, key, ".json", json.dumps(entry).encode("utf-8"))
+        with self._lock:
+            self._count += 1
+            if self._count > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        # Evict down to 90% of the budget so we don't rescan the directory on every put
+        excess = len(entries) - int(self.max_entries * 0.9)
+        for entry in entries[:max(excess, 0)]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+        self._count = len(entries) - max(excess, 0)
+
+    def _entries(self):
+        # Files starting with a dot are writes still in progress
+        return [entry for entry in os.scandir(self.directory)
+                if entry.name.endswith(".json") and not entry.name.startswith(".")]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": self._count}
@@ -1,18 +1,22 @@
 from langchain.llms import OpenAI
+from langchain.llms.base import BaseLLM
 from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain, SequentialChain, SimpleSequentialChain
+from langchain.chains import LLMChain
 from langchain.memory import SimpleMemory
 
 import openai
 import os
-from dotenv import load_dotenv
+import asyncio
+from typing import List, Optional, Tuple
+from environment import load_environment
+from instrumentation.metrics import METRICS, annotate
+from outbound.scheduler import BATCH, SCHEDULER, OutboundScheduler, outbound_priority
+from story_generation.prompt_cache import PromptCache
+from story_generation.validation import StoryValidator
 
 
 # Load the environment variables
-current_dir = os.path.dirname(os.path.abspath(__file__))
-project_root = os.path.dirname(os.path.dirname(current_dir))
-env_paht = os.path.join(project_root, ".env")
-load_dotenv(env_paht)
+load_environment()
 
 
 class StoryTemplates:
@@ -40,45 +44,172 @@ class StoryTemplates:
 
 
 class StoryGenerator:
-    def __init__(self, api_key: str = None, model: str = "gpt3.5-turbo"):
 
-        key = os.environ.get("OPENAI_KEY", api_key)
-        if not key:
-            raise ValueError("OPENAI API key must be provided.")
-        self.llm = OpenAI(temperature=0.9, openai_api_key=key)
+    PROVIDER = "openai"
 
-    
-    def generate_story(self, idea):
+    def __init__(self, api_key: str = None, model: str = "gpt3.5-turbo", llm: Optional[BaseLLM] = None,
+                 verbose: bool = False, prompt_cache: Optional[PromptCache] = None, deterministic: bool = False,
+                 early_exit: Optional[StoryValidator] = StoryValidator(), scheduler: Optional[OutboundScheduler] = None):
+        """
+        Args:
+            api_key: OpenAI API key, OPENAI_KEY takes precedence.
+            model: Name of the model.
+            llm: LLM to use instead of OpenAI (e.g. a fake one for benchmarks).
+            verbose: Log the chain steps to stdout.
+            prompt_cache: Cache of LLM responses, no caching when None.
+            deterministic: Sample at temperature 0, so a cached response is exactly what the LLM
+                would answer again.
+            early_exit: Validator of the first draft. When it passes, the review and improve
+                steps are skipped. None always runs all three steps.
+            scheduler: Rate limits and retries of the LLM calls, defaults to the shared `SCHEDULER`.
+        """
+        if llm is None:
+            key = os.environ.get("OPENAI_KEY", api_key)
+            if not key:
+                raise ValueError("OPENAI API key must be provided.")
+            # A single attempt, the scheduler retries with the rate limits of the account in mind
+            llm = OpenAI(temperature=0 if deterministic else 0.9, openai_api_key=key, max_retries=1)
+        self.llm = llm
+        self.scheduler = scheduler or SCHEDULER
+        self.prompt_cache = prompt_cache
+        self.early_exit = early_exit
+
+        # The chain graph doesn't depend on the idea, so it is built once per generator
+        self.story_chain, self.review_chain, self.improve_chain = self.build_chains(self.llm, verbose)
+
+    @staticmethod
+    def build_chains(llm: BaseLLM, verbose: bool = False) -> Tuple[LLMChain, LLMChain, LLMChain]:
+        """
+        Build the story, review and improve chains.
+        """
+        # Story generation
+        story_template = PromptTemplate(input_variables=["idea"], template=StoryTemplates.story_template)
+        story_chain = LLMChain(llm=llm, prompt=story_template, output_key="story", verbose=verbose)
+
+        # Review
+        review_template = PromptTemplate(input_variables=["story"], template=StoryTemplates.review_template)
+        review_chain = LLMChain(llm=llm, prompt=review_template, output_key="review", verbose=verbose)
+
+        # Improve
+        improve_template = PromptTemplate(input_variables=["story", "review"], template=StoryTemplates.improve_template)
+        improve_chain = LLMChain(llm=llm, prompt=improve_template, verbose=verbose)
+
+        return story_chain, review_chain, improve_chain
+
+    def _cache_key(self, chain: LLMChain, inputs: dict) -> str:
+        model = getattr(self.llm, "model_name", self.llm._llm_type)
+        return PromptCache.key(chain.prompt.template, inputs, model, getattr(self.llm, "temperature", None))
+
+    def _tokens(self, chain: LLMChain, inputs: dict) -> int:
+        # Roughly 4 characters per token for the prompt, plus the longest completion allowed
+        return len(chain.prompt.format(**inputs)) // 4 + getattr(self.llm, "max_tokens", 0)
+
+    def _call(self, chain: LLMChain, inputs: dict) -> str:
+        return self.scheduler.call(self.PROVIDER, chain.run, units=self._tokens(chain, inputs), **inputs)
+
+    async def _acall(self, chain: LLMChain, inputs: dict) -> str:
+        return await self.scheduler.acall(self.PROVIDER, chain.arun, units=self._tokens(chain, inputs), **inputs)
+
+    def _run(self, chain: LLMChain, **inputs) -> str:
+        if self.prompt_cache is None:
+            return self._call(chain, inputs)
+
+        key = self._cache_key(chain, inputs)
+        response = self.prompt_cache.get(key)
+        if response is None:
+            response = self._call(chain, inputs)
+            self.prompt_cache.put(key, response)
+        return response
+
+    async def _arun(self, chain: LLMChain, **inputs) -> str:
+        if self.prompt_cache is None:
+            return await self._acall(chain, inputs)
+
+        key = self._cache_key(chain, inputs)
+        response = self.prompt_cache.get(key)
+        if response is None:
+            response = await self._acall(chain, inputs)
+            self.prompt_cache.put(key, response)
+        return response
+
+    def _draft_is_final(self, story: str, language: Optional[str]) -> bool:
+        return self.early_exit is not None and self.early_exit(story, language)
+
+    @METRICS.instrument("story.generate_story", lambda self, idea, *args, **kwargs: {"characters": len(idea)})
+    def generate_story(self, idea, language: Optional[str] = None):
         """
         Method that uses llm chains to generates a story, reviews and modifies the story
-        accordingly.
+        accordingly. The review and improve steps are skipped when the first draft passes
+        the early exit validator.
 
         Args:
             idea: Input from the user on the story idea.
+            language: Language the story should be written in, checked by the validator.
 
         Returns:
             str - LLM generated story
         """
+        with METRICS.span("story.draft", characters=len(idea)):
+            story = self._run(self.story_chain, idea=idea)
+        final = self._draft_is_final(story, language)
+        annotate(early_exit=final)
+        if final:
+            return story
+
+        with METRICS.span("story.review", characters=len(story)):
+            review = self._run(self.review_chain, story=story)
+        with METRICS.span("story.improve", characters=len(story) + len(review)):
+            return self._run(self.improve_chain, story=story, review=review)
+
+    async def agenerate_story(self, idea, language: Optional[str] = None):
+        """
+        Async version of `generate_story`.
+        """
+        with METRICS.span("story.agenerate_story", characters=len(idea)) as span:
+            with METRICS.span("story.draft", characters=len(idea)):
+                story = await self._arun(self.story_chain, idea=idea)
+            final = self._draft_is_final(story, language)
+            span.set(early_exit=final)
+            if final:
+                return story
+
+            with METRICS.span("story.review", characters=len(story)):
+                review = await self._arun(self.review_chain, story=story)
+            with METRICS.span("story.improve", characters=len(story) + len(review)):
+                return await self._arun(self.improve_chain, story=story, review=review)
+
+    async def agenerate_stories(self, ideas: List[str], max_concurrency: int = 4,
+                                language: Optional[str] = None) -> List[str]:
+        """
+        Async version of `generate_stories`.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
 
-        # Story generation
-        story_template = PromptTemplate(input_variables=["idea"], template=StoryTemplates.story_template)
-        story_chain = LLMChain(llm=self.llm, prompt=story_template, output_key="story")
+        async def generate(idea):
+            async with semaphore:
+                return await self.agenerate_story(idea, language)
 
-        # Review
-        review_template = PromptTemplate(input_variables=["story"], template=StoryTemplates.review_template)
-        review_chain = LLMChain(llm=self.llm, prompt=review_template, output_key="review")
+        # Bulk stories make way for the ones users are waiting on
+        with outbound_priority(BATCH):
+            return await asyncio.gather(*(generate(idea) for idea in ideas))
 
-        # Improve
-        improve_template = PromptTemplate(input_variables=["story", "review"], template=StoryTemplates.improve_template)
-        improve_chain = LLMChain(llm=self.llm, prompt=improve_template)
+    def generate_stories(self, ideas: List[str], max_concurrency: int = 4,
+                         language: Optional[str] = None) -> List[str]:
+        """
+        Generate a story for every idea, running at most `max_concurrency` chains at a time.
+        Meant for bulk content jobs, the LLM calls are scheduled at batch priority; must not be
+        called from a running event loop (use `agenerate_stories` there).
 
-        final_chain = SequentialChain(
-            chains=[story_chain, review_chain, improve_chain],
-            input_variables=["idea"],
-            verbose=True
-        )
+        Args:
+            ideas: Story ideas.
+            max_concurrency: Maximum number of stories generated concurrently.
+            language: Language the stories should be written in, checked by the validator.
 
-        return final_chain.run(idea)
+        Returns:
+            List[str] - generated stories, in the order of `ideas`
+        """
+        with METRICS.span("story.generate_stories", stories=len(ideas)):
+            return asyncio.run(self.agenerate_stories(ideas, max_concurrency, language))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,46 @@
+import re
+from typing import Optional
+
+# A few of the most frequent function words of the languages offered in the app
+STOPWORDS = {
+    "English": {"the", "and", "of", "to", "a", "in", "was", "he", "she", "it", "that", "with", "his", "her"},
+    "Spanish": {"el", "la", "de", "que", "y", "en", "los", "las", "un", "una", "se", "con", "por", "su"},
+    "French": {"le", "la", "de", "et", "les", "des", "un", "une", "est", "il", "elle", "dans", "qui", "que"},
+    "German": {"der", "die", "das", "und", "ein", "eine", "ist", "nicht", "sie", "er", "mit", "zu", "den", "war"},
+}
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def detect_language(text: str) -> Optional[str]:
+    """Guess the language of a story from its stopwords, None if it isn't one we know."""
+    words = [word.lower() for word in WORD.findall(text)]
+    scores = {language: sum(word in stopwords for word in words) for language, stopwords in STOPWORDS.items()}
+    language, score = max(scores.items(), key=lambda item: item[1])
+    return language if score else None
+
+
+class StoryValidator:
+    """
+    Local check of a first draft against what the templates ask for. When a draft passes, the
+    review and improve LLM round trips are skipped.
+    """
+
+    def __init__(self, min_words: int = 75, max_words: int = 150):
+        """
+        :param min_words: Minimum length of the story in words
+        :param max_words: Maximum length of the story in words
+        """
+        self.min_words = min_words
+        self.max_words = max_words
+
+    def __call__(self, story: str, language: Optional[str] = None) -> bool:
+        """
+        :param story: The generated story
+        :param language: Expected language (e.g. "Spanish"), not checked when None
+        :return: True if the story can be used as is
+        """
+        word_count = len(WORD.findall(story))
+        if not self.min_words <= word_count <= self.max_words:
+            return False
+        return language is None or detect_language(story) == language
@@ -0,0 +1,359 @@
+import os
+import math
+import subprocess
+from dataclasses import dataclass, asdict
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from imageio_ffmpeg import get_ffmpeg_exe
+
+from instrumentation.metrics import METRICS, annotate
+from video_generation.subtitles import CaptionRenderer
+
+
+@dataclass(frozen=True)
+class EncoderSettings:
+    """
+    Settings passed to ffmpeg when encoding a video. They are part of the asset key of every
+    render, so changing any of them produces a new video instead of reusing a stored one.
+    """
+    fps: float = 30
+    codec: str = "libx264"
+    preset: str = "medium"
+    crf: int = 23
+    pix_fmt: str = "yuv420p"
+    tune: Optional[str] = None
+    audio_codec: str = "aac"
+    audio_bitrate: str = "192k"
+    # Encoder threads, ffmpeg picks when None
+    threads: Optional[int] = None
+
+    def as_dict(self) -> dict:
+        # The thread count changes how fast a video is encoded, not the video, so renders
+        # are shared between machines with different cores
+        settings = asdict(self)
+        del settings["threads"]
+        return settings
+
+
+# x264 presets from fastest to slowest
+PRESETS = ("ultrafast", "superfast", "veryfast", "faster", "fast", "medium", "slow", "slower")
+
+# Quality/speed profiles: (preset steps relative to what the cores afford, CRF)
+QUALITY_PROFILES = {
+    "fast": (-2, 26),
+    "balanced": (0, 23),
+    "quality": (1, 20),
+}
+
+
+def auto_settings(profile: str = "balanced", cores: Optional[int] = None, **overrides) -> EncoderSettings:
+    """Encoder settings for the cores of this machine.
+
+    Every doubling of the cores affords the next slower (better compressing) preset at about the
+    same wall time: veryfast on one core, medium on 8, slow on 16. The profile shifts that
+    choice and sets the CRF.
+
+    Args:
+        profile: One of QUALITY_PROFILES.
+        cores: Cores the encode may use, defaults to all of them.
+        overrides: Other EncoderSettings fields, e.g. fps.
+
+    Returns:
+        The settings, with one encoder thread per core.
+    """
+    if profile not in QUALITY_PROFILES:
+        raise ValueError(f"Unknown quality profile {profile}, expected one of {list(QUALITY_PROFILES)}")
+    cores = max(1, cores or os.cpu_count() or 1)
+    offset, crf = QUALITY_PROFILES[profile]
+    rung = min(max(2 + int(math.log2(cores)) + offset, 0), len(PRESETS) - 1)
+    settings = dict(preset=PRESETS[rung], crf=crf, threads=cores)
+    settings.update(overrides)
+    return EncoderSettings(**settings)
+
+
+# Frames between two calls of the progress callback of FramePipeEncoder, about a second of video
+PROGRESS_FRAMES = 30
+
+# Bytes per pixel of the raw frame formats FramePipeEncoder accepts
+INPUT_PIX_FMT_CHANNELS = {"rgb24": 3, "rgb0": 4}
+
+# Written in front of every MP4: the index (moov atom) is moved to the start of the file once the
+# encode finishes, so players can start before the whole file is downloaded and seek with ranges
+FASTSTART = ["-movflags", "+faststart"]
+
+# A single image shown for the whole audio: one frame per second is enough and x264's
+# stillimage tuning spends almost no bits on the repeated frames.
+STILL_IMAGE_SETTINGS = EncoderSettings(fps=1, tune="stillimage")
+# Captions burnt into a still image change at most every 1/fps seconds
+CAPTIONED_STILL_SETTINGS = EncoderSettings(fps=10, tune="stillimage")
+
+# Draft renders, to check the slide order and timing before the final render: a third of the
+# resolution at half the frame rate with the fastest preset. The audio settings are the final
+# ones, so the encoded audio track is shared with the final render
+PREVIEW_SCALE = 1 / 3
+PREVIEW_SETTINGS = EncoderSettings(fps=15, preset="ultrafast", crf=28)
+
+
+def preview_size(size: Tuple[int, int], scale: float = PREVIEW_SCALE) -> Tuple[int, int]:
+    """Frame size of the preview of a video of `size`, in even pixels as yuv420p requires."""
+    width, height = size
+    return max(2, 2 * round(width * scale / 2)), max(2, 2 * round(height * scale / 2))
+
+
+def slide_frame_counts(durations: List[float], fps: float) -> List[int]:
+    """Convert slide durations in seconds into frame counts.
+
+    Frame boundaries are rounded on the cumulative timeline, so rounding errors do not add up
+    and the video stays in sync with the audio no matter how many slides there are.
+
+    Args:
+        durations: Duration of each slide in seconds.
+        fps: Frame rate of the video.
+
+    Returns:
+        Number of frames to show for each slide.
+    """
+    counts = []
+    elapsed = 0.0
+    previous_boundary = 0
+    for duration in durations:
+        elapsed += duration
+        boundary = int(round(elapsed * fps))
+        counts.append(boundary - previous_boundary)
+        previous_boundary = boundary
+    return counts
+
+
+def write_captioned(encoder: "FramePipeEncoder", frame: np.ndarray, start: int, count: int,
+                    captions: Optional[CaptionRenderer], buffer: Optional[np.ndarray] = None):
+    """Write `frame` for frames [start, start + count) of the video, with the captions of those frames.
+
+    The frame is only copied and sent again where the caption changes, the runs in between are
+    written with `repeat`.
+
+    Args:
+        encoder: Open encoder.
+        frame: Image shown on those frames.
+        start: Index of the first frame in the video.
+        count: Number of frames.
+        captions: Captions burnt into the frames, the frame is written as is when None.
+        buffer: Scratch array of the shape of `frame` the captions are drawn into.
+    """
+    if captions is None:
+        encoder.write_frame(frame, repeat=count)
+        return
+    buffer = np.empty_like(frame) if buffer is None else buffer
+    boundaries = captions.boundaries(start, start + count) + [start + count]
+    for first, end in zip(boundaries, boundaries[1:]):
+        np.copyto(buffer, frame)
+        captions.draw(buffer, first)
+        encoder.write_frame(buffer, repeat=end - first)
+
+
+class FramePipeEncoder:
+    """
+    Streams raw RGB (or RGBX, see `input_pix_fmt`) frames into an ffmpeg process which encodes them (and optionally muxes an
+    audio track) straight into the output file, without any intermediate video file.
+
+    Usage:
+        with FramePipeEncoder(output_path, (1080, 1920), settings, audio_file_path) as encoder:
+            encoder.write_frame(frame)
+    """
+
+    def __init__(self, output_path: str, frame_size: Tuple[int, int], settings: EncoderSettings = EncoderSettings(),
+                 audio_file_path: Optional[str] = None, duration: Optional[float] = None, copy_audio: bool = False,
+                 input_pix_fmt: str = "rgb24", progress: Optional[Callable[[int], None]] = None):
+        """
+        :param output_path: Path of the video file to write
+        :param frame_size: (width, height) of the frames that will be written
+        :param settings: Encoder settings
+        :param audio_file_path: Optional audio file muxed into the video
+        :param duration: Optional exact duration in seconds the output is trimmed to
+        :param copy_audio: The audio file is already encoded (see `encode_audio`), mux it with stream copy
+        :param input_pix_fmt: Layout of the written frames, "rgb24" or "rgb0" (RGB padded to 4 bytes)
+        :param progress: Called with the number of frames written every `PROGRESS_FRAMES` frames.
+            An exception it raises (e.g. the job was cancelled) aborts the encode
+        """
+        if input_pix_fmt not in INPUT_PIX_FMT_CHANNELS:
+            raise ValueError(f"Unsupported input pixel format {input_pix_fmt}, expected one of {list(INPUT_PIX_FMT_CHANNELS)}")
+        self.output_path = output_path
+        self.frame_size = frame_size
+        self.settings = settings
+        self.audio_file_path = audio_file_path
+        self.duration = duration
+        self.copy_audio = copy_audio
+        self.input_pix_fmt = input_pix_fmt
+        self.progress = progress
+        self.frames_written = 0
+        self.process = None
+
+    def command(self) -> List[str]:
+        width, height = self.frame_size
+        cmd = [
+            get_ffmpeg_exe(), "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", self.input_pix_fmt, "-s", f"{width}x{height}", "-r", str(self.settings.fps),
+            "-i", "-",
+        ]
+        if self.audio_file_path:
+            cmd += ["-i", self.audio_file_path]
+        cmd += [
+            "-map", "0:v",
+            "-c:v", self.settings.codec, "-preset", self.settings.preset, "-crf", str(self.settings.crf),
+            "-pix_fmt", self.settings.pix_fmt,
+        ]
+        if self.settings.tune:
+            cmd += ["-tune", self.settings.tune]
+        if self.settings.threads:
+            cmd += ["-threads", str(self.settings.threads)]
+        if self.audio_file_path and self.copy_audio:
+            cmd += ["-map", "1:a", "-c:a", "copy"]
+        elif self.audio_file_path:
+            cmd += ["-map", "1:a", "-c:a", self.settings.audio_codec, "-b:a", self.settings.audio_bitrate]
+        if self.duration is not None:
+            cmd += ["-t", f"{self.duration:.3f}"]
+        cmd += FASTSTART
+        cmd.append(self.output_path)
+        return cmd
+
+    def open(self):
+        self.process = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write_frame(self, frame: np.ndarray, repeat: int = 1):
+        """
+        :param frame: uint8 array of shape (height, width, 3), or (height, width, 4) for "rgb0"
+        :param repeat: How many consecutive frames show this image
+        """
+        width, height = self.frame_size
+        shape = (height, width, INPUT_PIX_FMT_CHANNELS[self.input_pix_fmt])
+        if frame.shape != shape or frame.dtype != np.uint8:
+            raise ValueError(f"Expected a uint8 frame of shape {shape}, got {frame.dtype} {frame.shape}")
+
+        data = memoryview(np.ascontiguousarray(frame)).cast("B")
+        try:
+            for _ in range(repeat):
+                self.process.stdin.write(data)
+                self.frames_written += 1
+                if self.progress is not None and self.frames_written % PROGRESS_FRAMES == 0:
+                    self.progress(self.frames_written)
+        except BrokenPipeError:
+            self.close()
+
+    def close(self):
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        if not process.stdin.closed:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        error = process.stderr.read().decode(errors="replace")
+        if process.wait() != 0:
+            raise IOError(f"ffmpeg failed to encode {self.output_path}: {error.strip()}")
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+
+
+@METRICS.instrument("encode.audio")
+def encode_audio(audio_file_path: str, output_path: str, settings: EncoderSettings = EncoderSettings()):
+    """Encode an audio file to the audio codec of `settings`, so renders can mux it with stream copy.
+
+    Args:
+        audio_file_path: Source audio (e.g. the story mp3).
+        output_path: Path of the encoded track, the extension picks the container (e.g. .m4a).
+        settings: Encoder settings.
+    """
+    result = subprocess.run(
+        [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-i", audio_file_path, "-vn",
+         "-c:a", settings.audio_codec, "-b:a", settings.audio_bitrate, output_path],
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise IOError(f"ffmpeg failed to encode {output_path}: {result.stderr.decode(errors='replace').strip()}")
+
+
+@METRICS.instrument("encode.mux")
+def mux(video_path: str, audio_path: str, output_path: str):
+    """Combine a video stream and an audio track into one file with stream copy, without re-encoding either.
+
+    Args:
+        video_path: Video whose (first) video stream is used.
+        audio_path: Audio track, already in the codec of the output (see `encode_audio`).
+        output_path: Path of the video file to write.
+    """
+    result = subprocess.run(
+        [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-i", video_path, "-i", audio_path,
+         "-map", "0:v", "-map", "1:a", "-c", "copy", *FASTSTART, output_path],
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        raise IOError(f"ffmpeg failed to mux {output_path}: {result.stderr.decode(errors='replace').strip()}")
+
+
+@METRICS.instrument("encode.slideshow", lambda frames, durations, *args, **kwargs: {
+    "images": len(frames), "audio_seconds": sum(durations)})
+def encode_slideshow(frames: List[np.ndarray], durations: List[float], output_path: str,
+                     audio_file_path: Optional[str] = None, settings: EncoderSettings = EncoderSettings(),
+                     copy_audio: bool = False, captions: Optional[CaptionRenderer] = None):
+    """Encode a slideshow where each frame is shown for its exact duration.
+
+    Args:
+        frames: One uint8 RGB array per slide, all of the same size.
+        durations: Duration of each slide in seconds.
+        output_path: Path of the video file to write.
+        audio_file_path: Optional audio track muxed into the video.
+        settings: Encoder settings.
+        copy_audio: The audio track is already encoded, mux it with stream copy.
+        captions: Captions burnt into the video, at the frame rate of `settings`.
+    """
+    height, width = frames[0].shape[:2]
+    counts = slide_frame_counts(durations, settings.fps)
+    annotate(frames=sum(counts), size=f"{width}x{height}")
+    buffer = np.empty_like(frames[0]) if captions else None
+    with FramePipeEncoder(output_path, (width, height), settings, audio_file_path, copy_audio=copy_audio) as encoder:
+        start = 0
+        for frame, count in zip(frames, counts):
+            write_captioned(encoder, frame, start, count, captions, buffer)
+            start += count
+
+
+@METRICS.instrument("encode.still", lambda frame, duration, *args, **kwargs: {"audio_seconds": duration})
+def encode_still(frame: np.ndarray, duration: float, output_path: str, audio_file_path: Optional[str] = None,
+                 settings: EncoderSettings = STILL_IMAGE_SETTINGS, captions: Optional[CaptionRenderer] = None,
+                 progress: Optional[Callable[[float], None]] = None):
+    """Encode a single image shown for `duration` seconds, muxed against the audio.
+
+    The frame is sent to ffmpeg once per output frame at the (low) frame rate of `settings`
+    and the output is trimmed to the exact duration, so the video never outlasts the audio.
+
+    Args:
+        frame: uint8 RGB array of the image. Odd dimensions are cropped by a pixel since
+            yuv420p needs even sizes.
+        duration: Duration of the video in seconds.
+        output_path: Path of the video file to write.
+        audio_file_path: Optional audio track muxed into the video.
+        settings: Encoder settings, defaults to STILL_IMAGE_SETTINGS.
+        captions: Captions burnt into the video. They change on frame boundaries, so use a
+            frame rate of a few fps (see CAPTIONED_STILL_SETTINGS) for them to follow the speech.
+        progress: Called with the fraction of the frames written, see FramePipeEncoder.
+    """
+    height, width = frame.shape[:2]
+    frame = frame[:height - height % 2, :width - width % 2]
+    height, width = frame.shape[:2]
+    repeat = max(1, math.ceil(duration * settings.fps))
+    annotate(frames=repeat, size=f"{width}x{height}")
+    on_frames = (lambda written: progress(written / repeat)) if progress is not None else None
+    with FramePipeEncoder(output_path, (width, height), settings, audio_file_path, duration,
+                          progress=on_frames) as encoder:
+        write_captioned(encoder, np.ascontiguousarray(frame), 0, repeat, captions)
@@ -0,0 +1,165 @@
+import base64
+import hashlib
+import threading
+import contextvars
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from instrumentation.metrics import METRICS, annotate
+from outbound.scheduler import SCHEDULER, OutboundScheduler
+from storage.asset_store import AssetStore
+from video_generation.image_preprocessor import ImagePreprocessor
+
+# Square sizes the DALL·E 2 images endpoint can generate
+DALLE_SIZES = (256, 512, 1024)
+
+GeneratedImage = namedtuple("GeneratedImage", ["path", "frames"])
+
+
+def dalle_size(size: Tuple[int, int]) -> str:
+    """Smallest DALL·E size covering the longest side of `size`, the largest one if none does."""
+    side = next((side for side in DALLE_SIZES if side >= max(size)), DALLE_SIZES[-1])
+    return f"{side}x{side}"
+
+
+class DalleImageGenerator:
+    """
+    Generates images with the OpenAI images endpoint.
+
+    A prompt asks for up to MAX_IMAGES_PER_REQUEST images per request, and larger batches are
+    split into requests sent concurrently, at most `max_concurrency` in flight across all the
+    calls of the generator. Images come back base64 encoded by default, so there is no second
+    round trip; URL responses are downloaded on a pooled HTTP session. Every image is stored
+    under the hash of its contents and can be fitted to the video frame sizes from the bytes
+    in memory, filling the preprocessor cache without reading the file back.
+
+    Usage:
+        generator = DalleImageGenerator(api_key)
+        images = generator.generate("rusty old phone booth", n=4, frame_sizes=[Frames.INSTAGRAM_REEL])
+        video_generator.create_video([image.path for image in images], audio_file)
+    """
+
+    CATEGORY = "images"
+    MAX_IMAGES_PER_REQUEST = 10
+
+    def __init__(self, api_key: Optional[str] = None, asset_store: Optional[AssetStore] = None,
+                 image_preprocessor: Optional[ImagePreprocessor] = None, max_concurrency: int = 4,
+                 response_format: str = "b64_json", api_base: Optional[str] = None, timeout: float = 60,
+                 scheduler: Optional[OutboundScheduler] = None):
+        """
+        :param api_key: OpenAI API key, defaults to `openai.api_key`
+        :param asset_store: Store the generated images are saved in
+        :param image_preprocessor: Fits the images to frame sizes, defaults to one on the asset store
+        :param max_concurrency: Maximum number of requests in flight
+        :param response_format: "b64_json" to receive the images in the response, "url" to download them
+        :param api_base: Base URL of the API (e.g. a local stub), defaults to `openai.api_base`
+        :param timeout: Seconds to wait for an image download
+        :param scheduler: Rate limits and retries of the requests, defaults to the shared `SCHEDULER`
+        """
+        if response_format not in ("b64_json", "url"):
+            raise ValueError(f"Unknown response format {response_format}, expected b64_json or url")
+        self.api_key = api_key
+        self.asset_store = asset_store or AssetStore()
+        self.image_preprocessor = image_preprocessor or ImagePreprocessor(self.asset_store)
+        self.max_concurrency = max_concurrency
+        self.response_format = response_format
+        self.api_base = api_base
+        self.timeout = timeout
+        self.scheduler = scheduler or SCHEDULER
+        self._open()
+
+    def _open(self):
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+
+        # Downloads reuse their connections instead of opening one per image
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=self.max_concurrency))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=self.max_concurrency))
+
+    def __getstate__(self):
+        # Sent to the encode workers with the video generator, the limits and the connections are per process
+        state = dict(self.__dict__)
+        del state["_slots"], state["session"], state["scheduler"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.scheduler = SCHEDULER
+        self._open()
+
+    def _request(self, prompt: str, n: int, size: str, api_key: Optional[str]) -> List[bytes]:
+        # Imported on first use, openai is slow to import and the app starts without it
+        import openai
+
+        with self._slots, METRICS.span("dalle.request", images=n):
+            response = self.scheduler.call(
+                "dalle",
+                openai.Image.create,
+                units=n,
+                prompt=prompt,
+                n=n,
+                size=size,
+                response_format=self.response_format,
+                api_key=api_key or self.api_key or openai.api_key,
+                api_base=self.api_base or openai.api_base,
+            )
+            if self.response_format == "b64_json":
+                return [base64.b64decode(item["b64_json"]) for item in response["data"]]
+
+            images = []
+            for item in response["data"]:
+                with METRICS.span("dalle.download") as span:
+                    download = self.session.get(item["url"], timeout=self.timeout)
+                    download.raise_for_status()
+                    span.set(bytes=len(download.content))
+                images.append(download.content)
+            return images
+
+    def _store(self, image: bytes, prompt: str, frame_sizes: List[Tuple[int, int]], fit: str) -> GeneratedImage:
+        # Content-addressed, so every image gets its own file and a repeated image is stored once
+        key = hashlib.sha256(image).hexdigest()
+        path = self.asset_store.get(self.CATEGORY, key, ".png")
+        if not path:
+            path = self.asset_store.put_bytes(self.CATEGORY, key, ".png", image)
+            self.asset_store.catalog.record_image(path, "dalle", prompt)
+        frames = self.image_preprocessor.prepare_sizes(image, frame_sizes, fit) if frame_sizes else {}
+        return GeneratedImage(path, frames)
+
+    @METRICS.instrument("dalle.generate", lambda self, prompt, n=1, *args, **kwargs: {"images": n, "characters": len(prompt)})
+    def generate(self, prompt: str, n: int = 1, size: Tuple[int, int] = (1024, 1024),
+                 frame_sizes: Optional[List[Tuple[int, int]]] = None, fit: str = "crop",
+                 api_key: Optional[str] = None) -> List[GeneratedImage]:
+        """
+        :param prompt: Description of the images
+        :param n: Number of images
+        :param size: Size the images are meant for, the closest DALL·E size covering it is generated
+        :param frame_sizes: Video frame sizes to fit the images to right away, see `ImagePreprocessor.prepare_sizes`
+        :param fit: How the images are fitted to `frame_sizes`
+        :param api_key: API key of this call, defaults to the generator's
+        :return: The stored images with their frames keyed by size (empty without `frame_sizes`)
+        """
+        return self.generate_many([prompt], n, size, frame_sizes, fit, api_key)[0]
+
+    def generate_many(self, prompts: List[str], n: int = 1, size: Tuple[int, int] = (1024, 1024),
+                      frame_sizes: Optional[List[Tuple[int, int]]] = None, fit: str = "crop",
+                      api_key: Optional[str] = None) -> List[List[GeneratedImage]]:
+        """`generate` for several prompts, whose requests share the concurrency limit."""
+        batches = [(index, min(self.MAX_IMAGES_PER_REQUEST, n - start))
+                   for index in range(len(prompts)) for start in range(0, n, self.MAX_IMAGES_PER_REQUEST)]
+        annotate(requests=len(batches))
+
+        def run(batch):
+            index, count = batch
+            return [self._store(image, prompts[index], frame_sizes or [], fit)
+                    for image in self._request(prompts[index], count, dalle_size(size), api_key)]
+
+        results: Dict[int, List[GeneratedImage]] = {index: [] for index in range(len(prompts))}
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(batches)))) as pool:
+            futures = [pool.submit(contextvars.copy_context().run, run, batch) for batch in batches]
+            for (index, _), future in zip(batches, futures):
+                results[index].extend(future.result())
+        return [results[index] for index in range(len(prompts))]
@@ -0,0 +1,160 @@
+import io
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from instrumentation.metrics import METRICS
+from storage.asset_store import AssetStore
+
+# EXIF orientations that rotate the image by 90 or 270 degrees
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+FIT_MODES = ("crop", "fit", "stretch")
+
+
+class ImagePreprocessor:
+    """
+    Turns source images into frames of the exact video size.
+
+    JPEGs are decoded at a reduced scale with `Image.draft` (the decoder skips most of the work
+    for large phone photos), orientation from EXIF is applied and the image is fitted to the
+    frame without distortion. Frames are cached as raw arrays keyed by the source hash and the
+    target size, so re-rendering the same images at the same size skips decoding entirely.
+    """
+
+    CATEGORY = "frames"
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, max_workers: Optional[int] = None):
+        """
+        :param asset_store: Store the preprocessed frames are cached in
+        :param max_workers: Number of images decoded in parallel, defaults to the number of cores
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.max_workers = max_workers or os.cpu_count() or 1
+
+    @staticmethod
+    def frame_key(source_hash: str, size: Tuple[int, int], mode: str) -> str:
+        return AssetStore.hash_key("frame", source_hash, size, mode)
+
+    def prepare(self, image_path: str, size: Tuple[int, int], mode: str = "crop") -> np.ndarray:
+        """Return `image_path` as a uint8 RGB array of `size`.
+
+        Args:
+            image_path: Path of the source image.
+            size: Target (width, height).
+            mode: "crop" fills the frame and crops the overflow, "fit" letterboxes the whole
+                image on black, "stretch" resizes ignoring the aspect ratio.
+
+        Returns:
+            Read-only array of shape (height, width, 3).
+        """
+        return self.prepare_sizes(image_path, [size], mode)[tuple(size)]
+
+    def prepare_sizes(self, image_path, sizes: List[Tuple[int, int]], mode: str = "crop") -> Dict[tuple, np.ndarray]:
+        """Like `prepare` for several target sizes, decoding the source at most once.
+
+        Args:
+            image_path: Path of the source image, or its encoded bytes (e.g. an image that was
+                just downloaded), cached under the same key as the file holding those bytes.
+
+        Returns:
+            Frames keyed by size.
+        """
+        if mode not in FIT_MODES:
+            raise ValueError(f"Unknown fit mode {mode}, expected one of {FIT_MODES}")
+
+        if isinstance(image_path, bytes):
+            source_hash = hashlib.sha256(image_path).hexdigest()
+        else:
+            source_hash = AssetStore.hash_file(image_path)
+        frames = {}
+        missing = []
+        for size in dict.fromkeys(tuple(size) for size in sizes):
+            cached = self.asset_store.get(self.CATEGORY, self.frame_key(source_hash, size, mode), ".npy")
+            if cached:
+                frames[size] = np.load(cached, mmap_mode="r")
+            else:
+                missing.append(size)
+
+        if missing:
+            img = self.load(image_path, missing, mode)
+            for size in missing:
+                frame = self.fit(img, size, mode)
+                with self.asset_store.atomic_path(self.CATEGORY, self.frame_key(source_hash, size, mode), ".npy") as tmp_path:
+                    # np.save appends .npy to names without it, write through a file object instead
+                    with open(tmp_path, "wb") as f:
+                        np.save(f, frame)
+                frames[size] = frame
+        return frames
+
+    def prepare_many(self, image_paths: List[str], size: Tuple[int, int], mode: str = "crop") -> List[np.ndarray]:
+        """Prepare several images in parallel; the frames are returned in the order of `image_paths`."""
+        return [frames[tuple(size)] for frames in self.prepare_many_sizes(image_paths, [size], mode)]
+
+    @METRICS.instrument("preprocess.prepare_many_sizes", lambda self, image_paths, sizes, *args, **kwargs: {
+        "images": len(image_paths), "sizes": len(sizes)})
+    def prepare_many_sizes(self, image_paths: List[str], sizes: List[Tuple[int, int]],
+                           mode: str = "crop") -> List[Dict[tuple, np.ndarray]]:
+        """`prepare_sizes` for several images in parallel, in the order of `image_paths`."""
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(1, len(image_paths)))) as pool:
+            return list(pool.map(lambda path: self.prepare_sizes(path, sizes, mode), image_paths))
+
+    @staticmethod
+    def load(image, sizes: List[Tuple[int, int]], mode: str = "crop") -> Image.Image:
+        """Open an image and decode it at the smallest scale that still serves every size in `sizes`.
+
+        :param image: Path, bytes or an opened PIL image
+        :param sizes: Target (width, height) sizes the image will be fitted to
+        :param mode: See `prepare`
+        :return: Upright RGB PIL image
+        """
+        if isinstance(image, bytes):
+            image = io.BytesIO(image)
+        img = image if isinstance(image, Image.Image) else Image.open(image)
+
+        if img.format == "JPEG":
+            width, height = img.size
+            transposed = img.getexif().get(0x0112) in TRANSPOSED_ORIENTATIONS
+            draft_width, draft_height = 0, 0
+            for target_width, target_height in sizes:
+                if transposed:
+                    # Width and height swap once the orientation is applied
+                    target_width, target_height = target_height, target_width
+                # Smallest size the image can be decoded at and still cover (crop) or fill (fit) the target
+                if mode == "crop":
+                    scale = max(target_width / width, target_height / height)
+                    needed = (int(width * scale + 1), int(height * scale + 1))
+                elif mode == "fit":
+                    scale = min(target_width / width, target_height / height)
+                    needed = (int(width * scale + 1), int(height * scale + 1))
+                else:
+                    needed = (target_width, target_height)
+                draft_width, draft_height = max(draft_width, needed[0]), max(draft_height, needed[1])
+            img.draft("RGB", (draft_width, draft_height))
+
+        return ImageOps.exif_transpose(img).convert("RGB")
+
+    @staticmethod
+    def fit(img: Image.Image, size: Tuple[int, int], mode: str = "crop") -> np.ndarray:
+        """
+        :param img: Image returned by `load`
+        :param size: Target (width, height)
+        :param mode: See `prepare`
+        :return: uint8 RGB array of shape (height, width, 3)
+        """
+        if mode == "crop":
+            img = ImageOps.fit(img, size, Image.LANCZOS)
+        elif mode == "fit":
+            img = ImageOps.pad(img, size, Image.LANCZOS, color=(0, 0, 0))
+        else:
+            img = img.resize(size, Image.LANCZOS)
+        return np.asarray(img)
+
+    @classmethod
+    def decode(cls, image, size: Tuple[int, int], mode: str = "crop") -> np.ndarray:
+        """Load and fit an image without going through the cache."""
+        return cls.fit(cls.load(image, [size], mode), size, mode)
@@ -0,0 +1,223 @@
+import math
+from dataclasses import dataclass, asdict
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from instrumentation.metrics import METRICS, annotate
+from video_generation.encoder import EncoderSettings, FramePipeEncoder, slide_frame_counts
+from video_generation.subtitles import CaptionRenderer
+
+# Zoom direction and pan anchors of consecutive slides: (start zoom is the full image, start
+# anchor, end anchor). Anchors place the window in the slack of the source, (0.5, 0.5) is centred.
+KEN_BURNS_PATHS = (
+    (True, (0.5, 0.5), (0.5, 0.5)),
+    (False, (0.0, 0.5), (1.0, 0.5)),
+    (True, (0.5, 0.0), (0.5, 1.0)),
+    (False, (1.0, 0.5), (0.0, 0.5)),
+)
+
+
+@dataclass(frozen=True)
+class MotionSettings:
+    """Ken Burns pan/zoom and crossfades of a slideshow."""
+
+    # Zoom factor between the widest and the tightest framing of a slide, 1 disables pan/zoom
+    zoom: float = 1.15
+    # Pan across the image while zooming, otherwise zoom towards the centre
+    pan: bool = True
+    # Seconds each transition takes, 0 for hard cuts
+    crossfade: float = 0.5
+    # The slides are sampled from a copy this many times larger than the motion source, so the
+    # nearest-pixel lookups land within 1/supersample of a pixel and the motion doesn't jitter
+    supersample: int = 2
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def source_size(self, frame_size: Tuple[int, int]) -> Tuple[int, int]:
+        """Size the images are prepared at: the frame size at the tightest zoom, in even pixels."""
+        width, height = frame_size
+        return 2 * math.ceil(width * self.zoom / 2), 2 * math.ceil(height * self.zoom / 2)
+
+
+def ken_burns_boxes(count: int, source_size: Tuple[int, int], frame_size: Tuple[int, int],
+                    zoom_in: bool, start: Tuple[float, float], end: Tuple[float, float]) -> np.ndarray:
+    """
+    Crop boxes of the source for every frame of a slide, i.e. the affine (scale and
+    translation) mapping the source onto each frame.
+
+    :param count: Number of frames of the slide
+    :param source_size: (width, height) of the source image
+    :param frame_size: (width, height) of the frames, the tightest crop is 1:1 with the source
+    :param zoom_in: Start on the whole source and end on the tightest crop, or the other way round
+    :param start: Anchor of the window in the slack of the source on the first frame
+    :param end: Anchor of the window on the last frame
+    :return: float array of shape (count, 4) with the (left, top, right, bottom) of every frame
+    """
+    source_width, source_height = source_size
+    progress = np.linspace(0.0, 1.0, count) if count > 1 else np.zeros(1)
+    tightest = min(frame_size[0] / source_width, frame_size[1] / source_height)
+    scale = 1.0 + (tightest - 1.0) * (progress if zoom_in else 1.0 - progress)
+
+    width, height = source_width * scale, source_height * scale
+    anchor_x = start[0] + (end[0] - start[0]) * progress
+    anchor_y = start[1] + (end[1] - start[1]) * progress
+    left = (source_width - width) * anchor_x
+    top = (source_height - height) * anchor_y
+    return np.stack([left, top, left + width, top + height], axis=1)
+
+
+class MotionRenderer:
+    """
+    Synthesizes the frames of a slideshow with Ken Burns pan/zoom and crossfades.
+
+    Everything that doesn't depend on the pixels is precomputed: the crop box of every frame of
+    every slide and the blend weight of every transition frame. Each frame is then one
+    nearest-pixel resample of a supersampled copy of the slide (two during a transition),
+    pasted into a frame buffer shared with NumPy, plus an integer blend into preallocated
+    scratch arrays. The same buffer is yielded for every frame and at most two slides are kept
+    in memory. The resample returns a new frame-sized image, the one allocation per frame and
+    slide: PIL's nearest resize followed by the paste takes half the time of a NumPy gather
+    (`np.take` with precomputed indices) writing into the buffer directly.
+
+    Frames are RGBX (4 bytes per pixel), to be encoded with input pixel format "rgb0".
+    """
+
+    PIX_FMT = "rgb0"
+
+    def __init__(self, sources: List[np.ndarray], durations: List[float], frame_size: Tuple[int, int],
+                 fps: float, motion: MotionSettings = MotionSettings()):
+        """
+        :param sources: One uint8 RGB array per slide, of `motion.source_size(frame_size)`. Slides
+            outside the range rendered by `frames` (and its crossfades) may be None
+        :param durations: Duration of each slide in seconds
+        :param frame_size: (width, height) of the frames
+        :param fps: Frame rate
+        :param motion: Pan/zoom and transition settings
+        """
+        self.sources = sources
+        self.frame_size = tuple(frame_size)
+        self.motion = motion
+
+        counts = slide_frame_counts(durations, fps)
+        self.bounds = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        self.total_frames = int(self.bounds[-1])
+        self.fade = self.fade_frames(counts, fps, motion)
+
+        self.visible = []
+        self.boxes = []
+        for index in range(len(sources)):
+            first = self.bounds[index] - (self.fade if index > 0 else 0)
+            last = self.bounds[index + 1] + (self.fade if index < len(sources) - 1 else 0)
+            zoom_in, start, end = KEN_BURNS_PATHS[index % len(KEN_BURNS_PATHS)]
+            if not motion.pan:
+                start = end = (0.5, 0.5)
+            boxes = ken_burns_boxes(last - first, motion.source_size(self.frame_size), self.frame_size,
+                                    zoom_in, start, end)
+            self.visible.append((first, last))
+            self.boxes.append(boxes * motion.supersample)
+
+        # Weight of the incoming slide on each frame of a transition, out of 256
+        steps = 2 * self.fade
+        self.weights = ((np.arange(steps) + 0.5) / max(steps, 1) * 256).astype(np.uint16)
+
+        width, height = self.frame_size
+        self.buffer = np.zeros((height, width, 4), dtype=np.uint8)
+        self._incoming = np.zeros_like(self.buffer)
+        self._canvas = self._shared_image(self.buffer)
+        self._incoming_canvas = self._shared_image(self._incoming)
+        self._scratch = np.empty(self.buffer.shape, dtype=np.uint16)
+        self._scratch_incoming = np.empty(self.buffer.shape, dtype=np.uint16)
+        self._supersampled = {}
+
+    @staticmethod
+    def fade_frames(counts: List[int], fps: float, motion: MotionSettings) -> int:
+        """Frames each side of a cut that belong to its crossfade, never more than half a slide."""
+        return min([int(round(motion.crossfade * fps / 2))] + [count // 2 for count in counts])
+
+    @staticmethod
+    def _shared_image(buffer: np.ndarray) -> Image.Image:
+        height, width = buffer.shape[:2]
+        image = Image.frombuffer("RGBX", (width, height), buffer, "raw", "RGBX", 0, 1)
+        # frombuffer maps the array read-only, pasting into it writes straight into `buffer`
+        image.readonly = 0
+        return image
+
+    def _slide(self, index: int) -> Image.Image:
+        if index not in self._supersampled:
+            # Only the slides of the current frame are kept
+            for stale in [i for i in self._supersampled if i < index - 1]:
+                del self._supersampled[stale]
+            source = Image.fromarray(np.ascontiguousarray(self.sources[index])).convert("RGBX")
+            factor = self.motion.supersample
+            if factor > 1:
+                source = source.resize((source.width * factor, source.height * factor), Image.BICUBIC)
+            self._supersampled[index] = source
+        return self._supersampled[index]
+
+    def _draw(self, index: int, frame: int, canvas: Image.Image):
+        box = self.boxes[index][frame - self.visible[index][0]]
+        canvas.paste(self._slide(index).resize(self.frame_size, Image.NEAREST, box=tuple(box)))
+
+    def _blend(self, weight: int):
+        # buffer = (buffer * (256 - weight) + incoming * weight) / 256, in preallocated uint16
+        np.multiply(self.buffer, 256 - weight, out=self._scratch, dtype=np.uint16)
+        np.multiply(self._incoming, weight, out=self._scratch_incoming, dtype=np.uint16)
+        np.add(self._scratch, self._scratch_incoming, out=self._scratch)
+        np.right_shift(self._scratch, 8, out=self._scratch)
+        np.copyto(self.buffer, self._scratch, casting="unsafe")
+
+    def frames(self, first_slide: int = 0, last_slide: Optional[int] = None) -> Iterator[np.ndarray]:
+        """
+        :param first_slide: First slide rendered, e.g. the start of a segment
+        :param last_slide: Slide the rendering stops before, defaults to the end
+
+        Yields:
+            The frame buffer, of shape (height, width, 4), once per frame of those slides. It is
+            overwritten by the next frame, consume it (e.g. write it to the encoder) before advancing.
+        """
+        last_slide = len(self.sources) if last_slide is None else last_slide
+        for index in range(first_slide, last_slide):
+            start, end = self.bounds[index], self.bounds[index + 1]
+            for frame in range(start, end):
+                self._draw(index, frame, self._canvas)
+                if index > 0 and frame < start + self.fade:
+                    # Second half of the transition from the previous slide
+                    self._draw(index - 1, frame, self._incoming_canvas)
+                    self._blend(256 - int(self.weights[frame - start + self.fade]))
+                elif index < len(self.sources) - 1 and frame >= end - self.fade:
+                    # First half of the transition to the next slide
+                    self._draw(index + 1, frame, self._incoming_canvas)
+                    self._blend(int(self.weights[frame - end + self.fade]))
+                yield self.buffer
+
+
+@METRICS.instrument("encode.motion", lambda sources, durations, *args, **kwargs: {
+    "images": len(sources), "audio_seconds": sum(durations)})
+def encode_motion_slideshow(sources: List[np.ndarray], durations: List[float], output_path: str,
+                            frame_size: Tuple[int, int], audio_file_path: Optional[str] = None,
+                            settings: EncoderSettings = EncoderSettings(), motion: MotionSettings = MotionSettings(),
+                            copy_audio: bool = False, captions: Optional[CaptionRenderer] = None):
+    """Encode a slideshow with pan/zoom and crossfades, streaming the frames to ffmpeg.
+
+    Args:
+        sources: One uint8 RGB array per slide, of `motion.source_size(frame_size)`.
+        durations: Duration of each slide in seconds.
+        output_path: Path of the video file to write.
+        frame_size: (width, height) of the video.
+        audio_file_path: Optional audio track muxed into the video.
+        settings: Encoder settings.
+        motion: Pan/zoom and transition settings.
+        copy_audio: The audio track is already encoded, mux it with stream copy.
+        captions: Captions burnt into the video.
+    """
+    renderer = MotionRenderer(sources, durations, frame_size, settings.fps, motion)
+    annotate(frames=renderer.total_frames, size=f"{frame_size[0]}x{frame_size[1]}")
+    with FramePipeEncoder(output_path, frame_size, settings, audio_file_path, copy_audio=copy_audio,
+                          input_pix_fmt=MotionRenderer.PIX_FMT) as encoder:
+        for index, frame in enumerate(renderer.frames()):
+            if captions is not None:
+                captions.draw(frame, index)
+            encoder.write_frame(frame)
@@ -0,0 +1,279 @@
+import os
+import math
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from imageio_ffmpeg import get_ffmpeg_exe
+
+from instrumentation.metrics import METRICS, annotate
+from storage.asset_store import AssetStore
+from video_generation.encoder import (FASTSTART, EncoderSettings, FramePipeEncoder, encode_slideshow, slide_frame_counts,
+                                      write_captioned)
+from video_generation.motion import KEN_BURNS_PATHS, MotionRenderer, MotionSettings, encode_motion_slideshow
+from video_generation.subtitles import CaptionRenderer, Cue
+
+# Process pools of this process by size, kept for the following renders since starting the
+# workers (a fresh interpreter each) costs about a second
+_POOLS: Dict[int, ProcessPoolExecutor] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _pool(workers: int) -> ProcessPoolExecutor:
+    with _POOLS_LOCK:
+        if workers not in _POOLS:
+            # Never fork, renders may run in the (multi-threaded) Streamlit server
+            _POOLS[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return _POOLS[workers]
+
+
+def _frame_progress(progress: Optional[Callable[[float], None]], count: int) -> Optional[Callable[[int], None]]:
+    """FramePipeEncoder progress callback reporting the fraction of a segment of `count` frames."""
+    if progress is None:
+        return None
+    return lambda written: progress(written / max(1, count))
+
+
+def _encode_still_segment(frame: np.ndarray, count: int, start: int, output_path: str,
+                          settings: EncoderSettings, cues: Optional[List[Cue]],
+                          progress: Optional[Callable[[float], None]] = None) -> List[dict]:
+    recorded = METRICS.recorded
+    height, width = frame.shape[:2]
+    with METRICS.span("encode.segment", images=1, frames=count):
+        captions = CaptionRenderer(cues, (width, height), settings.fps) if cues else None
+        with FramePipeEncoder(output_path, (width, height), settings,
+                              progress=_frame_progress(progress, count)) as encoder:
+            write_captioned(encoder, frame, start, count, captions)
+    # Worker processes report their spans to the parent, whose metrics they don't share
+    return METRICS.spans_since(recorded)
+
+
+def _encode_motion_segment(sources: List[Optional[np.ndarray]], durations: List[float], slide: int,
+                           output_path: str, frame_size: Tuple[int, int], settings: EncoderSettings,
+                           motion: MotionSettings, cues: Optional[List[Cue]],
+                           progress: Optional[Callable[[float], None]] = None) -> List[dict]:
+    recorded = METRICS.recorded
+    with METRICS.span("encode.segment", images=1):
+        renderer = MotionRenderer(sources, durations, frame_size, settings.fps, motion)
+        captions = CaptionRenderer(cues, frame_size, settings.fps) if cues else None
+        start = int(renderer.bounds[slide])
+        count = int(renderer.bounds[slide + 1]) - start
+        annotate(frames=count)
+        with FramePipeEncoder(output_path, frame_size, settings, input_pix_fmt=MotionRenderer.PIX_FMT,
+                              progress=_frame_progress(progress, count)) as encoder:
+            for index, frame in enumerate(renderer.frames(slide, slide + 1), start):
+                if captions is not None:
+                    captions.draw(frame, index)
+                encoder.write_frame(frame)
+    return METRICS.spans_since(recorded)
+
+
+@METRICS.instrument("encode.concat", lambda segment_paths, *args, **kwargs: {"segments": len(segment_paths)})
+def concat_segments(segment_paths: List[str], output_path: str, audio_file_path: Optional[str] = None,
+                    settings: EncoderSettings = EncoderSettings(), copy_audio: bool = False):
+    """Join video-only segments without re-encoding them and mux the audio track over the whole video.
+
+    Args:
+        segment_paths: Segments in order, encoded with the same settings.
+        output_path: Path of the video file to write.
+        audio_file_path: Optional audio track muxed into the video.
+        settings: Encoder settings, for the audio codec.
+        copy_audio: The audio track is already encoded, mux it with stream copy.
+    """
+    fd, list_path = tempfile.mkstemp(prefix=".concat.", suffix=".txt", dir=os.path.dirname(output_path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            for path in segment_paths:
+                escaped = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+        cmd = [get_ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+        if audio_file_path:
+            cmd += ["-i", audio_file_path]
+        cmd += ["-map", "0:v", "-c:v", "copy"]
+        if audio_file_path and copy_audio:
+            cmd += ["-map", "1:a", "-c:a", "copy"]
+        elif audio_file_path:
+            cmd += ["-map", "1:a", "-c:a", settings.audio_codec, "-b:a", settings.audio_bitrate]
+        cmd += FASTSTART
+        cmd.append(output_path)
+
+        result = subprocess.run(cmd, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise IOError(f"ffmpeg failed to concatenate {output_path}: {result.stderr.decode(errors='replace').strip()}")
+    finally:
+        os.remove(list_path)
+
+
+class SegmentedEncoder:
+    """
+    Encodes slideshows one slide per segment, in parallel across the cores.
+
+    Every slide is synthesized and encoded (video only) as its own segment in a worker process,
+    with the cores shared between the workers' encoder threads. The segments are then joined
+    with stream copy and the audio is muxed once over the whole video. x264 scales poorly past
+    a few threads per encode, so on many cores several smaller encodes keep all of them busy.
+
+    Segments are keyed on everything that shows in their frames (see `segment_keys`), so a
+    caller storing them only encodes the slides that changed since the last render: swapping
+    an image re-encodes that slide (and, with crossfades, its neighbours) and re-joins the rest.
+
+    Usage:
+        encoder = SegmentedEncoder()
+        encoder.encode_slideshow(frames, durations, output_path, audio_track, auto_settings(), copy_audio=True)
+    """
+
+    CATEGORY = "segments"
+
+    def __init__(self, cores: Optional[int] = None, threads_per_segment: int = 4):
+        """
+        :param cores: Cores the encodes may use, defaults to all of them
+        :param threads_per_segment: Encoder threads of every segment, which sets the number of workers
+        """
+        self.cores = max(1, cores or os.cpu_count() or 1)
+        self.threads_per_segment = threads_per_segment
+
+    @property
+    def workers(self) -> int:
+        return max(1, self.cores // self.threads_per_segment)
+
+    def segment_keys(self, slide_ids: List[str], durations: List[float], frame_size: Tuple[int, int],
+                     settings: EncoderSettings, context=None, captions: Optional[List[Cue]] = None,
+                     motion: Optional[MotionSettings] = None) -> List[str]:
+        """
+        Content keys of the segment of every slide.
+
+        :param slide_ids: Content hash of the image of every slide
+        :param durations: Duration of each slide in seconds
+        :param frame_size: (width, height) of the video
+        :param settings: Encoder settings, the audio fields and threads are ignored
+        :param context: Anything else that changes the frames (e.g. how the images were fitted)
+        :param captions: Caption cues burnt into the video, each segment depends on the ones it shows
+        :param motion: Pan/zoom and crossfades, still slides when None
+        :return: One key per slide
+        """
+        counts = slide_frame_counts(durations, settings.fps)
+        bounds = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        video_settings = {name: value for name, value in settings.as_dict().items() if not name.startswith("audio_")}
+        cue_frames = [(round(cue.start * settings.fps), round(cue.end * settings.fps), cue.text) for cue in captions or []]
+        fade = MotionRenderer.fade_frames(counts, settings.fps, motion) if motion else 0
+
+        keys = []
+        for index, (start, end) in enumerate(zip(bounds, bounds[1:])):
+            # Captions relative to the segment, so a slide showing the same captions after a shift is reused
+            cues = [(max(first, start) - start, min(last, end) - start, text)
+                    for first, last, text in cue_frames if first < end and last > start]
+            if motion:
+                # Crossfades show the neighbours, whose zoom path follows their own position and length
+                neighbours = range(max(0, index - 1), min(len(counts), index + 2))
+                slide = dict(images=[slide_ids[i] for i in neighbours], counts=[counts[i] for i in neighbours],
+                             first=index == 0, last=index == len(counts) - 1, fade=fade,
+                             path=index % len(KEN_BURNS_PATHS), motion=motion.as_dict())
+            else:
+                slide = dict(image=slide_ids[index], count=int(counts[index]))
+            keys.append(AssetStore.hash_key("segment", frame_size, video_settings, context, slide, cues))
+        return keys
+
+    def encode_segments(self, frames: List[Optional[np.ndarray]], durations: List[float], outputs: Dict[int, str],
+                        frame_size: Tuple[int, int], settings: EncoderSettings = EncoderSettings(),
+                        captions: Optional[List[Cue]] = None, motion: Optional[MotionSettings] = None,
+                        progress: Optional[Callable[[float], None]] = None):
+        """
+        Encode the segments of some slides, in parallel.
+
+        :param frames: One uint8 RGB array per slide, of the frame size, or of `motion.source_size(frame_size)`
+            with motion. Only the slides encoded (and, with motion, their neighbours) are needed, the others may be None
+        :param durations: Duration of each slide in seconds
+        :param outputs: Path to write the segment of each slide to encode, by slide index
+        :param frame_size: (width, height) of the video
+        :param settings: Encoder settings
+        :param captions: Caption cues burnt into the video
+        :param motion: Pan/zoom and crossfades, still slides when None
+        :param progress: Called with the fraction of the segments encoded, after each segment, and within
+            a segment every `PROGRESS_FRAMES` frames when there is a single worker. An exception it raises
+            (e.g. the job was cancelled) stops the encode: the segment in progress is aborted and the
+            queued ones are dropped
+        """
+        if not outputs:
+            return
+        counts = slide_frame_counts(durations, settings.fps)
+        bounds = np.concatenate([[0], np.cumsum(counts)]).astype(int)
+        workers = min(self.workers, len(outputs))
+        segment_settings = replace(settings, threads=max(1, math.ceil(self.cores / workers)))
+        annotate(segments=len(outputs), workers=workers)
+
+        jobs = []
+        for index, path in sorted(outputs.items()):
+            if motion is not None:
+                # Only the slide and the neighbours it crossfades with are sent
+                sources = [frame if index - 1 <= i <= index + 1 else None for i, frame in enumerate(frames)]
+                jobs.append((_encode_motion_segment, sources, durations, index, path, frame_size, segment_settings,
+                             motion, captions))
+            else:
+                jobs.append((_encode_still_segment, frames[index], counts[index], int(bounds[index]), path,
+                             segment_settings, captions))
+
+        if workers == 1:
+            # Not worth the worker processes, the spans are recorded here already
+            for done, (fn, *args) in enumerate(jobs):
+                segment_progress = None
+                if progress is not None:
+                    segment_progress = lambda fraction, done=done: progress((done + fraction) / len(jobs))
+                fn(*args, progress=segment_progress)
+                if progress is not None:
+                    progress((done + 1) / len(jobs))
+            return
+
+        # The callback can't be sent to the workers, progress is reported as their segments finish
+        pool = _pool(workers)
+        futures = [pool.submit(*job) for job in jobs]
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                for span in future.result():
+                    METRICS.record(span, trace=False)
+                if progress is not None:
+                    progress(done / len(jobs))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def encode_slideshow(self, frames: List[np.ndarray], durations: List[float], output_path: str,
+                         audio_file_path: Optional[str] = None, settings: EncoderSettings = EncoderSettings(),
+                         copy_audio: bool = False, captions: Optional[List[Cue]] = None,
+                         motion: Optional[MotionSettings] = None, frame_size: Optional[Tuple[int, int]] = None):
+        """
+        Encode a whole slideshow without keeping the segments, see `encode_slideshow` and
+        `encode_motion_slideshow`. A single worker encodes it in one pass instead.
+
+        :param frames: One uint8 RGB array per slide, of the frame size, or of `motion.source_size(frame_size)` with motion
+        :param durations: Duration of each slide in seconds
+        :param output_path: Path of the video file to write
+        :param audio_file_path: Optional audio track muxed into the video
+        :param settings: Encoder settings
+        :param copy_audio: The audio track is already encoded, mux it with stream copy
+        :param captions: Caption cues burnt into the video
+        :param motion: Pan/zoom and crossfades, still slides when None
+        :param frame_size: (width, height) of the video, required with motion
+        """
+        frame_size = tuple(frame_size or (frames[0].shape[1], frames[0].shape[0]))
+        if self.workers == 1 or len(frames) == 1:
+            caption_renderer = CaptionRenderer(captions, frame_size, settings.fps) if captions else None
+            if motion is not None:
+                encode_motion_slideshow(frames, durations, output_path, frame_size, audio_file_path, settings, motion,
+                                        copy_audio=copy_audio, captions=caption_renderer)
+            else:
+                encode_slideshow(frames, durations, output_path, audio_file_path, settings, copy_audio=copy_audio,
+                                 captions=caption_renderer)
+            return
+
+        # Next to the output so the segments are on the same disk, dot-prefixed like other in-progress files
+        with tempfile.TemporaryDirectory(prefix=".segments.", dir=os.path.dirname(output_path)) as tmp_dir:
+            paths = [os.path.join(tmp_dir, f"{index:04d}.mp4") for index in range(len(frames))]
+            self.encode_segments(frames, durations, dict(enumerate(paths)), frame_size, settings, captions, motion)
+            concat_segments(paths, output_path, audio_file_path, settings, copy_audio)
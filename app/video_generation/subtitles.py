@@ -0,0 +1,228 @@
+import os
+import math
+import logging
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from voice_generation.text_chunking import split_sentences
+
+logger = logging.getLogger(__name__)
+
+# Fonts tried in order for burnt-in captions, CAPTION_FONT (a .ttf path) takes precedence
+CAPTION_FONTS = [
+    "DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf",
+    "/usr/share/fonts/TTF/DejaVuSans-Bold.ttf",
+    "/Library/Fonts/Arial Bold.ttf",
+    "C:/Windows/Fonts/arialbd.ttf",
+]
+
+Cue = namedtuple("Cue", ["start", "end", "text"])
+
+
+def _weight(text: str) -> int:
+    # Speech time follows the spoken characters better than the raw length
+    return max(1, sum(1 for char in text if char.isalnum()))
+
+
+def wrap_caption(text: str, max_chars: int = 42, max_lines: int = 2) -> List[str]:
+    """
+    Break a sentence into captions of at most `max_lines` lines of `max_chars` characters.
+
+    :return: Captions in reading order, lines separated by newlines
+    """
+    lines, line = [], ""
+    for word in text.split():
+        if line and len(line) + 1 + len(word) > max_chars:
+            lines.append(line)
+            line = word
+        else:
+            line = f"{line} {word}" if line else word
+    if line:
+        lines.append(line)
+    return ["\n".join(lines[start:start + max_lines]) for start in range(0, len(lines), max_lines)]
+
+
+def sentence_cues(sentences: List[str], durations: List[float], total: Optional[float] = None,
+                  max_chars: int = 42, max_lines: int = 2) -> List[Cue]:
+    """
+    Caption cues from the duration of every sentence, i.e. the TTS chunks the audio was built from.
+
+    :param sentences: Sentences in story order
+    :param durations: Seconds of audio of each sentence
+    :param total: Length of the whole audio; the timings are scaled to it so the last cue ends with
+        the audio even if the chunk durations are estimates
+    :param max_chars: Characters per caption line
+    :param max_lines: Lines per caption, longer sentences are split over several captions
+    """
+    measured = sum(durations)
+    scale = total / measured if total and measured else 1.0
+
+    cues = []
+    start = 0.0
+    for sentence, duration in zip(sentences, durations):
+        end = start + duration * scale
+        captions = wrap_caption(sentence, max_chars, max_lines)
+        weights = np.cumsum([0] + [_weight(caption) for caption in captions])
+        # The captions of a sentence share its time in proportion to their length
+        bounds = start + (end - start) * weights / weights[-1]
+        cues.extend(Cue(float(bounds[i]), float(bounds[i + 1]), caption) for i, caption in enumerate(captions))
+        start = end
+    return cues
+
+
+def proportional_cues(text: str, total: float, max_chars: int = 42, max_lines: int = 2) -> List[Cue]:
+    """
+    Caption cues when the per-sentence timings are unknown (e.g. a voice clone synthesized in one
+    request): the audio is shared between the sentences in proportion to their length.
+    """
+    sentences = split_sentences(text)
+    return sentence_cues(sentences, [_weight(sentence) for sentence in sentences], total, max_chars, max_lines)
+
+
+def _timestamp(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
+
+
+def to_srt(cues: List[Cue]) -> str:
+    return "".join(f"{index}\n{_timestamp(cue.start)} --> {_timestamp(cue.end)}\n{cue.text}\n\n"
+                   for index, cue in enumerate(cues, 1))
+
+
+def load_caption_font(size: int) -> Optional[ImageFont.FreeTypeFont]:
+    """The first TrueType font found, None if the system has none."""
+    candidates = [os.environ["CAPTION_FONT"]] if os.environ.get("CAPTION_FONT") else []
+    for candidate in candidates + CAPTION_FONTS:
+        try:
+            return ImageFont.truetype(candidate, size)
+        except OSError:
+            continue
+    return None
+
+
+def _text_box(text: str, font, **kwargs) -> Tuple[int, int, int, int]:
+    bbox = ImageDraw.Draw(Image.new("L", (1, 1))).multiline_textbbox((0, 0), text, font=font, align="center", **kwargs)
+    # Centred lines can start at fractional offsets, round the box outwards to whole pixels
+    return math.floor(bbox[0]), math.floor(bbox[1]), math.ceil(bbox[2]), math.ceil(bbox[3])
+
+
+class CaptionRenderer:
+    """
+    Burns captions into video frames.
+
+    Each caption is rasterized once, the first time it is shown, into a premultiplied RGBA
+    sprite the size of its text. Drawing it into a frame is an integer alpha blend of that
+    sprite's rectangle only, so captions cost next to nothing per frame and need no text
+    rendering per frame.
+
+    Usage:
+        captions = CaptionRenderer(cues, (1080, 1920), fps=30)
+        for index, frame in enumerate(frames):
+            captions.draw(frame, index)
+    """
+
+    def __init__(self, cues: List[Cue], frame_size: Tuple[int, int], fps: float, font_size: Optional[int] = None,
+                 color: Tuple[int, int, int] = (255, 255, 255), outline: Tuple[int, int, int] = (0, 0, 0),
+                 bottom_margin: float = 0.12, max_width: float = 0.92):
+        """
+        :param cues: Captions with their times in seconds
+        :param frame_size: (width, height) of the frames
+        :param fps: Frame rate, the cues are shown on the frames starting within their time
+        :param font_size: Height of the text in pixels, defaults to a size readable on phones
+        :param color: Text color
+        :param outline: Color of the outline keeping the text readable on any image
+        :param bottom_margin: Distance of the captions from the bottom, in fractions of the height
+        :param max_width: Widest caption, in fractions of the width
+        """
+        self.cues = cues
+        self.frame_size = tuple(frame_size)
+        self.font_size = font_size or max(16, round(min(frame_size) / 24))
+        self.color = color
+        self.outline = outline
+        self.bottom_margin = bottom_margin
+        self.max_width = max_width
+
+        # First frame of every cue and the first frame after it
+        self.frames = np.array([[round(cue.start * fps), round(cue.end * fps)] for cue in cues], dtype=int).reshape(-1, 2)
+        self.font = load_caption_font(self.font_size)
+        if self.font is None:
+            logger.warning("No TrueType font found for captions, set CAPTION_FONT to a .ttf file")
+        self._sprite = (None, None)
+
+    def cue_at(self, frame: int) -> Optional[int]:
+        """Index of the cue shown on `frame`, None between cues."""
+        index = int(np.searchsorted(self.frames[:, 0], frame, side="right")) - 1
+        if index >= 0 and frame < self.frames[index, 1]:
+            return index
+        return None
+
+    def boundaries(self, start: int, end: int) -> List[int]:
+        """Frames in [start, end) where the caption changes, starting with `start`."""
+        changes = self.frames[(self.frames > start) & (self.frames < end)]
+        return sorted({start, *changes.tolist()})
+
+    def _rasterize(self, text: str) -> Image.Image:
+        stroke = max(1, self.font_size // 12)
+        if self.font is not None:
+            left, top, right, bottom = _text_box(text, self.font, stroke_width=stroke)
+            sprite = Image.new("RGBA", (right - left, bottom - top))
+            ImageDraw.Draw(sprite).multiline_text((-left, -top), text, font=self.font, fill=self.color,
+                                                  stroke_width=stroke, stroke_fill=self.outline, align="center")
+            return sprite
+
+        # The built-in bitmap font has a single small size and no outline, scale it up instead
+        font = ImageFont.load_default()
+        left, top, right, bottom = _text_box(text, font)
+        sprite = Image.new("RGBA", (right - left + 2, bottom - top + 2))
+        draw = ImageDraw.Draw(sprite)
+        for dx, dy in ((0, 0), (2, 0), (0, 2), (2, 2)):
+            draw.multiline_text((dx - left, dy - top), text, font=font, fill=self.outline, align="center")
+        draw.multiline_text((1 - left, 1 - top), text, font=font, fill=self.color, align="center")
+        factor = max(1, round(self.font_size / max(1, bottom - top)))
+        return sprite.resize((sprite.width * factor, sprite.height * factor), Image.NEAREST)
+
+    def sprite(self, index: int):
+        """
+        :return: ((x, y) of the sprite in the frame, 256 - alpha as uint16 (h, w, 1),
+            color premultiplied by alpha as uint16 (h, w, 3), blend scratch)
+        """
+        if self._sprite[0] != index:
+            image = self._rasterize(self.cues[index].text)
+            width, height = self.frame_size
+            # Captions wider than the safe area of the frame are scaled down to fit
+            max_width = int(width * self.max_width)
+            if image.width > max_width:
+                image = image.resize((max_width, max(1, round(image.height * max_width / image.width))), Image.LANCZOS)
+            x = (width - image.width) // 2
+            y = max(0, round(height * (1 - self.bottom_margin)) - image.height)
+            rgba = np.asarray(image, dtype=np.uint16)[:height - y]
+            alpha = rgba[..., 3:] + (rgba[..., 3:] >> 7)  # 0..255 to 0..256
+            self._sprite = (index, ((x, y), 256 - alpha, rgba[..., :3] * alpha, np.empty_like(rgba[..., :3])))
+        return self._sprite[1]
+
+    def draw(self, frame: np.ndarray, index: int) -> bool:
+        """
+        Blend the caption of frame `index` into `frame` in place.
+
+        :param frame: uint8 RGB or RGBX array of shape (height, width, 3 or 4)
+        :return: Whether a caption was drawn
+        """
+        cue = self.cue_at(index)
+        if cue is None:
+            return False
+        (x, y), inverse_alpha, premultiplied, scratch = self.sprite(cue)
+        height, width = inverse_alpha.shape[:2]
+        region = frame[y:y + height, x:x + width, :3]
+        np.multiply(region, inverse_alpha, out=scratch, dtype=np.uint16)
+        np.add(scratch, premultiplied, out=scratch)
+        np.right_shift(scratch, 8, out=scratch)
+        np.copyto(region, scratch, casting="unsafe")
+        return True
@@ -0,0 +1,39 @@
+import re
+import subprocess
+
+import pytest
+from imageio_ffmpeg import count_frames_and_secs, get_ffmpeg_exe
+from mutagen.mp3 import MP3
+
+from benchmarks.synthetic import make_audio, make_images
+from storage.asset_store import AssetStore
+from video_generation.encoder import CAPTIONED_STILL_SETTINGS, STILL_IMAGE_SETTINGS
+from video_generation.video_generator import VideoGenerator
+
+
+def probe(path: str):
+    """Codecs of the streams and duration of the container, from what `ffmpeg -i` prints."""
+    output = subprocess.run([get_ffmpeg_exe(), "-hide_banner", "-i", path], capture_output=True, text=True).stderr
+    streams = re.findall(r"Stream #\d+:\d+.*?: (Video|Audio): (\w+)", output)
+    hours, minutes, seconds = re.search(r"Duration: (\d+):(\d+):([\d.]+)", output).groups()
+    return streams, int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+@pytest.mark.parametrize("captions, settings", [
+    (None, STILL_IMAGE_SETTINGS),
+    ("A short story. It has two sentences.", CAPTIONED_STILL_SETTINGS),
+])
+def test_still_video_has_one_stream_each_and_the_audio_length(tmp_path, captions, settings):
+    audio = make_audio(str(tmp_path / "story.mp3"), 3.5)
+    image, = make_images(str(tmp_path / "images"), 1, size=(540, 960))
+    generator = VideoGenerator(asset_store=AssetStore(str(tmp_path / "store")))
+
+    video = generator.generate_video_static(audio, static_image=image, captions=captions)
+
+    streams, duration = probe(video)
+    assert streams == [("Video", "h264"), ("Audio", "aac")]
+    audio_seconds = MP3(audio).info.length
+    frame = 1 / settings.fps
+    assert abs(duration - audio_seconds) <= frame
+    frames, _ = count_frames_and_secs(video)
+    assert abs(frames * frame - audio_seconds) <= frame
@@ -0,0 +1,70 @@
+import os
+import pickle
+
+import pytest
+
+from benchmarks.fakes import FakeImageServer
+from instrumentation.metrics import MetricsRegistry
+from outbound.scheduler import OutboundScheduler
+from storage.asset_store import AssetStore
+from video_generation.image_generation import DalleImageGenerator, dalle_size
+
+
+@pytest.fixture(scope="module")
+def server():
+    with FakeImageServer(image_size=64) as server:
+        yield server
+
+
+def image_generator(root, server: FakeImageServer, **kwargs) -> DalleImageGenerator:
+    scheduler = OutboundScheduler({}, registry=MetricsRegistry())
+    return DalleImageGenerator("fake-key", AssetStore(str(root)), api_base=server.api_base, scheduler=scheduler,
+                               **kwargs)
+
+
+def test_dalle_size_covers_the_longest_side():
+    assert dalle_size((200, 100)) == "256x256"
+    assert dalle_size((300, 512)) == "512x512"
+    assert dalle_size((1080, 1920)) == "1024x1024"
+
+
+def test_batch_is_split_into_as_few_requests_as_possible(tmp_path, server):
+    requests = server.requests
+    images = image_generator(tmp_path, server).generate("a lighthouse at night", n=12, size=(64, 64))
+
+    assert server.requests - requests == 2
+    paths = [image.path for image in images]
+    assert len(set(paths)) == 12
+    assert all(os.path.dirname(path) == str(tmp_path / "images") for path in paths)
+
+
+@pytest.mark.parametrize("response_format", ["b64_json", "url"])
+def test_images_are_stored_under_their_contents(tmp_path, server, response_format):
+    generator = image_generator(tmp_path, server, response_format=response_format)
+    image, = generator.generate("a lighthouse at night", size=(64, 64))
+
+    with open(image.path, "rb") as f:
+        contents = f.read()
+    assert contents in server.images.values()
+    assert os.path.basename(image.path) == AssetStore.hash_file(image.path) + ".png"
+
+
+def test_frames_are_fitted_from_the_response(tmp_path, server):
+    generator = image_generator(tmp_path, server)
+    image, = generator.generate("a lighthouse at night", size=(64, 64), frame_sizes=[(36, 64), (64, 36)])
+
+    assert {size: frame.shape for size, frame in image.frames.items()} == {(36, 64): (64, 36, 3),
+                                                                            (64, 36): (36, 64, 3)}
+    # Cached under the file's key, the render doesn't decode the image again
+    cached = generator.image_preprocessor.prepare_sizes(image.path, [(36, 64)])
+    assert (cached[(36, 64)] == image.frames[(36, 64)]).all()
+
+
+def test_generate_many_keeps_the_prompt_order(tmp_path, server):
+    results = image_generator(tmp_path, server).generate_many(["one", "two", "three"], n=2, size=(64, 64))
+    assert [len(images) for images in results] == [2, 2, 2]
+
+
+def test_generator_survives_pickling(tmp_path, server):
+    generator = pickle.loads(pickle.dumps(image_generator(tmp_path, server, max_concurrency=2)))
+    assert len(generator.generate("a lighthouse at night", size=(64, 64))) == 1
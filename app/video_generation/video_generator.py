@@ -1,22 +1,61 @@
 import os
-from dotenv import load_dotenv
-from typing import List, Optional
+import json
+import threading
+import contextvars
+from collections import namedtuple
+from contextlib import ExitStack
+from dataclasses import replace
+from typing import Callable, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 from mutagen.mp3 import MP3
-from moviepy import editor
 from PIL import Image
-from moviepy.editor import TextClip, CompositeVideoClip, ImageClip
-from moviepy.editor import *
 import logging
-from moviepy.video.io.VideoFileClip import VideoFileClip
-import glob
-from PIL import Image
-import openai
-import requests
+import numpy as np
+from environment import load_environment
+from instrumentation.metrics import METRICS, annotate
+from storage.asset_store import AssetStore
+from video_generation.image_preprocessor import ImagePreprocessor
+from video_generation.image_generation import DalleImageGenerator
+from video_generation.encoder import (EncoderSettings, STILL_IMAGE_SETTINGS, CAPTIONED_STILL_SETTINGS, PREVIEW_SETTINGS,
+                                      auto_settings, encode_audio, encode_still, mux, preview_size)
+from video_generation.motion import MotionSettings
+from video_generation.segmented import SegmentedEncoder, concat_segments
+from video_generation.subtitles import Cue, CaptionRenderer, sentence_cues, proportional_cues, to_srt
+from voice_generation.timings import load_timings
 
 # Load the environment variables
-env_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), '.env')
-load_dotenv(env_path)
+load_environment()
+
+logger = logging.getLogger(__name__)
+
+# Timing of a render: length of the audio, duration of every slide and the caption cues (None without captions)
+Timeline = namedtuple("Timeline", ["audio_seconds", "durations", "cues"])
+
+
+class RenderProgress:
+    """
+    Adds up the progress of the parts of a render, which run in parallel threads, into the
+    fraction done passed to `callback`. Parts are weighted by their units of work (e.g. segments).
+    """
+
+    def __init__(self, callback: Optional[Callable[[float], None]], total: float):
+        """
+        :param callback: Called with the fraction of the render done, None to ignore the progress
+        :param total: Units of work of the whole render
+        """
+        self.callback = callback
+        self.total = max(total, 1)
+        self.done: Dict[object, float] = {}
+        self.lock = threading.Lock()
+
+    def update(self, part, units: float):
+        """:param units: Units of work of `part` done so far"""
+        if self.callback is None:
+            return
+        with self.lock:
+            self.done[part] = units
+            self.callback(min(sum(self.done.values()) / self.total, 1.0))
 
 class Frames:
     INSTAGRAM_REEL = (1080, 1920)  # size in pixels
@@ -24,6 +63,11 @@ class Frames:
     TIKTOK_REEL = (1080, 1920)     
     INSTAGRAM_POST = (1080, 1080)  
 
+    @classmethod
+    def all(cls) -> Dict[str, tuple]:
+        """All the formats, keyed by name."""
+        return {name: size for name, size in vars(cls).items() if name.isupper()}
+
 class VideoGenerator:
 
     # If the app is ran in docker, the db folder is copied into the app folder
@@ -41,7 +85,12 @@ class VideoGenerator:
                  image_path: str = image_storage_path,
                  subtitle_path: str = subtitle_storage_path,
                  openai_api_key: Optional[str] = None, 
-                 stable_diff_api_key: Optional[str] = None):
+                 stable_diff_api_key: Optional[str] = None,
+                 asset_store: Optional[AssetStore] = None,
+                 image_preprocessor: Optional[ImagePreprocessor] = None,
+                 image_generator: Optional[DalleImageGenerator] = None,
+                 segmented_encoder: Optional[SegmentedEncoder] = None,
+                 quality: str = "balanced"):
         """
         :param src: List[str] would be a list of image file locations [db/storage/images/image1.png, ] or it can be
         a string "generate" which would use DALLE or Stable diffusion to generate new sets of images.
@@ -51,15 +100,26 @@ class VideoGenerator:
         :param image_path: Where the newly generated audio is stored
         :param openai_api_key - api key for OpenAI
         :param stable_diff_api_key - api key for Stable Diffusion
+        :param asset_store - content-addressed store the rendered videos are saved in
+        :param image_preprocessor - decodes and fits images to the frame size, with a cache
+        :param image_generator - generates images with DALL·E, see `generate_images`
+        :param segmented_encoder - encodes the slideshows in parallel segments across the cores
+        :param quality - quality/speed profile of the default encoder settings, see `auto_settings`
         """
 
         self.video_path = video_path
         self.audio_path = audio_path
         self.image_path = image_path
         self.subtitle_path = subtitle_path
-
-        openai.api_key = os.environ.get("OPENAI_KEY", openai_api_key)
+        self.asset_store = asset_store or AssetStore()
+        self.image_preprocessor = image_preprocessor or ImagePreprocessor(self.asset_store)
+        self.image_generator = image_generator or DalleImageGenerator(asset_store=self.asset_store,
+                                                                      image_preprocessor=self.image_preprocessor)
+        self.segmented_encoder = segmented_encoder or SegmentedEncoder()
+        self.quality = quality
+        self.openai_api_key = os.environ.get("OPENAI_KEY", openai_api_key)
         
+    @METRICS.instrument("video.upload_images", lambda self, image_files, *args, **kwargs: {"images": len(image_files)})
     def upload_images(self, image_files: List[str], destination_folder: str):
         """
         :param image_files: List of paths of images to upload
@@ -69,18 +129,19 @@ class VideoGenerator:
             shutil.copy(image_file, destination_folder)
     
     
-    def resize_image(self, image_path: str, size: tuple = Frames.INSTAGRAM_REEL) -> str:
+    @METRICS.instrument("video.resize_image", lambda self, image_path, *args, **kwargs: {"images": 1})
+    def resize_image(self, image_path: str, size: tuple = Frames.INSTAGRAM_REEL, fit: str = "crop") -> str:
         """Resize an image to the specified size and save it.
 
         Args:
             image_path: The path to the image to resize.
             size: The desired size as a tuple (width, height).
+            fit: How the aspect ratio is kept, see `ImagePreprocessor.prepare`.
 
         Returns:
             The path to the saved image.
         """
-        img = Image.open(image_path)
-        img = img.resize(size)
+        img = Image.fromarray(self.image_preprocessor.prepare(image_path, size, fit))
         new_image_path = image_path.rsplit('.', 1)[0] + '_resized.' + image_path.rsplit('.', 1)[1]
         img.save(new_image_path)
         return new_image_path
@@ -93,111 +154,351 @@ class VideoGenerator:
         audio = MP3(audio_file_path)
         return audio.info.length
 
-    def create_video(self, image_files: List[str], audio_file_path: str = None, video_size: tuple = Frames.INSTAGRAM_REEL):
+    def video_key(self, kind: str, audio_file_path: str, image_files: List[str], video_size: tuple, encoder_settings: dict) -> str:
+        """
+        :param kind: Type of render (e.g. "slideshow", "static")
+        :param audio_file_path: Path of the audio track of the video
+        :param image_files: Images the video is built from
+        :param video_size: Frame size of the video
+        :param encoder_settings: Settings passed to the encoder
+        :return: Content hash identifying the rendered video
+        """
+        return AssetStore.hash_key(
+            "video",
+            kind,
+            AssetStore.hash_file(audio_file_path),
+            [AssetStore.hash_file(image) for image in image_files],
+            video_size,
+            encoder_settings,
+            # Videos rendered before the index was moved to the front are remuxed once
+            "faststart",
+        )
+
+    def picture_key(self, kind: str, image_hashes: List[str], video_size: Optional[tuple], render_settings: dict,
+                    timeline) -> str:
+        """
+        Key of the silent video stream of a render, which depends on the images and the timing
+        of the audio but not on the audio itself: re-voicing a story with the same timing
+        reuses the encoded pictures and only muxes the new audio.
+
+        :param kind: Type of render (e.g. "slideshow", "static")
+        :param image_hashes: Content hashes of the images
+        :param video_size: Frame size of the video
+        :param render_settings: Settings of the render, the audio codec and bitrate are ignored
+        :param timeline: Whatever fixes the timing of the frames, e.g. the frame count of every slide
+        :return: Content hash identifying the video stream
+        """
+        picture_settings = {name: value for name, value in render_settings.items() if not name.startswith("audio_")}
+        return AssetStore.hash_key("picture", kind, image_hashes, video_size, picture_settings, timeline)
+
+    @METRICS.instrument("video.audio_track")
+    def audio_track(self, audio_file_path: str, settings: EncoderSettings = EncoderSettings()) -> str:
+        """
+        :param audio_file_path: Path of the story audio
+        :param settings: Encoder settings, only the audio codec and bitrate are used
+        :return: Path of the audio encoded for the video container, encoded once per audio asset
+        """
+        key = AssetStore.hash_key("audio_track", AssetStore.hash_file(audio_file_path),
+                                  settings.audio_codec, settings.audio_bitrate)
+        track_path = self.asset_store.get("audio_tracks", key, ".m4a")
+        annotate(cached=bool(track_path))
+        if track_path:
+            return track_path
+
+        with self.asset_store.atomic_path("audio_tracks", key, ".m4a") as tmp_path:
+            encode_audio(audio_file_path, tmp_path, settings)
+        return self.asset_store.path_for("audio_tracks", key, ".m4a")
+
+    @METRICS.instrument("video.timeline")
+    def timeline(self, audio_file_path: str, slides: int, captions: Optional[str] = None) -> Timeline:
+        """
+        Every slide is shown for an equal, exact share of the audio. The timeline is stored per
+        audio, number of slides and caption text, so the preview and the final render of a story
+        show the same cuts and captions and the final one doesn't read the audio and its timings again.
+
+        :param audio_file_path: Path of the story audio
+        :param slides: Number of slides
+        :param captions: Text of the story, timed into caption cues
+        :return: The timeline of the render
+        """
+        key = AssetStore.hash_key("timeline", AssetStore.hash_file(audio_file_path), slides, captions)
+        timeline_path = self.asset_store.get("timelines", key, ".json")
+        annotate(cached=bool(timeline_path))
+        if timeline_path:
+            with open(timeline_path) as f:
+                stored = json.load(f)
+            cues = [Cue(*cue) for cue in stored["cues"]] if stored["cues"] is not None else None
+            return Timeline(stored["audio_seconds"], stored["durations"], cues)
+
+        audio_seconds = self.read_audio_file(audio_file_path)
+        cues = self.subtitle_cues(audio_file_path, captions) if captions else None
+        timeline = Timeline(audio_seconds, [audio_seconds / slides] * slides, cues)
+        self.asset_store.put_bytes("timelines", key, ".json", json.dumps(timeline._asdict()).encode("utf-8"))
+        return timeline
+
+    @METRICS.instrument("video.create_video", lambda self, image_files, *args, **kwargs: {"images": len(image_files)})
+    def create_video(self, image_files: List[str], audio_file_path: str, video_size: tuple = Frames.INSTAGRAM_REEL,
+                     settings: Optional[EncoderSettings] = None, fit: str = "crop",
+                     motion: Optional[MotionSettings] = None, captions: Optional[str] = None,
+                     preview: bool = False, progress: Optional[Callable[[float], None]] = None) -> str:
         """
         :param image_files: List of paths of images to use for the video
         :param audio_file_path: Path of the audio file to use for the video
         :param video_size: Tuple , defaults to size for IG reel
+        :param settings: Encoder settings used for the render, defaults to the generator's quality profile
+            (`PREVIEW_SETTINGS` for a preview)
+        :param fit: How images with a different aspect ratio are fitted ("crop", "fit" or "stretch")
+        :param motion: Pan/zoom and crossfades between the images, still slides when None
+        :param captions: Text of the story, burnt into the video as subtitles
+        :param preview: Render a draft to check the slide order and timing, at a third of `video_size`.
+            The images are fitted to `video_size` in the same pass, so the final render of the same
+            inputs starts with them, the timeline and the audio track ready
+        :param progress: Called with the fraction of the render done, see `create_videos`
+        :return: Path of the rendered video
         """
-        if not audio_file_path:
-            # TODO: Current saving of audio is to a file called 'test.mp3' so if its not provided we will just grab that one. This needs to be updated.
-            audio_file_path = os.path.join(self.audio_path, "test.mp3")
+        if not preview:
+            return self.create_videos(image_files, audio_file_path, {"video": video_size}, settings, fit, motion,
+                                      captions, progress)["video"]
+
+        size = preview_size(video_size)
+        # Both sizes from a single decode of every image, the final ones are only cached for now
+        sizes = [motion.source_size(video_size), motion.source_size(size)] if motion else [tuple(video_size), size]
+        self.image_preprocessor.prepare_many_sizes(image_files, sizes, fit)
+        return self.create_videos(image_files, audio_file_path, {"preview": size}, settings or PREVIEW_SETTINGS, fit,
+                                  motion, captions, progress)["preview"]
+
+    @METRICS.instrument("video.create_videos", lambda self, image_files, *args, **kwargs: {"images": len(image_files)})
+    def create_videos(self, image_files: List[str], audio_file_path: str, formats: Optional[Dict[str, tuple]] = None,
+                      settings: Optional[EncoderSettings] = None, fit: str = "crop",
+                      motion: Optional[MotionSettings] = None, captions: Optional[str] = None,
+                      progress: Optional[Callable[[float], None]] = None) -> Dict[str, str]:
+        """
+        Render the same slideshow in several formats in one pass. Every image is decoded once
+        for all the sizes, the audio is encoded once and muxed into every video with stream
+        copy, and the formats are encoded in parallel. Formats of the same size share a render.
 
-        # Calculate duration per image
-        audio_length = self.read_audio_file(audio_file_path)
-        duration_per_image = audio_length / len(image_files)
-        
-        # Open, resize and save images as gif
-        images = [Image.open(image).resize(video_size, Image.ANTIALIAS) for image in image_files]
-        images[0].save("temp.gif", save_all=True, append_images=images[1:], duration=int(duration_per_image)*1000)
+        A render is built from stored stages, each redone only when its own inputs change:
+        the timeline (see `timeline`), the audio track (per audio asset), one silent segment per slide (see
+        `SegmentedEncoder.segment_keys`) and the final join of both with stream copy.
+        Swapping an image re-encodes that slide's segment only; changing the voice re-encodes
+        the audio track and re-joins, reusing the segments when the slides round to the same frames.
 
-        # Set output file name
-        output_file_name = os.path.splitext(os.path.basename(audio_file_path))[0] + '.mp4'
-        output_video_path = os.path.join(self.video_path, output_file_name)
-        
-        # Combine audio and gif to create video
-        video = editor.VideoFileClip("temp.gif")
-        audio = editor.AudioFileClip(audio_file_path)
-        final_video = video.set_audio(audio)
-        final_video.write_videofile(output_video_path, fps=30, codec="libx264")
-        
-        # Delete temporary gif
-        os.remove("temp.gif")
+        :param image_files: List of paths of images to use for the video
+        :param audio_file_path: Path of the audio file to use for the video
+        :param formats: Frame size per format name, defaults to all the `Frames`
+        :param settings: Encoder settings used for the renders, defaults to the generator's quality profile
+        :param fit: How images with a different aspect ratio are fitted ("crop", "fit" or "stretch")
+        :param motion: Pan/zoom and crossfades between the images, still slides when None
+        :param captions: Text of the story, burnt into the videos as subtitles
+        :param progress: Called with the fraction of the render done: once the images are fitted, after
+            every segment, within segments every few frames (see `SegmentedEncoder.encode_segments`)
+            and after every join. An exception it raises (e.g. the job was cancelled) stops the render
+        :return: Manifest of the rendered video path per format name
+        """
+        formats = formats or Frames.all()
+        settings = settings or auto_settings(self.quality, self.segmented_encoder.cores)
+        render_settings = dict(settings.as_dict(), fit=fit)
+        if motion is not None:
+            render_settings["motion"] = motion.as_dict()
+        timeline = self.timeline(audio_file_path, len(image_files), captions)
+        cues = timeline.cues
+        if cues is not None:
+            render_settings["captions"] = to_srt(cues)
+        keys = {size: self.video_key("slideshow", audio_file_path, image_files, size, render_settings)
+                for size in dict.fromkeys(tuple(size) for size in formats.values())}
+        paths = {size: self.asset_store.get("videos", key, ".mp4") for size, key in keys.items()}
+        missing = [size for size, path in paths.items() if not path]
+        annotate(renders=len(missing), cached_renders=len(paths) - len(missing))
+
+        if missing:
+            annotate(audio_seconds=timeline.audio_seconds)
+            durations = timeline.durations
+            audio_track = self.audio_track(audio_file_path, settings)
+
+            # Every slide is a stored segment of its own, only the ones whose frames changed are encoded
+            image_hashes = [AssetStore.hash_file(image) for image in image_files]
+            category = SegmentedEncoder.CATEGORY
+            segment_keys = {size: self.segmented_encoder.segment_keys(image_hashes, durations, size, settings, fit,
+                                                                      cues, motion)
+                            for size in missing}
+            segments = {size: [self.asset_store.get(category, key, ".mp4") for key in size_keys]
+                        for size, size_keys in segment_keys.items()}
+            unrendered = {size: [index for index, path in enumerate(size_segments) if not path]
+                          for size, size_segments in segments.items()}
+            annotate(segments=sum(len(indices) for indices in unrendered.values()),
+                     cached_segments=sum(len(paths) - len(unrendered[size]) for size, paths in segments.items()))
+            # One unit for fitting the images, one per segment to encode and one per join
+            tracker = RenderProgress(progress, 1 + sum(len(indices) + 1 for indices in unrendered.values()))
+
+            # Each fitted image is held once in memory per size and streamed to ffmpeg as raw frames.
+            # With motion the images are fitted larger, to the window of the tightest zoom, and the
+            # neighbours of a changed slide are needed for its crossfades
+            source_sizes = {size: motion.source_size(size) if motion else size for size in missing}
+            spread = 1 if motion else 0
+            needed = sorted({neighbour for indices in unrendered.values() for index in indices
+                             for neighbour in range(max(0, index - spread), min(len(image_files), index + spread + 1))})
+            sizes = list(dict.fromkeys(source_sizes[size] for size, indices in unrendered.items() if indices))
+            prepared = self.image_preprocessor.prepare_many_sizes([image_files[index] for index in needed], sizes, fit)
+            frames = dict(zip(needed, prepared))
+            tracker.update("images", 1)
+
+            def render(size):
+                if unrendered[size]:
+                    sources = [frames[index][source_sizes[size]] if index in frames else None
+                               for index in range(len(image_files))]
+                    with ExitStack() as stack:
+                        outputs = {index: stack.enter_context(
+                            self.asset_store.atomic_path(category, segment_keys[size][index], ".mp4"))
+                            for index in unrendered[size]}
+                        count = len(unrendered[size])
+                        self.segmented_encoder.encode_segments(
+                            sources, durations, outputs, size, settings, cues, motion,
+                            progress=lambda fraction: tracker.update(("segments", size), fraction * count))
+                    for index in unrendered[size]:
+                        segments[size][index] = self.asset_store.path_for(category, segment_keys[size][index], ".mp4")
+
+                with self.asset_store.atomic_path("videos", keys[size], ".mp4") as tmp_path:
+                    concat_segments(segments[size], tmp_path, audio_track, settings, copy_audio=True)
+                tracker.update(("join", size), 1)
+                video_path = self.asset_store.path_for("videos", keys[size], ".mp4")
+                self.asset_store.catalog.record_video(keys[size], video_path, "slideshow", audio_file_path,
+                                                      image_files, size, render_settings)
+                return video_path
+
+            # The encodes run in separate ffmpeg processes, threads are enough to use all the cores
+            # Each render runs in a copy of the caller's context, so its spans nest under this one
+            with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, render, size) for size in missing]
+                paths.update(zip(missing, [future.result() for future in futures]))
+
+        return {name: paths[tuple(size)] for name, size in formats.items()}
     
-    def generate_video_static(self, audio_file_path: str = None, static_image: Optional[str] = None):
+    @METRICS.instrument("video.generate_video_static")
+    def generate_video_static(self, audio_file_path: str, static_image: Optional[str] = None,
+                              settings: Optional[EncoderSettings] = None, captions: Optional[str] = None,
+                              preview: bool = False, progress: Optional[Callable[[float], None]] = None) -> str:
         """
         :param audio_file_path: Path of the audio file to use for the video
         :param static_image: Path of the static image, defaults to black
+        :param settings: Encoder settings, defaults to a still image tuned low frame rate encode
+        :param captions: Text of the story, burnt into the video as subtitles
+        :param preview: Render a draft at a third of the image size with the fastest preset, sharing
+            the timeline and audio track with the final render
+        :param progress: Called with the fraction of the frames encoded every few frames, see `encode_still`.
+            An exception it raises (e.g. the job was cancelled) stops the render
+        :return: Path of the rendered video
         """
         # Check static image
         if not static_image:
             static_image = os.path.join(self.image_path, "black_image.png")
-            
-        if not audio_file_path:
-            # TODO: Current saving of audio is to a file called 'test.mp3' so if its not provided we will just grab that one. This needs to be updated.
-            audio_file_path = os.path.join(self.audio_path, "test.mp3")
 
-        # Load the audio file
-        audio = AudioFileClip(audio_file_path)
-
-        # Load the static image file and convert it to a clip with the duration of the audio
-        img_clip = ImageClip(static_image, duration=audio.duration)
+        settings = settings or (CAPTIONED_STILL_SETTINGS if captions else STILL_IMAGE_SETTINGS)
+        if preview:
+            settings = replace(settings, preset=PREVIEW_SETTINGS.preset, crf=PREVIEW_SETTINGS.crf)
+        render_settings = settings.as_dict()
+        if preview:
+            render_settings["preview"] = True
+        timeline = self.timeline(audio_file_path, 1, captions)
+        cues = timeline.cues
+        if cues is not None:
+            render_settings["captions"] = to_srt(cues)
+
+        key = self.video_key("static", audio_file_path, [static_image], None, render_settings)
+        video_file_path = self.asset_store.get("videos", key, ".mp4")
+        annotate(cached=bool(video_file_path))
+        if video_file_path:
+            return video_file_path
+
+        duration = timeline.audio_seconds
+        annotate(audio_seconds=duration)
+        # The audio is encoded once per asset and shared with the slideshows of the same story
+        audio_track = self.audio_track(audio_file_path, settings)
+
+        picture_key = self.picture_key("static", [AssetStore.hash_file(static_image)], None, render_settings,
+                                       round(duration, 3))
+        picture_path = self.asset_store.get(SegmentedEncoder.CATEGORY, picture_key, ".mp4")
+        annotate(cached_picture=bool(picture_path))
+        if not picture_path:
+            # The image is decoded once and encoded at a very low frame rate for the length of the audio
+            image = Image.open(static_image).convert("RGB")
+            if preview:
+                image = image.resize(preview_size(image.size), Image.BILINEAR)
+            frame = np.asarray(image)
+            frame_size = (frame.shape[1] - frame.shape[1] % 2, frame.shape[0] - frame.shape[0] % 2)
+            caption_renderer = CaptionRenderer(cues, frame_size, settings.fps) if cues else None
+            with self.asset_store.atomic_path(SegmentedEncoder.CATEGORY, picture_key, ".mp4") as tmp_path:
+                encode_still(frame, duration, tmp_path, None, settings, captions=caption_renderer, progress=progress)
+            picture_path = self.asset_store.path_for(SegmentedEncoder.CATEGORY, picture_key, ".mp4")
+
+        with self.asset_store.atomic_path("videos", key, ".mp4") as tmp_path:
+            mux(picture_path, audio_track, tmp_path)
+        video_file_path = self.asset_store.path_for("videos", key, ".mp4")
+        self.asset_store.catalog.record_video(key, video_file_path, "static", audio_file_path, [static_image],
+                                              None, render_settings)
+        return video_file_path
+        
 
-        # Set the audio of the video to the audio clip
-        video = img_clip.set_audio(audio)
+    def subtitle_cues(self, audio_file_path: str, text: str, max_chars: int = 42, max_lines: int = 2) -> List[Cue]:
+        """
+        Time the story text against its audio without speech recognition. A story synthesized
+        sentence by sentence has the duration of every sentence saved next to its audio; other
+        audio (e.g. a cloned voice) is shared between the sentences in proportion to their length.
+
+        :param audio_file_path: Path of the story audio
+        :param text: Text of the story
+        :param max_chars: Characters per caption line
+        :param max_lines: Lines per caption
+        :return: Caption cues with their times in seconds
+        """
+        total = self.read_audio_file(audio_file_path)
+        timings = load_timings(audio_file_path)
+        if timings is not None and " ".join(timings[0]).split() == text.split():
+            return sentence_cues(*timings, total=total, max_chars=max_chars, max_lines=max_lines)
+        return proportional_cues(text, total, max_chars, max_lines)
+
+    @METRICS.instrument("video.generate_subtitles", lambda self, audio_file_path, text, *args, **kwargs: {
+        "characters": len(text)})
+    def generate_subtitles(self, audio_file_path: str, text: str, max_chars: int = 42, max_lines: int = 2) -> str:
+        """
+        Write the SRT subtitles of a story audio, see `subtitle_cues`.
 
-        # Create file output path
-        audio_name = os.path.splitext(os.path.basename(audio_file_path))[0] + ".mp4"
-        video_file_path = os.path.join(self.video_path, audio_name)
+        :param audio_file_path: Path of the story audio
+        :param text: Text of the story
+        :param max_chars: Characters per caption line
+        :param max_lines: Lines per caption
+        :return: Path of the .srt file
+        """
+        key = AssetStore.hash_key("subtitles", AssetStore.hash_file(audio_file_path), text, max_chars, max_lines)
+        subtitle_path = self.asset_store.get("subtitles", key, ".srt")
+        annotate(cached=bool(subtitle_path))
+        if subtitle_path:
+            return subtitle_path
 
-        # Write the final video file
-        video.write_videofile(video_file_path, codec='libx264', temp_audiofile='temp-audio.m4a', remove_temp=True, audio_codec='aac', fps=24)
-        
+        srt = to_srt(self.subtitle_cues(audio_file_path, text, max_chars, max_lines))
+        return self.asset_store.put_bytes("subtitles", key, ".srt", srt.encode("utf-8"))
 
-    def generate_subtitles(self, auido_file_path: str, subtitle_file_path: str, language='en'):
+    def generate_images(self, prompt: str, n: int = 1, size: tuple = Frames.INSTAGRAM_POST,
+                        frame_sizes: Optional[List[tuple]] = None, api_key: Optional[str] = None) -> List[str]:
         """
-        :param language: Language code of the audio file's language (default is 'en' for English)
+        :param prompt: Description of the images
+        :param n: Number of images, generated in as few requests as possible
+        :param size: Size the images are meant for
+        :param frame_sizes: Video sizes the images are fitted to right away, so the render finds them cached
+        :param api_key: OpenAI API key, defaults to the one of the generator
+        :return: Paths of the generated images, each under its own content hash
         """
-        # Generate a subtitle file name (without path) from audio file
-        subtitle_file_name = os.path.splitext(os.path.basename(subtitle_file_path))[0] + ".srt"
+        return [image.path for image in self.image_generator.generate(prompt, n, size, frame_sizes,
+                                                                         api_key=api_key or self.openai_api_key)]
 
-        # If subtitle file does not exist in the directory, generate it
-        if not glob.glob(f"{self.subtitle_storage_path}/{subtitle_file_name}"):
-            # TODO: Figure out how to generate subtitles. This seems to be the fix
-            # https://stackoverflow.com/questions/66977227/could-not-load-dynamic-library-libcudnn-so-8-when-running-tensorflow-on-ubun
-            pass
-    
     def generate_images_with_dalle(self, api_key: str, prompt: str, size: tuple = Frames.INSTAGRAM_POST):
-
-        openai.api_key = api_key
-
-        size_for_openai = "1024x1024"
-        
+        """
+        :return: Path of one generated image, None if the generation failed
+        """
         try:
-            generation_response = openai.Image.create(
-                prompt=prompt,
-                n=1,
-                size=size_for_openai,
-                response_format="url"
-            )
-
-            # save the image
-            generated_image_name = "generated_image.png"  # any name you like; the filetype should be .png
-            generated_image_filepath = os.path.join(self.image_path, generated_image_name)
-
-            generated_image_url = generation_response["data"][0]["url"]  # extract image URL from response
-            generated_image = requests.get(generated_image_url).content  # download the image
-
-            with open(generated_image_filepath, "wb") as image_file:
-                image_file.write(generated_image)
-              # write the image to the file
-            
-            print("Sucess!")
-
-            return generated_image_filepath
-        
-        except Exception as e:
-            print(e)
+            return self.generate_images(prompt, 1, size, api_key=api_key)[0]
+
+        except Exception:
+            logger.exception("Image generation failed")
 
 if __name__ == "__main__":
 
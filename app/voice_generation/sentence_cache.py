@@ -0,0 +1,95 @@
+import os
+import threading
+from typing import Optional
+
+from storage.asset_store import AssetStore
+
+
+class SentenceAudioCache:
+    """
+    Disk cache of synthesized sentences keyed by (sentence, voice, model).
+
+    When a user edits one sentence of a story and regenerates, only that sentence is sent to
+    the TTS service and the rest of the track is reassembled from the cache. Entries are
+    evicted least recently used first once the cache grows over `max_bytes`; the file mtime
+    is used as the access time so the order survives restarts.
+    """
+
+    CATEGORY = "audio_sentences"
+
+    def __init__(self, asset_store: AssetStore, max_bytes: int = 500 * 1024 * 1024):
+        """
+        :param asset_store: Store the sentence files are saved in
+        :param max_bytes: Size of the cache on disk before the least recently used entries are evicted
+        """
+        self.asset_store = asset_store
+        self.max_bytes = max_bytes
+        self.directory = asset_store.category_dir(self.CATEGORY)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.characters_saved = 0
+        self.characters_synthesized = 0
+        self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    @staticmethod
+    def key(sentence: str, voice, model: Optional[str]) -> str:
+        return AssetStore.hash_key("sentence_audio", sentence, str(voice), model)
+
+    def get(self, sentence: str, voice, model: Optional[str]) -> Optional[bytes]:
+        path = self.asset_store.path_for(self.CATEGORY, self.key(sentence, voice, model), ".mp3")
+        try:
+            with open(path, "rb") as f:
+                audio = f.read()
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # Not cached, or evicted by another session in the meantime
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.characters_saved += len(sentence)
+        return audio
+
+    def put(self, sentence: str, voice, model: Optional[str], audio: bytes):
+        self.asset_store.put_bytes(self.CATEGORY, self.key(sentence, voice, model), ".mp3", audio)
+        with self._lock:
+            self.characters_synthesized += len(sentence)
+            self._size += len(audio)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        entries = self._entries()
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+
+        # Evict down to 90% of the budget so we don't rescan the directory on every put
+        for entry in entries:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+
+    def _entries(self):
+        # Files starting with a dot are writes still in progress
+        return [entry for entry in os.scandir(self.directory)
+                if entry.name.endswith(".mp3") and not entry.name.startswith(".")]
+
+    def stats(self) -> dict:
+        """Hit/miss counters since the cache was created and its current size on disk."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "characters_saved": self.characters_saved,
+                "characters_synthesized": self.characters_synthesized,
+                "size_bytes": self._size,
+            }
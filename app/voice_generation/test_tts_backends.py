@@ -0,0 +1,133 @@
+import json
+
+import pytest
+import requests
+from requests.adapters import BaseAdapter
+
+from instrumentation.metrics import MetricsRegistry
+from outbound.scheduler import OutboundScheduler, ProviderLimits
+from voice_generation.timings import mp3_duration
+from voice_generation.tts_backends import ElevenLabsBackend, ElevenLabsHTTPError, FakeTTSBackend, silent_mp3, strip_id3
+
+VOICE_ID = "VR6AewLTigWG4xSOukaG"
+VOICES = {"voices": [{"voice_id": VOICE_ID, "name": "Arnold"}]}
+
+
+def response(status: int, body, **headers) -> requests.Response:
+    result = requests.Response()
+    result.status_code = status
+    result._content = body if isinstance(body, bytes) else body.encode("utf-8")
+    result.headers.update({name.replace("_", "-"): value for name, value in headers.items()})
+    return result
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport answering the requests of a session with `responses`, in order, and keeping the requests."""
+
+    def __init__(self):
+        super().__init__()
+        self.responses = []
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        result = self.responses.pop(0)
+        result.request, result.url = request, request.url
+        return result
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def elevenlabs():
+    scheduler = OutboundScheduler({"elevenlabs": ProviderLimits(max_retries=2, base_delay=0.01)},
+                                  registry=MetricsRegistry())
+    backend = ElevenLabsBackend("fake-key", scheduler=scheduler, api_base="https://elevenlabs.test/v1")
+    adapter = ReplayAdapter()
+    backend.session.mount("https://", adapter)
+    return backend, adapter, scheduler
+
+
+@pytest.mark.parametrize("failure, throttled", [
+    (response(502, "<html><body>502 Bad Gateway</body></html>"), False),
+    (response(500, json.dumps({"detail": "Internal Server Error"})), False),
+    (response(429, json.dumps({"detail": {"status": "rate_limit_exceeded", "message": "Slow down"}}),
+              Retry_After="0.05"), True),
+    (response(503, json.dumps({"detail": {"status": "system_busy", "message": "Try again later"}})), True),
+])
+def test_transient_failures_are_retried(elevenlabs, failure, throttled):
+    backend, adapter, scheduler = elevenlabs
+    adapter.responses += [failure, response(200, json.dumps(VOICES))]
+
+    assert [voice.name for voice in backend.list_voices()] == ["Arnold"]
+    assert scheduler.stats()["elevenlabs"]["retries"] == 1
+    assert scheduler.stats()["elevenlabs"]["rate_limited"] == throttled
+    assert [request.url for request in adapter.requests] == ["https://elevenlabs.test/v1/voices"] * 2
+    assert adapter.requests[0].headers["xi-api-key"] == "fake-key"
+
+
+def test_client_errors_are_not_retried(elevenlabs):
+    backend, adapter, scheduler = elevenlabs
+    adapter.responses += [response(400, json.dumps({"detail": {"status": "invalid_request", "message": "Bad voice"}})),
+                          response(200, json.dumps(VOICES))]
+
+    with pytest.raises(ElevenLabsHTTPError) as error:
+        backend.list_voices()
+    assert error.value.response.status_code == 400
+    assert (error.value.status, error.value.message) == ("invalid_request", "Bad voice")
+    assert scheduler.stats()["elevenlabs"]["retries"] == 0
+
+
+def test_voices_are_synthesized_by_id(elevenlabs):
+    backend, adapter, _ = elevenlabs
+    audio = silent_mp3(1.0)
+    adapter.responses += [response(200, json.dumps(VOICES)), response(200, audio), response(200, audio)]
+
+    assert backend.synthesize("Hello there.", "Arnold") == audio
+    assert backend.synthesize("Hello there.", VOICE_ID, model="eleven_multilingual_v2") == audio
+
+    # The name is looked up once, an id is used as is
+    assert [(request.method, request.url) for request in adapter.requests] == [
+        ("GET", "https://elevenlabs.test/v1/voices"),
+        ("POST", f"https://elevenlabs.test/v1/text-to-speech/{VOICE_ID}"),
+        ("POST", f"https://elevenlabs.test/v1/text-to-speech/{VOICE_ID}"),
+    ]
+    assert json.loads(adapter.requests[1].body) == {"text": "Hello there.", "model_id": "eleven_monolingual_v1"}
+    assert json.loads(adapter.requests[2].body)["model_id"] == "eleven_multilingual_v2"
+
+
+def test_clone_sends_the_samples_again_on_retry(elevenlabs, tmp_path):
+    backend, adapter, _ = elevenlabs
+    sample = tmp_path / "sample.mp3"
+    sample.write_bytes(silent_mp3(1.0))
+    adapter.responses += [response(502, "Bad Gateway"), response(200, json.dumps({"voice_id": "cloned"}))]
+
+    assert backend.clone_voice("Narrator", "Calm", [str(sample)]) == "cloned"
+    assert len(adapter.requests) == 2
+    for request in adapter.requests:
+        assert request.url == "https://elevenlabs.test/v1/voices/add"
+        assert sample.read_bytes() in request.body
+        assert b'name="name"' in request.body and b"Narrator" in request.body
+
+
+def test_silent_mp3_lasts_the_requested_time():
+    for seconds in (0.5, 2.0, 7.3):
+        assert abs(mp3_duration(silent_mp3(seconds)) - seconds) < 0.03
+
+
+def test_strip_id3_leaves_only_the_frames():
+    frames = silent_mp3(1.0)
+    # ID3v2.4 header with a synchsafe size of 130 bytes (1 << 7 | 2)
+    tag = b"ID3\x04\x00\x00\x00\x00\x01\x02" + bytes(130)
+    assert strip_id3(tag + frames) == frames
+    assert strip_id3(frames) == frames
+
+
+def test_fake_backend_speaks_at_its_rate_and_clones_voices():
+    backend = FakeTTSBackend(latency=0.0, chars_per_second=10)
+    assert abs(mp3_duration(backend.synthesize("x" * 40, "fake-arnold")) - 4.0) < 0.03
+
+    voice_id = backend.clone_voice("Narrator", "Calm", ["sample.mp3"])
+    assert (voice_id, "Narrator") in backend.list_voices()
+    assert [text for _, text in backend.calls] == ["x" * 40]
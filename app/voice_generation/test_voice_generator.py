@@ -0,0 +1,65 @@
+import time
+
+from storage.asset_store import AssetStore
+from voice_generation.text_chunking import split_sentences
+from voice_generation.timings import mp3_duration
+from voice_generation.tts_backends import FakeTTSBackend, silent_mp3
+from voice_generation.voice_generator import VoiceGenerator
+
+STORY = ("Once upon a time there was a lighthouse keeper. Every night he climbed the stairs. "
+         "One evening, a storm rolled in from the sea and the lamp went out. "
+         "He lit a candle. The ships found their way home anyway, guided by that small flame.")
+
+
+def voice_generator(root, backend: FakeTTSBackend, max_workers: int = 4) -> VoiceGenerator:
+    return VoiceGenerator(asset_store=AssetStore(str(root)), backend=backend, max_workers=max_workers)
+
+
+def test_split_sentences_merges_short_fragments():
+    assert split_sentences('"Yes!" she said. Run. The house was on fire, so we ran outside.') == [
+        '"Yes!" she said. Run.',
+        "The house was on fire, so we ran outside.",
+    ]
+    assert split_sentences("A long enough first sentence. Ok.") == ["A long enough first sentence. Ok."]
+
+
+def test_stream_yields_every_sentence_in_story_order(tmp_path):
+    # Longer sentences take longer, so the requests finish out of order
+    backend = FakeTTSBackend(latency=0.0, seconds_per_char=0.002)
+    chunks = list(voice_generator(tmp_path, backend).stream_story_audio(STORY))
+
+    sentences = split_sentences(STORY)
+    assert chunks == [silent_mp3(len(sentence) / backend.chars_per_second) for sentence in sentences]
+    assert sorted(text for _, text in backend.calls) == sorted(sentences)
+
+
+def test_first_sentence_is_ready_before_the_story(tmp_path):
+    backend = FakeTTSBackend(latency=0.2)
+    generator = voice_generator(tmp_path, backend, max_workers=2)
+    # The voice catalog is fetched once, before the timing
+    generator.get_list_of_voices()
+    start = time.perf_counter()
+    arrivals = [time.perf_counter() - start for _ in generator.stream_story_audio(STORY)]
+
+    assert len(arrivals) == len(split_sentences(STORY)) == 4
+    assert arrivals[0] < 0.35
+    # Two requests in flight at a time: two rounds of 0.2 s
+    assert arrivals[-1] >= 0.35
+    starts = sorted(started for started, _ in backend.calls)
+    assert starts[2] - starts[0] >= 0.15
+
+
+def test_story_audio_is_the_sentences_back_to_back(tmp_path):
+    backend = FakeTTSBackend(latency=0.0)
+    generator = voice_generator(tmp_path, backend)
+    chunks = []
+    path = generator.generate_story_audio(STORY, on_chunk=lambda index, chunk: chunks.append((index, chunk)))
+
+    with open(path, "rb") as f:
+        audio = f.read()
+    assert [index for index, _ in chunks] == list(range(4))
+    assert audio == b"".join(chunk for _, chunk in chunks)
+    assert abs(mp3_duration(audio) - sum(mp3_duration(chunk) for _, chunk in chunks)) < 0.01
+    # Stored, the same story isn't synthesized again
+    assert generator.generate_story_audio(STORY) == path
+    assert len(backend.calls) == 4
@@ -0,0 +1,46 @@
+import re
+from typing import List
+
+# A sentence ends with ., !, ? or … (optionally followed by closing quotes/brackets) and whitespace
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])[\"'”’)\]]*\s+")
+
+
+def split_sentences(text: str, min_chars: int = 20) -> List[str]:
+    """Split a story into sentences that are synthesized as separate TTS chunks.
+
+    Sentences shorter than `min_chars` (e.g. "Yes!" or dialogue fragments) are merged into the
+    following one, since very short requests cost a round trip and sound clipped on their own.
+
+    Args:
+        text: The story text.
+        min_chars: Minimum length of a chunk.
+
+    Returns:
+        List of sentences in story order, without surrounding whitespace.
+    """
+    chunks = []
+    pending = ""
+    for match in _iter_sentences(text):
+        pending = f"{pending} {match}".strip() if pending else match
+        if len(pending) >= min_chars:
+            chunks.append(pending)
+            pending = ""
+
+    if pending:
+        if chunks:
+            chunks[-1] = f"{chunks[-1]} {pending}"
+        else:
+            chunks.append(pending)
+    return chunks
+
+
+def _iter_sentences(text: str):
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        sentence = text[start:boundary.end()].strip()
+        if sentence:
+            yield sentence
+        start = boundary.end()
+    tail = text[start:].strip()
+    if tail:
+        yield tail
@@ -0,0 +1,44 @@
+import io
+import os
+import json
+from typing import List, Optional, Tuple
+
+from mutagen import MutagenError
+from mutagen.mp3 import MP3
+
+# Sentence timings are saved next to the story audio, under the same key
+TIMINGS_EXT = ".timings.json"
+
+
+def mp3_duration(audio: bytes) -> float:
+    """Duration in seconds of mp3 bytes (e.g. one TTS chunk), 0 if they can't be parsed."""
+    try:
+        return MP3(io.BytesIO(audio)).info.length
+    except MutagenError:
+        return 0.0
+
+
+def timings_path(audio_file_path: str) -> str:
+    return os.path.splitext(audio_file_path)[0] + TIMINGS_EXT
+
+
+def encode_timings(sentences: List[str], chunks: List[bytes]) -> bytes:
+    """
+    :param sentences: Sentences of the story, in the order they were synthesized
+    :param chunks: mp3 bytes of every sentence
+    :return: JSON document of the sentences and their durations in seconds
+    """
+    return json.dumps({"sentences": sentences, "durations": [mp3_duration(chunk) for chunk in chunks]}).encode("utf-8")
+
+
+def load_timings(audio_file_path: str) -> Optional[Tuple[List[str], List[float]]]:
+    """
+    :param audio_file_path: Path of a story audio
+    :return: (sentences, durations) of the audio, None if it wasn't synthesized sentence by sentence
+    """
+    try:
+        with open(timings_path(audio_file_path)) as f:
+            timings = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return timings["sentences"], timings["durations"]
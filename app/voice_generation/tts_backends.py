@@ -0,0 +1,197 @@
+import os
+import re
+import time
+import uuid
+import threading
+from collections import namedtuple
+from contextlib import ExitStack
+from typing import List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from outbound.scheduler import SCHEDULER, OutboundScheduler
+
+ELEVENLABS_API_BASE = os.environ.get("ELEVEN_BASE_URL", "https://api.elevenlabs.io/v1")
+# Model of the text-to-speech requests that don't name one
+ELEVENLABS_DEFAULT_MODEL = "eleven_monolingual_v1"
+# Voice ids, anything else is a voice name
+VOICE_ID = re.compile(r"^[a-zA-Z0-9]{20}$")
+
+# MPEG-1 Layer III, 128 kbps, 44.1 kHz, mono, no CRC. An all-zero frame body decodes to silence.
+SILENT_MP3_FRAME = b"\xff\xfb\x90\xc0" + bytes(417 - 4)
+MP3_FRAME_SECONDS = 1152 / 44100
+
+
+def silent_mp3(seconds: float) -> bytes:
+    """Return a valid mp3 of (roughly) `seconds` of silence, built without an encoder."""
+    return SILENT_MP3_FRAME * max(1, round(seconds / MP3_FRAME_SECONDS))
+
+
+def strip_id3(audio: bytes) -> bytes:
+    """Remove a leading ID3v2 tag so mp3 chunks can be concatenated into one stream."""
+    if audio[:3] != b"ID3" or len(audio) < 10:
+        return audio
+    size = (audio[6] << 21) | (audio[7] << 14) | (audio[8] << 7) | audio[9]
+    footer = 10 if audio[5] & 0x10 else 0
+    return audio[10 + size + footer:]
+
+
+VoiceInfo = namedtuple("VoiceInfo", ["voice_id", "name"])
+
+
+class ElevenLabsHTTPError(requests.HTTPError):
+    """
+    A failed ElevenLabs request, with its response for the status code and Retry-After, and the
+    status and message of the error body (e.g. "system_busy"), None if it has none.
+    """
+
+    def __init__(self, response: requests.Response):
+        self.status = self.message = None
+        try:
+            detail = response.json()["detail"]
+        except (ValueError, KeyError, TypeError):
+            # Not the JSON error body, e.g. a gateway's 502 page
+            detail = None
+        if isinstance(detail, dict):
+            self.status, self.message = detail.get("status"), detail.get("message")
+        elif isinstance(detail, str):
+            self.message = detail
+        super().__init__(f"ElevenLabs answered {response.status_code}: {self.message or response.reason}",
+                         response=response)
+
+
+class TTSBackend:
+    """
+    Interface of the text-to-speech services used by VoiceGenerator.
+    """
+
+    def list_voices(self) -> List[VoiceInfo]:
+        """
+        :return: Voices available on the account
+        """
+        raise NotImplementedError
+
+    def clone_voice(self, name: str, description: str, files: List[str]) -> str:
+        """
+        :param name: Name of the new voice
+        :param description: Description of the new voice
+        :param files: Paths of the voice samples
+        :return: Id of the cloned voice
+        """
+        raise NotImplementedError
+
+    def synthesize(self, text: str, voice, model: Optional[str] = None) -> bytes:
+        """
+        :param text: Text to speak
+        :param voice: Voice name or id
+        :param model: Model to use, None for the service default
+        :return: mp3 bytes
+        """
+        raise NotImplementedError
+
+
+class ElevenLabsBackend(TTSBackend):
+    """
+    ElevenLabs REST API, called through the outbound scheduler: the account's concurrency limit is
+    shared by all the generators of the process, and throttled, busy and failed (5xx) requests are
+    retried. The requests reuse their connections.
+    """
+
+    PROVIDER = "elevenlabs"
+
+    def __init__(self, api_key: str, scheduler: Optional[OutboundScheduler] = None, api_base: Optional[str] = None,
+                 timeout: float = 60, max_connections: int = 8):
+        """
+        :param api_key: ElevenLabs API key
+        :param scheduler: Rate limits and retries of the requests, defaults to the shared `SCHEDULER`
+        :param api_base: Base URL of the API, defaults to $ELEVEN_BASE_URL, then the public API
+        :param timeout: Seconds to wait for a response
+        :param max_connections: Connections kept open to the API
+        """
+        self.api_key = api_key
+        self.scheduler = scheduler or SCHEDULER
+        self.api_base = (api_base or ELEVENLABS_API_BASE).rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["xi-api-key"] = api_key
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=max_connections))
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=max_connections))
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        response = self.session.request(method, f"{self.api_base}/{path}", timeout=self.timeout, **kwargs)
+        if not response.ok:
+            raise ElevenLabsHTTPError(response)
+        return response
+
+    def _call(self, method: str, path: str, units: int, **kwargs) -> requests.Response:
+        return self.scheduler.call(self.PROVIDER, self._request, method, path, units=units, **kwargs)
+
+    def list_voices(self) -> List[VoiceInfo]:
+        voices = self._call("GET", "voices", units=0).json()["voices"]
+        return [VoiceInfo(voice["voice_id"], voice["name"]) for voice in voices]
+
+    def _clone(self, name: str, description: str, files: List[str]) -> requests.Response:
+        # Opened for every attempt, a retry sends the samples again
+        with ExitStack() as stack:
+            samples = [("files", (os.path.basename(file), stack.enter_context(open(file, "rb"))))
+                       for file in files]
+            return self._request("POST", "voices/add", data=dict(name=name, description=description),
+                                 files=samples)
+
+    def clone_voice(self, name: str, description: str, files: List[str]) -> str:
+        response = self.scheduler.call(self.PROVIDER, self._clone, name, description, files, units=0)
+        return response.json()["voice_id"]
+
+    def voice_id(self, voice: str) -> str:
+        """:param voice: Voice id or name, names are looked up in the voices of the account"""
+        if VOICE_ID.match(voice):
+            return voice
+        found = next((info.voice_id for info in self.list_voices() if info.name == voice), None)
+        if found is None:
+            raise ValueError(f"Voice '{voice}' not found.")
+        return found
+
+    def synthesize(self, text: str, voice, model: Optional[str] = None) -> bytes:
+        # Characters are what the account is billed and throttled on
+        body = dict(text=text, model_id=model or ELEVENLABS_DEFAULT_MODEL)
+        return self._call("POST", f"text-to-speech/{self.voice_id(voice)}", units=len(text), json=body,
+                          headers={"Accept": "audio/mpeg"}).content
+
+
+class FakeTTSBackend(TTSBackend):
+    """
+    Local stand-in for ElevenLabs. Returns silent mp3s whose length follows the text and sleeps
+    to simulate the request latency, so chunking, ordering and time-to-first-audio can be
+    exercised offline.
+    """
+
+    def __init__(self, latency: float = 0.3, seconds_per_char: float = 0.0, chars_per_second: float = 15.0):
+        """
+        :param latency: Fixed delay of every request in seconds
+        :param seconds_per_char: Additional delay per character of text
+        :param chars_per_second: Speaking rate used for the length of the returned audio
+        """
+        self.latency = latency
+        self.seconds_per_char = seconds_per_char
+        self.chars_per_second = chars_per_second
+        self.calls: List[Tuple[float, str]] = []
+        self.voices = [VoiceInfo("fake-arnold", "Arnold"), VoiceInfo("fake-bella", "Bella")]
+        self._lock = threading.Lock()
+
+    def list_voices(self) -> List[VoiceInfo]:
+        time.sleep(self.latency)
+        return list(self.voices)
+
+    def clone_voice(self, name: str, description: str, files: List[str]) -> str:
+        time.sleep(self.latency)
+        voice = VoiceInfo(f"fake-{uuid.uuid4().hex[:12]}", name)
+        with self._lock:
+            self.voices.append(voice)
+        return voice.voice_id
+
+    def synthesize(self, text: str, voice, model: Optional[str] = None) -> bytes:
+        with self._lock:
+            self.calls.append((time.perf_counter(), text))
+        time.sleep(self.latency + self.seconds_per_char * len(text))
+        return silent_mp3(len(text) / self.chars_per_second)
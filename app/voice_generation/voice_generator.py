@@ -1,74 +1,189 @@
-from elevenlabs import set_api_key, generate, voices, clone
 import os
-from dotenv import load_dotenv
-from typing import List
+import contextvars
+from typing import Callable, Iterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from environment import load_environment
+from instrumentation.metrics import METRICS, annotate, mark_failed
+from storage.asset_store import AssetStore
+from voice_generation.sentence_cache import SentenceAudioCache
+from voice_generation.text_chunking import split_sentences
+from voice_generation.timings import TIMINGS_EXT, encode_timings, mp3_duration
+from voice_generation.voice_registry import VoiceCatalog, ClonedVoiceRegistry
+from voice_generation.tts_backends import TTSBackend, ElevenLabsBackend, strip_id3
 
 # Load the environment variables
-env_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__)))), '.env')
-load_dotenv(env_path)
+load_environment()
 
+logger = logging.getLogger(__name__)
 
-class VoiceGenerator:
-
-    def __init__(self, api_key: str = None):
-
-        # Try to use the environment variable, if not present use the provided key
-        key = os.environ.get("ELEVEN_LABS_KEY", api_key)
-        if not key:
-            raise ValueError("API Key must be provided if ELEVEN_LABS_KEY environment variable is not set")
-        set_api_key(key)
 
-        # Define the path to the audio file storage directory (db is copied into app folder in docker)
-        root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
-        storage_dir = "app/db/storage" if os.path.exists(os.path.join(root_dir, "app/db/storage")) else "db/storage"
-        self.audio_file_dir = os.path.join(storage_dir, "audios")
-
-        # Create the directory and its parent directories if they don't exist
-        if not os.path.exists(self.audio_file_dir):
-            os.makedirs(self.audio_file_dir, exist_ok=True)
-            
-    def generate_story_audio(self, text: str, voice: str = "Arnold", model: str = "eleven_multilingual_v1"):
+class VoiceGenerator:
 
-        # TODO: Implement some kind of file naming protocol
-        audio_path = os.path.join(self.audio_file_dir, 'test.mp3')
+    def __init__(self, api_key: str = None, asset_store: Optional[AssetStore] = None,
+                 backend: Optional[TTSBackend] = None, max_workers: int = 4,
+                 sentence_cache: Optional[SentenceAudioCache] = None,
+                 voice_registry: Optional[ClonedVoiceRegistry] = None, catalog_ttl: float = 10 * 60):
+        """
+        :param api_key: ElevenLabs API key, ELEVEN_LABS_KEY takes precedence
+        :param asset_store: Store the generated audio files are saved in
+        :param backend: Text-to-speech backend, defaults to ElevenLabs
+        :param max_workers: Maximum number of sentences synthesized concurrently when streaming
+        :param sentence_cache: Cache of synthesized sentences, defaults to one in the asset store
+        :param voice_registry: Registry of the voices cloned from sample files, defaults to one in the asset store
+        :param catalog_ttl: Seconds the list of voices of the account is cached
+        """
+        if backend is None:
+            # Try to use the environment variable, if not present use the provided key
+            key = os.environ.get("ELEVEN_LABS_KEY", api_key)
+            if not key:
+                raise ValueError("API Key must be provided if ELEVEN_LABS_KEY environment variable is not set")
+            backend = ElevenLabsBackend(key)
+        self.backend = backend
+        self.max_workers = max_workers
+
+        # Audio files are stored content-addressed (db is copied into app folder in docker)
+        self.asset_store = asset_store or AssetStore()
+        self.audio_file_dir = self.asset_store.category_dir("audios")
+        self.sentence_cache = sentence_cache or SentenceAudioCache(self.asset_store)
+        self.voice_catalog = VoiceCatalog(self.backend.list_voices, ttl=catalog_ttl)
+        self.voice_registry = voice_registry or ClonedVoiceRegistry(self.asset_store)
+
+    @METRICS.instrument("voice.generate_story_audio", lambda self, text, *args, **kwargs: {"characters": len(text)})
+    def generate_story_audio(self, text: str, voice: str = "Arnold", model: str = "eleven_multilingual_v1",
+                             streaming: bool = True, on_chunk: Optional[Callable[[int, bytes], None]] = None):
+        """
+        Generate the story audio, reusing the stored file if the same text, voice and model
+        were already synthesized.
+
+        Args:
+            text: The story.
+            voice: Voice name.
+            model: ElevenLabs model.
+            streaming: Synthesize the story sentence by sentence, see `stream_story_audio`. This
+                is what lets an edited story reuse the cached audio of its unchanged sentences.
+            on_chunk: Called with (index, mp3 bytes) for every sentence in story order as soon as
+                it is ready, so playback can start before the whole story is synthesized.
+                Implies streaming.
+
+        Returns:
+            str - path of the mp3 file, or "" if it could not be saved
+        """
+        key = AssetStore.hash_key("audio", text, voice, model)
+        audio_path = self.asset_store.get("audios", key, ".mp3")
+        annotate(cached=bool(audio_path))
+        if audio_path:
+            return audio_path
 
-        audio = generate(text=text, voice=voice, model=model)
+        timings = None
+        if streaming or on_chunk:
+            chunks = []
+            for index, chunk in enumerate(self.stream_story_audio(text, voice, model)):
+                if on_chunk:
+                    on_chunk(index, chunk)
+                chunks.append(chunk)
+            audio = b"".join(chunks)
+            # The length of every sentence chunk times the subtitles, see `VideoGenerator.generate_subtitles`
+            timings = encode_timings(split_sentences(text), chunks)
+        else:
+            audio = self.backend.synthesize(text, self.voice_catalog.resolve(voice), model)
 
         try:
-            with open(audio_path, 'wb') as f:
-                f.write(audio)
-
+            if timings:
+                # Written first, so a stored audio always has the timings it was made with
+                self.asset_store.put_bytes("audios", key, TIMINGS_EXT, timings)
+            audio_path = self.asset_store.put_bytes("audios", key, ".mp3", audio)
+            self.asset_store.catalog.record_audio(audio_path, text, voice, model, mp3_duration(audio))
             return audio_path
 
         except Exception as e:
-            print(e)
+            logger.exception("Could not save the story audio %s", key)
+            mark_failed(e)
             return ""
 
+    @METRICS.instrument("voice.generate_story_with_new_voice",
+                        lambda self, text, name, description, files: {"characters": len(text), "samples": len(files)})
     def generate_story_with_new_voice(self, text: str, name: str, description: str, files: List[str]):
+        """
+        Clone a voice from the sample files and generate the story audio with it. The result is
+        keyed on the text, voice name and the contents of the samples, so a repeated request
+        skips both the clone and the synthesis. Samples that were cloned before reuse the
+        registered voice instead of cloning a duplicate on the account.
+
+        Returns:
+            str - path of the mp3 file, or "" if it could not be saved
+        """
+        sample_hashes = [AssetStore.hash_file(file) for file in files]
+        key = AssetStore.hash_key("cloned_audio", text, name, description, sample_hashes)
+        audio_path = self.asset_store.get("audios", key, ".mp3")
+        annotate(cached=bool(audio_path))
+        if audio_path:
+            return audio_path
 
-        audio_path = os.path.join(self.audio_file_dir, f"{name}.mp3")
-
-        voice = clone(
-            name=name,
-            description=description,
-            files=files
-        )
-
-        audio = generate(text=text, voice=voice)
+        registry_key = self.voice_registry.key(sample_hashes)
+        voice_id = self.voice_registry.get(registry_key)
+        if voice_id and not self.voice_catalog.find(voice_id):
+            # The voice was deleted from the account since it was cloned
+            self.voice_registry.evict(registry_key)
+            voice_id = None
+
+        if voice_id is None:
+            with METRICS.span("voice.clone", samples=len(files)):
+                voice_id = self.backend.clone_voice(
+                    name=name,
+                    description=description,
+                    files=files
+                )
+            self.voice_registry.put(registry_key, voice_id, name)
+            self.voice_catalog.invalidate()
+
+        audio = self.backend.synthesize(text, voice_id)
 
         try:
-            with open(audio_path, "wb") as f:
-                f.write(audio)
+            audio_path = self.asset_store.put_bytes("audios", key, ".mp3", audio)
+            self.asset_store.catalog.record_audio(audio_path, text, name, duration=mp3_duration(audio))
             return audio_path
 
         except Exception as e:
-            print(e)
+            logger.exception("Could not save the story audio %s", key)
+            mark_failed(e)
             return ""
     
-    @staticmethod
-    def get_list_of_voices():
-        return [v.name for v in voices()]
+    def stream_story_audio(self, text: str, voice: str = "Arnold", model: str = "eleven_multilingual_v1") -> Iterator[bytes]:
+        """
+        Split the story at sentence boundaries and synthesize the sentences concurrently on a
+        pool of `max_workers` threads. Sentences found in the sentence cache are not sent to
+        the TTS service again.
+
+        Yields:
+            mp3 bytes of every sentence in story order. Leading ID3 tags are stripped so the
+            chunks concatenate into a single mp3 stream without gaps between sentences.
+        """
+        sentences = split_sentences(text)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            # With the caller's context, so the requests keep its span and outbound priority
+            futures = [pool.submit(contextvars.copy_context().run, self.synthesize_sentence, sentence, voice, model)
+                       for sentence in sentences]
+            try:
+                for future in futures:
+                    yield strip_id3(future.result())
+            finally:
+                # Don't pay for sentences nobody is going to listen to
+                for future in futures:
+                    future.cancel()
+
+    @METRICS.instrument("voice.synthesize_sentence", lambda self, sentence, *args, **kwargs: {"characters": len(sentence)})
+    def synthesize_sentence(self, sentence: str, voice, model: Optional[str] = None) -> bytes:
+        audio = self.sentence_cache.get(sentence, voice, model)
+        annotate(cached=audio is not None)
+        if audio is None:
+            audio = self.backend.synthesize(sentence, self.voice_catalog.resolve(voice), model)
+            self.sentence_cache.put(sentence, voice, model, audio)
+        return audio
+
+    @METRICS.instrument("voice.get_list_of_voices")
+    def get_list_of_voices(self):
+        return self.voice_catalog.names()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import threading
+from typing import Callable, List, Optional
+
+from storage.asset_store import AssetStore
+from voice_generation.tts_backends import VoiceInfo
+
+
+class VoiceCatalog:
+    """
+    The voices available on the account, fetched at most once per `ttl` seconds.
+    """
+
+    def __init__(self, fetch: Callable[[], List[VoiceInfo]], ttl: float = 10 * 60):
+        """
+        :param fetch: Returns the voices of the account (e.g. `TTSBackend.list_voices`)
+        :param ttl: Seconds the fetched catalog is served before it is fetched again
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self._voices: Optional[List[VoiceInfo]] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def list(self) -> List[VoiceInfo]:
+        with self._lock:
+            if self._voices is None or time.time() - self._fetched_at > self.ttl:
+                self._voices = self.fetch()
+                self._fetched_at = time.time()
+            return self._voices
+
+    def names(self) -> List[str]:
+        return [voice.name for voice in self.list()]
+
+    def find(self, voice: str) -> Optional[VoiceInfo]:
+        """Look a voice up by id or name."""
+        return next((v for v in self.list() if voice in (v.voice_id, v.name)), None)
+
+    def resolve(self, voice):
+        """Return the id of a voice given by name, so the TTS service doesn't look it up on every request."""
+        found = self.find(voice) if isinstance(voice, str) else None
+        return found.voice_id if found else voice
+
+    def invalidate(self):
+        with self._lock:
+            self._voices = None
+
+
+class ClonedVoiceRegistry:
+    """
+    Maps a hash of the voice sample files to the id of the voice cloned from them, so uploading
+    the same samples again reuses the voice instead of cloning a duplicate on the account.
+
+    Entries not used for `ttl` seconds, or whose voice no longer exists on the account, are
+    evicted. The file mtime of an entry is its last use.
+    """
+
+    CATEGORY = "cloned_voices"
+
+    def __init__(self, asset_store: Optional[AssetStore] = None, ttl: float = 30 * 24 * 60 * 60):
+        """
+        :param asset_store: Store the registry entries are saved in
+        :param ttl: Seconds an unused entry is kept
+        """
+        self.asset_store = asset_store or AssetStore()
+        self.ttl = ttl
+
+    @staticmethod
+    def key(sample_hashes: List[str]) -> str:
+        # The order the samples were uploaded in doesn't change the voice
+        return AssetStore.hash_key("cloned_voice", sorted(sample_hashes))
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the voice id registered for the samples, None if there is none or it expired."""
+        path = self.asset_store.path_for(self.CATEGORY, key, ".json")
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                self.evict(key)
+                return None
+            with open(path) as f:
+                entry = json.load(f)
+            # Mark the entry as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return entry["voice_id"]
+
+    def put(self, key: str, voice_id: str, name: str):
+        entry = {"voice_id": voice_id, "name": name, "created_at": time.time()}
+        self.asset_store.put_bytes(self.CATEGORY, key, ".json", json.dumps(entry).encode("utf-8"))
+
+    def evict(self, key: str):
+        try:
+            os.remove(self.asset_store.path_for(self.CATEGORY, key, ".json"))
+        except FileNotFoundError:
+            pass
+
+    def sweep(self, catalog: Optional[VoiceCatalog] = None) -> int:
+        """
+        Evict the expired entries, and with a catalog the entries of voices deleted from the account.
+
+        :return: Number of evicted entries
+        """
+        voice_ids = {voice.voice_id for voice in catalog.list()} if catalog else None
+        evicted = 0
+        for entry in os.scandir(self.asset_store.category_dir(self.CATEGORY)):
+            if not entry.name.endswith(".json") or entry.name.startswith("."):
+                continue
+            key = entry.name[:-len(".json")]
+            try:
+                expired = time.time() - entry.stat().st_mtime > self.ttl
+                if not expired and voice_ids is not None:
+                    with open(entry.path) as f:
+                        expired = json.load(f)["voice_id"] not in voice_ids
+            except FileNotFoundError:
+                continue
+            if expired:
+                self.evict(key)
+                evicted += 1
+        return evicted